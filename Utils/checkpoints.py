@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import time
+
+from utils.feature_store import file_hash
+
+MANIFEST_DIR = 'manifests'
+
+
+def _digest(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StageCheckpoints:
+    """Per-run stage manifests that let a rerun skip up-to-date stages.
+
+    Every stage records, in `<run_dir>/manifests/<stage>.json`, the digests
+    of its inputs, its parameters and the outputs it produced. A stage's
+    key is the hash of its inputs and parameters, and it doubles as the
+    digest of its outputs for the stages downstream. On a rerun a stage is
+    skipped when its key is unchanged and all its outputs still exist, so
+    work resumes at the first stale stage and everything after it.
+    """
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.manifest_dir = os.path.join(run_dir, MANIFEST_DIR)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self._hash_cache_path = os.path.join(self.manifest_dir, 'file_hashes.json')
+        try:
+            with open(self._hash_cache_path) as f:
+                self._hash_cache = json.load(f)
+        except (OSError, ValueError):
+            self._hash_cache = {}
+
+    def file_digest(self, path):
+        """SHA-1 of a file, cached by (size, mtime) so unchanged files are not read again"""
+        st = os.stat(path)
+        cache_key = os.path.abspath(path)
+        cached = self._hash_cache.get(cache_key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        digest = file_hash(path)
+        self._hash_cache[cache_key] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def save_hash_cache(self):
+        with open(self._hash_cache_path, 'w') as f:
+            json.dump(self._hash_cache, f)
+
+    def files_digest(self, paths):
+        """Content digest of a set of files (by basename and SHA-1)"""
+        entries = [(os.path.basename(path), self.file_digest(path))
+                   for path in sorted(paths, key=os.path.basename)]
+        self.save_hash_cache()
+        return _digest(entries)
+
+    def _manifest_path(self, stage):
+        return os.path.join(self.manifest_dir, f'{stage}.json')
+
+    def load(self, stage):
+        try:
+            with open(self._manifest_path(stage)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, stage, key):
+        manifest = self.load(stage)
+        return (manifest is not None and manifest.get('key') == key
+                and all(os.path.exists(os.path.join(self.run_dir, o)) for o in manifest['outputs']))
+
+    def invalidate(self, stage):
+        try:
+            os.remove(self._manifest_path(stage))
+        except OSError:
+            pass
+
+    def run(self, stage, fn, inputs, params, outputs, extra=None):
+        """Run `fn()` unless `stage` is up to date; returns (key, skipped)
+
+        `inputs` maps names to digests (usually the keys of upstream
+        stages), `params` must be JSON-serializable and `outputs` are
+        paths relative to the run directory. `extra` is stored in the
+        manifest as is.
+        """
+        key = _digest({'stage': stage, 'inputs': inputs, 'params': params})
+        if self.is_fresh(stage, key):
+            return key, True
+
+        # Drop the old manifest first so an interrupted stage is never trusted
+        self.invalidate(stage)
+        start = time.time()
+        fn()
+        manifest = {
+            'stage': stage,
+            'key': key,
+            'inputs': inputs,
+            'params': params,
+            'outputs': list(outputs),
+            'duration': round(time.time() - start, 3),
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        if extra:
+            manifest.update(extra)
+        tmp = self._manifest_path(stage) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, default=str)
+        os.replace(tmp, self._manifest_path(stage))
+        return key, False
@@ -0,0 +1,125 @@
+import sqlite3
+
+import numpy as np
+
+MAX_IMAGE_ID = 2**31 - 1
+
+# COLMAP camera model ids
+SIMPLE_RADIAL = 2
+
+# COLMAP TwoViewGeometry::ConfigurationType
+UNCALIBRATED = 3
+
+
+def image_ids_to_pair_id(image_id1, image_id2):
+    if image_id1 > image_id2:
+        image_id1, image_id2 = image_id2, image_id1
+    return image_id1 * MAX_IMAGE_ID + image_id2
+
+
+def pair_id_to_image_ids(pair_id):
+    image_id2 = pair_id % MAX_IMAGE_ID
+    image_id1 = (pair_id - image_id2) // MAX_IMAGE_ID
+    return image_id1, image_id2
+
+
+def _blob(array):
+    return array.tobytes() if array is not None else None
+
+
+class COLMAPDatabase:
+    """Thin writer for the tables of a COLMAP `database.db`.
+
+    The schema itself is expected to exist already (created by
+    `colmap database_creator`) so it always matches the installed COLMAP
+    version. All inserts go through `executemany` inside one transaction;
+    call `commit()` once everything is written.
+    """
+
+    def __init__(self, database_path):
+        self.connection = sqlite3.connect(database_path)
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA journal_mode = MEMORY')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.connection.rollback()
+        self.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def add_camera(self, model, width, height, params, prior_focal_length=False):
+        params = np.asarray(params, np.float64)
+        cursor = self.connection.execute(
+            'INSERT INTO cameras (model, width, height, params, prior_focal_length) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (model, width, height, _blob(params), int(prior_focal_length)))
+        return cursor.lastrowid
+
+    def add_image(self, name, camera_id):
+        cursor = self.connection.execute(
+            'INSERT INTO images (name, camera_id) VALUES (?, ?)', (name, camera_id))
+        return cursor.lastrowid
+
+    def image_ids(self):
+        """Map image name -> image_id for images already in the database"""
+        return dict(self.connection.execute('SELECT name, image_id FROM images'))
+
+    def clear_matches(self):
+        """Delete all raw and verified matches, e.g. before re-matching"""
+        self.connection.execute('DELETE FROM matches')
+        self.connection.execute('DELETE FROM two_view_geometries')
+
+    def add_keypoints_many(self, items):
+        """Insert keypoints for many images; `items` yields (image_id, Nx2 array)"""
+        rows = []
+        for image_id, keypoints in items:
+            keypoints = np.ascontiguousarray(keypoints, np.float32)
+            rows.append((image_id,) + keypoints.shape + (_blob(keypoints),))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO keypoints (image_id, rows, cols, data) VALUES (?, ?, ?, ?)', rows)
+
+    def add_descriptors_many(self, items):
+        """Insert descriptors for many images; `items` yields (image_id, NxD uint8 array)"""
+        rows = []
+        for image_id, descriptors in items:
+            descriptors = np.ascontiguousarray(descriptors, np.uint8)
+            rows.append((image_id,) + descriptors.shape + (_blob(descriptors),))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO descriptors (image_id, rows, cols, data) VALUES (?, ?, ?, ?)', rows)
+
+    @staticmethod
+    def _pair_row(image_id1, image_id2, matches):
+        matches = np.asarray(matches, np.uint32).reshape(-1, 2)
+        if image_id1 > image_id2:
+            matches = matches[:, ::-1]
+        matches = np.ascontiguousarray(matches)
+        return (image_ids_to_pair_id(image_id1, image_id2),) + matches.shape + (_blob(matches),)
+
+    def add_matches_many(self, items):
+        """Insert raw matches; `items` yields (image_id1, image_id2, Kx2 array)"""
+        rows = [self._pair_row(i1, i2, m) for i1, i2, m in items]
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO matches (pair_id, rows, cols, data) VALUES (?, ?, ?, ?)', rows)
+
+    def add_two_view_geometries_many(self, items):
+        """Insert verified matches; `items` yields (image_id1, image_id2, Kx2 array, F, config)"""
+        rows = []
+        for image_id1, image_id2, matches, F, config in items:
+            F = np.eye(3) if F is None else np.asarray(F, np.float64)
+            if image_id1 > image_id2:
+                F = F.T
+            rows.append(self._pair_row(image_id1, image_id2, matches)
+                        + (config, _blob(F), _blob(np.eye(3)), _blob(np.eye(3))))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO two_view_geometries '
+            '(pair_id, rows, cols, data, config, F, E, H) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
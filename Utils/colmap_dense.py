@@ -1,44 +1,64 @@
-import subprocess
 import os
 
-COLMAP_PATH = r'D:\colmap-main\bin\colmap.exe'
+from utils.colmap_runner import colmap_executable, run_colmap
 
-def run_colmap_dense(sparse_dir, image_dir, output_dir):
+DEFAULT_PATCH_MATCH_OPTIONS = {
+    'geom_consistency': 'true',
+    'max_image_size': 4000,
+    'window_radius': 7,
+    'num_samples': 20,
+    'num_iterations': 1,
+}
+
+def run_image_undistorter(sparse_dir, image_dir, output_dir):
     os.makedirs(output_dir, exist_ok=True)
-    
-    # Image undistorter
     print("Running COLMAP image undistortion...")
-    subprocess.run([
-        COLMAP_PATH, 'image_undistorter',
+    run_colmap([
+        colmap_executable(), 'image_undistorter',
         '--image_path', image_dir,
         '--input_path', os.path.join(sparse_dir, '0'),
         '--output_path', output_dir,
         '--output_type', 'COLMAP'
-    ], check=True)
+    ])
     print("✓ Image undistortion completed")
-    
-    # Patch match stereo with higher density
+
+def run_patch_match_stereo(output_dir, options=None):
+    """Patch match stereo with higher density; `options` override DEFAULT_PATCH_MATCH_OPTIONS"""
+    options = {**DEFAULT_PATCH_MATCH_OPTIONS, **(options or {})}
     print("Running COLMAP patch match stereo...")
-    subprocess.run([
-        COLMAP_PATH, 'patch_match_stereo',
-        '--workspace_path', output_dir,
-        '--workspace_format', 'COLMAP',
-        '--PatchMatchStereo.geom_consistency', 'true',
-        '--PatchMatchStereo.max_image_size', '4000',
-        '--PatchMatchStereo.window_radius', '7',
-        '--PatchMatchStereo.num_samples', '20',
-        '--PatchMatchStereo.num_iterations', '1'
-    ], check=True)
+    args = [colmap_executable(), 'patch_match_stereo',
+            '--workspace_path', output_dir,
+            '--workspace_format', 'COLMAP']
+    for key, value in options.items():
+        args += [f'--PatchMatchStereo.{key}', str(value)]
+    run_colmap(args)
     print("✓ Patch match stereo completed")
-    
-    # Stereo fusion with lower min_num_pixels for more points
+
+def write_patch_match_config(output_dir, image_names, num_src_images=20):
+    """Restrict patch match stereo to `image_names`
+
+    patch_match_stereo only computes depth maps for the reference images
+    listed in stereo/patch-match.cfg; depth maps of the other images are
+    left as they are and still used by stereo_fusion.
+    """
+    with open(os.path.join(output_dir, 'stereo', 'patch-match.cfg'), 'w') as f:
+        for name in image_names:
+            f.write(f"{name}\n__auto__, {num_src_images}\n")
+
+def run_stereo_fusion(output_dir, min_num_pixels=3):
+    """Stereo fusion with lower min_num_pixels for more points"""
     print("Running COLMAP stereo fusion...")
-    subprocess.run([
-        COLMAP_PATH, 'stereo_fusion',
+    run_colmap([
+        colmap_executable(), 'stereo_fusion',
         '--workspace_path', output_dir,
         '--workspace_format', 'COLMAP',
         '--input_type', 'geometric',
         '--output_path', os.path.join(output_dir, 'fused.ply'),
-        '--StereoFusion.min_num_pixels', '3'
-    ], check=True)
-    print("✓ Stereo fusion completed") 
\ No newline at end of file
+        '--StereoFusion.min_num_pixels', str(min_num_pixels)
+    ])
+    print("✓ Stereo fusion completed")
+
+def run_colmap_dense(sparse_dir, image_dir, output_dir, patch_match_options=None, min_num_pixels=3):
+    run_image_undistorter(sparse_dir, image_dir, output_dir)
+    run_patch_match_stereo(output_dir, patch_match_options)
+    run_stereo_fusion(output_dir, min_num_pixels)
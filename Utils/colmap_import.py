@@ -0,0 +1,198 @@
+import os
+
+import cv2
+import numpy as np
+
+from utils.colmap_database import COLMAPDatabase, SIMPLE_RADIAL, UNCALIBRATED
+from utils.colmap_runner import run_colmap
+from utils.image_processing import image_size, load_image, resized_shape
+from utils.pair_planner import plan_pairs, write_pairs
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+def list_images(image_dir):
+    """Image file names in `image_dir`, as COLMAP names them"""
+    return sorted(f for f in os.listdir(image_dir)
+                  if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def _original_size(path):
+    size = image_size(path)
+    if size is None:
+        size = load_image(path).shape[:2]
+    return size
+
+
+def _quantize_descriptors(descriptors):
+    """L2-normalized float descriptors (D x N) -> N x D uint8, as stored by COLMAP"""
+    return np.clip(np.round(descriptors.T * 127.5 + 127.5), 0, 255).astype(np.uint8)
+
+
+def verify_matches(kpts0, kpts1, matches, min_num_inliers=15, max_error=4.0, confidence=0.999):
+    """RANSAC fundamental-matrix verification; returns (inlier matches, F) or (None, None)"""
+    if len(matches) < max(8, min_num_inliers):
+        return None, None
+    pts0 = kpts0[matches[:, 0]].astype(np.float64)
+    pts1 = kpts1[matches[:, 1]].astype(np.float64)
+    F, mask = cv2.findFundamentalMat(pts0, pts1, cv2.FM_RANSAC, max_error, confidence)
+    if F is None or mask is None:
+        return None, None
+    inliers = matches[mask.ravel().astype(bool)]
+    if len(inliers) < min_num_inliers:
+        return None, None
+    return inliers, F[:3]
+
+
+def _learned_features(image_dir, names, superpoint_config, max_size, device, batch_size, store):
+    """SuperPoint features plus original sizes, network input shapes and COLMAP keypoints"""
+    from utils.feature_extraction import extract_superpoint_features_batch
+
+    paths = [os.path.join(image_dir, n) for n in names]
+    features = extract_superpoint_features_batch(
+        paths, batch_size=batch_size, device=device, config=superpoint_config,
+        max_size=max_size, store=store)
+
+    sizes, shapes, keypoints = {}, {}, {}
+    for name, path, (kpts, _, _) in zip(names, paths, features):
+        sizes[name] = _original_size(path)
+        shapes[name] = resized_shape(sizes[name], max_size)
+        h, w = sizes[name]
+        rh, rw = shapes[name]
+        # COLMAP puts the center of the top-left pixel at (0.5, 0.5)
+        keypoints[name] = (kpts + 0.5) * np.array([w / rw, h / rh], np.float32)
+    return dict(zip(names, features)), sizes, shapes, keypoints
+
+
+def import_learned_keypoints(colmap_path, image_dir, database_path, superpoint_config=None,
+                             max_size=1024, device='auto', batch_size=8, store=None):
+    """Create a COLMAP database holding SuperPoint keypoints and descriptors
+
+    The database is created with `colmap database_creator` so its schema
+    matches the installed COLMAP. Cameras, images, keypoints and quantized
+    descriptors are written in a single transaction.
+    """
+    if os.path.exists(database_path):
+        os.remove(database_path)
+    run_colmap([colmap_path, 'database_creator', '--database_path', database_path])
+    return add_learned_keypoints(image_dir, database_path, list_images(image_dir),
+                                 superpoint_config, max_size, device, batch_size, store)
+
+
+def add_learned_keypoints(image_dir, database_path, names, superpoint_config=None,
+                          max_size=1024, device='auto', batch_size=8, store=None):
+    """Add images `names` with their SuperPoint keypoints to an existing database"""
+    print(f"Extracting SuperPoint features from {len(names)} images...")
+    features, sizes, _, keypoints = _learned_features(
+        image_dir, names, superpoint_config, max_size, device, batch_size, store)
+
+    with COLMAPDatabase(database_path) as db:
+        image_ids = {}
+        for name in names:
+            h, w = sizes[name]
+            camera_id = db.add_camera(SIMPLE_RADIAL, w, h, [1.2 * max(w, h), w / 2, h / 2, 0.0])
+            image_ids[name] = db.add_image(name, camera_id)
+        db.add_keypoints_many((image_ids[n], keypoints[n]) for n in names)
+        db.add_descriptors_many((image_ids[n], _quantize_descriptors(features[n][1])) for n in names)
+    return image_ids
+
+
+def import_learned_matches(image_dir, database_path, pairs=None,
+                           pair_strategy='exhaustive', num_neighbors=10,
+                           superpoint_config=None, superglue_config=None,
+                           max_size=1024, device='auto', batch_size=8, match_batch_size=16,
+                           matcher='superglue', min_nn_inliers=50, store=None,
+                           replace=True):
+    """Match the images of a database created by import_learned_keypoints
+
+    Matches `pairs` (planned with `pair_strategy` when not given, see
+    utils.pair_planner) and verifies them with a fundamental-matrix RANSAC.
+    `matcher` is 'superglue', 'nn' (mutual nearest neighbors only) or
+    'adaptive' (mutual NN first, SuperGlue for pairs with fewer than
+    `min_nn_inliers` RANSAC inliers). With `replace` existing matches are
+    deleted first, otherwise the new pairs are added to them. Raw and
+    verified matches are written in a single transaction.
+    """
+    # Imported lazily so the SIFT path does not need torch
+    from utils.feature_matching import (match_superglue_pairs, match_mutual_nn,
+                                        match_pairs_with_fallback)
+
+    with COLMAPDatabase(database_path) as db:
+        image_ids = db.image_ids()
+    if pairs is None:
+        names = sorted(image_ids)
+    else:
+        names = sorted({name for pair in pairs for name in pair})
+    features, _, shapes, keypoints = _learned_features(
+        image_dir, names, superpoint_config, max_size, device, batch_size, store)
+
+    if pairs is None:
+        pairs = plan_pairs(names, pair_strategy, num_neighbors, features)
+    if replace:
+        write_pairs(pairs, os.path.join(os.path.dirname(os.path.abspath(database_path)), 'pairs.txt'))
+    print(f"Matching {len(pairs)} image pairs ({matcher})...")
+    if matcher == 'superglue':
+        results = match_superglue_pairs(features, pairs, shapes, batch_size=match_batch_size,
+                                        device=device, config=superglue_config)
+    elif matcher == 'nn':
+        results = ((a, b, match_mutual_nn(features[a][1], features[b][1])['matches0'], None)
+                   for a, b in pairs)
+    elif matcher == 'adaptive':
+        def count_inliers(name0, name1, matches0):
+            valid = matches0 > -1
+            matches = np.stack([np.where(valid)[0], matches0[valid]], -1)
+            inliers, F = verify_matches(keypoints[name0], keypoints[name1], matches)
+            # Kept so the pairs that stay with their NN matches are not verified twice
+            checked[name0, name1] = (matches0, inliers, F)
+            return 0 if inliers is None else len(inliers)
+        checked = {}
+        results = match_pairs_with_fallback(features, pairs, shapes, min_inliers=min_nn_inliers,
+                                            count_inliers=count_inliers, batch_size=match_batch_size,
+                                            device=device, config=superglue_config)
+    else:
+        raise ValueError(f"Unknown matcher: {matcher}")
+
+    raw_matches, verified = [], []
+    for name0, name1, matches0, _ in results:
+        valid = matches0 > -1
+        matches = np.stack([np.where(valid)[0], matches0[valid]], -1)
+        raw_matches.append((name0, name1, matches))
+        cached = checked.pop((name0, name1), None) if matcher == 'adaptive' else None
+        if cached is not None and cached[0] is matches0:
+            inliers, F = cached[1:]
+        else:
+            inliers, F = verify_matches(keypoints[name0], keypoints[name1], matches)
+        if inliers is not None:
+            verified.append((name0, name1, inliers, F))
+
+    with COLMAPDatabase(database_path) as db:
+        if replace:
+            db.clear_matches()
+        db.add_matches_many((image_ids[a], image_ids[b], m) for a, b, m in raw_matches)
+        db.add_two_view_geometries_many(
+            (image_ids[a], image_ids[b], m, F, UNCALIBRATED) for a, b, m, F in verified)
+
+    print(f"✓ Imported {len(verified)}/{len(pairs)} verified pairs")
+    return len(verified)
+
+
+def import_learned_features(colmap_path, image_dir, database_path, pairs=None,
+                            pair_strategy='exhaustive', num_neighbors=10,
+                            superpoint_config=None, superglue_config=None,
+                            max_size=1024, device='auto', batch_size=8, match_batch_size=16,
+                            matcher='superglue', min_nn_inliers=50, store=None):
+    """Write SuperPoint keypoints and SuperGlue matches into a new COLMAP database
+
+    Runs import_learned_keypoints followed by import_learned_matches, so
+    only `mapper` needs to run afterwards.
+    """
+    image_ids = import_learned_keypoints(
+        colmap_path, image_dir, database_path, superpoint_config=superpoint_config,
+        max_size=max_size, device=device, batch_size=batch_size, store=store)
+    import_learned_matches(
+        image_dir, database_path, pairs=pairs, pair_strategy=pair_strategy,
+        num_neighbors=num_neighbors, superpoint_config=superpoint_config,
+        superglue_config=superglue_config, max_size=max_size, device=device,
+        batch_size=batch_size, match_batch_size=match_batch_size, matcher=matcher,
+        min_nn_inliers=min_nn_inliers, store=store)
+    return image_ids
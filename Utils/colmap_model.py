@@ -0,0 +1,338 @@
+import mmap
+import os
+import struct
+
+import numpy as np
+
+# COLMAP camera models: id -> (name, number of parameters)
+CAMERA_MODELS = {
+    0: ('SIMPLE_PINHOLE', 3),
+    1: ('PINHOLE', 4),
+    2: ('SIMPLE_RADIAL', 4),
+    3: ('RADIAL', 5),
+    4: ('OPENCV', 8),
+    5: ('OPENCV_FISHEYE', 8),
+    6: ('FULL_OPENCV', 12),
+    7: ('FOV', 5),
+    8: ('SIMPLE_RADIAL_FISHEYE', 4),
+    9: ('RADIAL_FISHEYE', 5),
+    10: ('THIN_PRISM_FISHEYE', 12),
+    11: ('RAD_TAN_THIN_PRISM_FISHEYE', 16),
+}
+CAMERA_MODEL_IDS = {name: model_id for model_id, (name, _) in CAMERA_MODELS.items()}
+# Models with a single focal length (f, cx, cy, ...); the others start with fx, fy, cx, cy
+_SINGLE_FOCAL = {'SIMPLE_PINHOLE', 'SIMPLE_RADIAL', 'RADIAL', 'SIMPLE_RADIAL_FISHEYE', 'RADIAL_FISHEYE'}
+
+_POINT2D_DTYPE = np.dtype([('xy', '<f8', 2), ('point3D_id', '<i8')])
+_TRACK_DTYPE = np.dtype([('image_id', '<i4'), ('point2D_idx', '<i4')])
+# points3D.bin record: id u64, xyz 3*f64, rgb 3*u8, error f64, track length u64, then the track
+_POINT3D_FIXED = 51
+_POINT3D_LENGTH_AT = 43
+_POINT3D_HEADER_DTYPE = np.dtype([('id', '<u8'), ('xyz', '<f8', 3), ('rgb', 'u1', 3),
+                                  ('error', '<f8'), ('length', '<u8')])
+
+
+def qvec_to_rotmat(qvec):
+    """Rotation matrices from COLMAP (w, x, y, z) quaternions, [..., 4] -> [..., 3, 3]"""
+    q = np.asarray(qvec, np.float64)
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    return np.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y),
+        2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x),
+        2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y),
+    ], axis=-1).reshape(q.shape[:-1] + (3, 3))
+
+
+def _open_map(path):
+    """Read-only memory map of a file"""
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _cameras(ids, model_ids, widths, heights, params):
+    num_params = max([len(p) for p in params] or [0])
+    padded = np.full((len(params), num_params), np.nan)
+    for i, p in enumerate(params):
+        padded[i, :len(p)] = p
+    model_ids = np.asarray(model_ids, np.int32)
+    K = np.zeros((len(params), 3, 3))
+    K[:, 2, 2] = 1
+    for i, (model_id, p) in enumerate(zip(model_ids, params)):
+        if CAMERA_MODELS[model_id][0] in _SINGLE_FOCAL:
+            K[i, 0, 0] = K[i, 1, 1] = p[0]
+            K[i, 0, 2], K[i, 1, 2] = p[1], p[2]
+        else:
+            K[i, 0, 0], K[i, 1, 1], K[i, 0, 2], K[i, 1, 2] = p[:4]
+    return {
+        'ids': np.asarray(ids, np.int64),
+        'model_ids': model_ids,
+        'models': [CAMERA_MODELS[m][0] for m in model_ids],
+        'widths': np.asarray(widths, np.int64),
+        'heights': np.asarray(heights, np.int64),
+        'params': padded,
+        'K': K,
+    }
+
+
+def read_cameras_binary(path):
+    buf = _open_map(path)
+    count = struct.unpack_from('<Q', buf, 0)[0]
+    ids, model_ids, widths, heights, params = [], [], [], [], []
+    pos = 8
+    for _ in range(count):
+        camera_id, model_id, width, height = struct.unpack_from('<iiQQ', buf, pos)
+        n = CAMERA_MODELS[model_id][1]
+        params.append(np.frombuffer(buf, '<f8', n, pos + 24))
+        pos += 24 + 8 * n
+        ids.append(camera_id)
+        model_ids.append(model_id)
+        widths.append(width)
+        heights.append(height)
+    return _cameras(ids, model_ids, widths, heights, params)
+
+
+def read_cameras_text(path):
+    ids, model_ids, widths, heights, params = [], [], [], [], []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            camera_id, model, width, height, *p = line.split()
+            ids.append(int(camera_id))
+            model_ids.append(CAMERA_MODEL_IDS[model])
+            widths.append(int(width))
+            heights.append(int(height))
+            params.append(np.array(p, np.float64))
+    return _cameras(ids, model_ids, widths, heights, params)
+
+
+def _images(ids, qvecs, tvecs, camera_ids, names, points2D):
+    qvec = np.asarray(qvecs, np.float64).reshape(-1, 4)
+    tvec = np.asarray(tvecs, np.float64).reshape(-1, 3)
+    R = qvec_to_rotmat(qvec)
+    points = np.concatenate(points2D) if points2D else np.empty(0, _POINT2D_DTYPE)
+    return {
+        'ids': np.asarray(ids, np.int64),
+        'qvec': qvec,
+        'tvec': tvec,
+        'R': R,
+        'centers': -np.einsum('nji,nj->ni', R, tvec),
+        'camera_ids': np.asarray(camera_ids, np.int64),
+        'names': names,
+        # Observations of image i are points2D_ptr[i]:points2D_ptr[i + 1]
+        'points2D_ptr': np.concatenate([[0], np.cumsum([len(p) for p in points2D])]).astype(np.int64),
+        'xy': np.ascontiguousarray(points['xy']),
+        'point3D_ids': np.ascontiguousarray(points['point3D_id']),  # -1 when not triangulated
+    }
+
+
+def read_images_binary(path):
+    buf = _open_map(path)
+    count = struct.unpack_from('<Q', buf, 0)[0]
+    ids, qvecs, tvecs, camera_ids, names, points2D = [], [], [], [], [], []
+    header = struct.Struct('<I7dI')
+    pos = 8
+    for _ in range(count):
+        image_id, *pose, camera_id = header.unpack_from(buf, pos)
+        pos += header.size
+        end = buf.find(b'\0', pos)
+        names.append(buf[pos:end].decode('utf-8'))
+        pos = end + 1
+        n = struct.unpack_from('<Q', buf, pos)[0]
+        points2D.append(np.frombuffer(buf, _POINT2D_DTYPE, n, pos + 8))
+        pos += 8 + n * _POINT2D_DTYPE.itemsize
+        ids.append(image_id)
+        qvecs.append(pose[:4])
+        tvecs.append(pose[4:])
+        camera_ids.append(camera_id)
+    return _images(ids, qvecs, tvecs, camera_ids, names, points2D)
+
+
+def read_images_text(path):
+    with open(path) as f:
+        # Two lines per image; the second (its 2D points) may be empty
+        lines = [line for line in f if not line.startswith('#')]
+    ids, qvecs, tvecs, camera_ids, names, points2D = [], [], [], [], [], []
+    for header, observations in zip(lines[::2], lines[1::2]):
+        fields = header.split()
+        if not fields:
+            continue
+        ids.append(int(fields[0]))
+        qvecs.append([float(v) for v in fields[1:5]])
+        tvecs.append([float(v) for v in fields[5:8]])
+        camera_ids.append(int(fields[8]))
+        names.append(' '.join(fields[9:]))
+        values = np.array(observations.split(), np.float64).reshape(-1, 3)
+        points = np.empty(len(values), _POINT2D_DTYPE)
+        points['xy'] = values[:, :2]
+        points['point3D_id'] = values[:, 2].astype(np.int64)
+        points2D.append(points)
+    return _images(ids, qvecs, tvecs, camera_ids, names, points2D)
+
+
+def _point3D_offsets(buf, count):
+    """Start of every points3D.bin record
+
+    Records have variable length, so finding them is inherently sequential;
+    this is the only per-point Python step, kept to one table lookup and one
+    addition per record. Only the low byte of each track length is read.
+    """
+    if count == 0:
+        return np.empty(0, np.int64)
+    from itertools import accumulate, repeat
+    step = [_POINT3D_FIXED + 8 * low for low in range(256)]
+    low_bytes = memoryview(buf)[_POINT3D_LENGTH_AT:]
+    return np.fromiter(accumulate(repeat(None, count - 1),
+                                  lambda pos, _: pos + step[low_bytes[pos]],
+                                  initial=8), np.int64, count)
+
+
+def read_points3D_binary(path):
+    buf = _open_map(path)
+    count = struct.unpack_from('<Q', buf, 0)[0]
+    if count == 0:
+        return _points3D(np.empty(0, np.int64), np.empty((0, 3)), np.empty((0, 3), np.uint8),
+                         np.empty(0), np.zeros(1, np.int64), np.empty(0, _TRACK_DTYPE))
+    # The offsets are found from the low byte of each track length only; check them
+    try:
+        offsets = _point3D_offsets(buf, count)
+        header = _point3D_headers(buf, offsets)
+        lengths = header['length'].astype(np.int64)
+        ends = offsets + _POINT3D_FIXED + 8 * lengths
+        valid = ends[-1] == len(buf) and np.array_equal(ends[:-1], offsets[1:])
+    except IndexError:
+        valid = False
+    if not valid:
+        offsets, lengths = _point3D_offsets_slow(buf, count)
+        header = _point3D_headers(buf, offsets)
+
+    # Track element j of a record lies 8 * j bytes after its first element;
+    # int32 positions halve the memory traffic for files below 2 GB
+    index_type = np.int32 if len(buf) < 2**31 else np.int64
+    track_ptr = np.concatenate([[0], np.cumsum(lengths)])
+    index = np.repeat((offsets + _POINT3D_FIXED - 8 * track_ptr[:-1]).astype(index_type), lengths)
+    index += np.arange(0, 8 * track_ptr[-1], 8, dtype=index_type)
+    tracks = _unaligned(buf, '<u8')[index].view(_TRACK_DTYPE)
+    return _points3D(header['id'].astype(np.int64), header['xyz'], header['rgb'],
+                     header['error'], track_ptr, tracks)
+
+
+def _unaligned(buf, dtype):
+    """View of `buf` with an item of `dtype` starting at every byte offset"""
+    dtype = np.dtype(dtype)
+    return np.ndarray((len(buf) - dtype.itemsize + 1,), dtype, buffer=buf, strides=(1,))
+
+
+def _point3D_headers(buf, offsets):
+    """Fixed 51-byte part of each points3D.bin record, gathered into an aligned copy"""
+    return _unaligned(buf, f'V{_POINT3D_FIXED}')[offsets].view(_POINT3D_HEADER_DTYPE)
+
+
+def _point3D_offsets_slow(buf, count):
+    """Offsets and track lengths for tracks longer than 255 observations"""
+    offsets = np.empty(count, np.int64)
+    lengths = np.empty(count, np.int64)
+    pos = 8
+    for k in range(count):
+        offsets[k] = pos
+        lengths[k] = struct.unpack_from('<Q', buf, pos + _POINT3D_LENGTH_AT)[0]
+        pos += _POINT3D_FIXED + 8 * lengths[k]
+    return offsets, lengths
+
+
+def read_points3D_text(path):
+    ids, xyz, rgb, error, lengths, tracks = [], [], [], [], [], []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split()
+            ids.append(int(fields[0]))
+            xyz.append([float(v) for v in fields[1:4]])
+            rgb.append([int(v) for v in fields[4:7]])
+            error.append(float(fields[7]))
+            track = fields[8:]
+            lengths.append(len(track) // 2)
+            tracks.extend(track)
+    elements = np.array(tracks, np.int32).reshape(-1, 2)
+    track = np.empty(len(elements), _TRACK_DTYPE)
+    track['image_id'] = elements[:, 0]
+    track['point2D_idx'] = elements[:, 1]
+    return _points3D(np.array(ids, np.int64), np.array(xyz, np.float64).reshape(-1, 3),
+                     np.array(rgb, np.uint8).reshape(-1, 3), np.array(error, np.float64),
+                     np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64), track)
+
+
+def _points3D(ids, xyz, rgb, error, track_ptr, tracks):
+    return {
+        'ids': ids,
+        'xyz': np.ascontiguousarray(xyz),
+        'rgb': np.ascontiguousarray(rgb),
+        'error': np.ascontiguousarray(error),
+        # Track of point i is track_image_ids/track_point2D_idx[track_ptr[i]:track_ptr[i + 1]]
+        'track_ptr': track_ptr,
+        # Field views of the track records; copying them would double the load time
+        'track_image_ids': tracks['image_id'],
+        'track_point2D_idx': tracks['point2D_idx'],
+    }
+
+
+def detect_model_format(path):
+    """'.bin' or '.txt', whichever complete model is found in `path`"""
+    for ext in ('.bin', '.txt'):
+        if all(os.path.isfile(os.path.join(path, name + ext)) for name in ('cameras', 'images', 'points3D')):
+            return ext
+    raise FileNotFoundError(f"No COLMAP model (cameras/images/points3D .bin or .txt) in {path}")
+
+
+def read_camera_centers(path, ext=None):
+    """(n, 3) camera centres of the images of a sparse model, without reading its points"""
+    ext = ext or detect_model_format(path)
+    reader = read_images_binary if ext == '.bin' else read_images_text
+    return reader(os.path.join(path, 'images' + ext))['centers']
+
+
+def read_model(path, ext=None):
+    """Read a COLMAP sparse model (e.g. sparse/0) into structure-of-arrays dicts
+
+    Returns {'cameras', 'images', 'points3D'}. Cameras hold ids, model
+    ids/names, sizes, NaN-padded params and 3x3 intrinsics `K`. Images
+    hold ids, world-to-camera `qvec`/`tvec`/`R`, camera `centers`,
+    camera ids, names and their 2D points in CSR form (`points2D_ptr`,
+    `xy`, `point3D_ids`). Points hold ids, `xyz`, `rgb`, `error` and
+    their tracks in CSR form (`track_ptr`, `track_image_ids`,
+    `track_point2D_idx`). Binary files are memory-mapped and decoded
+    without per-point Python objects.
+    """
+    ext = ext or detect_model_format(path)
+    if ext == '.bin':
+        readers = (read_cameras_binary, read_images_binary, read_points3D_binary)
+    else:
+        readers = (read_cameras_text, read_images_text, read_points3D_text)
+    return {name: reader(os.path.join(path, name + ext))
+            for name, reader in zip(('cameras', 'images', 'points3D'), readers)}
+
+
+def id_lookup(ids):
+    """Function mapping ids to row indices (-1 for unknown ids), e.g. point3D_ids -> points3D rows"""
+    order = np.argsort(ids)
+    sorted_ids = np.append(ids[order], -1)
+
+    def lookup(query):
+        pos = np.minimum(np.searchsorted(sorted_ids[:-1], query), len(order) - 1)
+        found = (pos >= 0) & (sorted_ids[pos] == query)
+        return np.where(found, order[np.maximum(pos, 0)] if len(order) else -1, -1)
+    return lookup
+
+
+def csr_indices(ptr, rows):
+    """Element indices of the given rows of a CSR layout, concatenated
+
+    E.g. the track elements of some points: csr_indices(points3D['track_ptr'], rows).
+    """
+    rows = np.asarray(rows, np.int64)
+    lengths = ptr[rows + 1] - ptr[rows]
+    index = np.repeat(ptr[rows] - np.cumsum(lengths) + lengths, lengths)
+    index += np.arange(len(index))
+    return index
@@ -0,0 +1,256 @@
+import contextlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+LOGS_DIR = 'logs'
+CONFIG_FILE = 'config.json'
+# Where COLMAP was installed on the original development machine
+_LEGACY_COLMAP_PATH = r'D:\colmap-main\bin\colmap.exe'
+
+# Per-item progress lines of the COLMAP commands; each pattern yields (current, total)
+_PROGRESS_PATTERNS = [
+    re.compile(r'Process(?:ed|ing) file \[(\d+)/(\d+)\]'),    # feature_extractor
+    re.compile(r'Matching image \[(\d+)/(\d+)\]'),             # sequential/vocab_tree/spatial
+    re.compile(r'Undistorting image \[(\d+)/(\d+)\]'),         # image_undistorter
+    re.compile(r'Processing view (\d+) / (\d+)'),              # patch_match_stereo
+    re.compile(r'Fusing image \[(\d+)/(\d+)\]'),               # stereo_fusion
+]
+# exhaustive_matcher works on blocks: "Matching block [i/n, j/n]"
+_BLOCK_PATTERN = re.compile(r'Matching block \[(\d+)/(\d+), (\d+)/(\d+)\]')
+# mapper/image_registrator: "Registering image #42 (17)", 17 being the number registered so far
+_REGISTER_PATTERN = re.compile(r'Registering image #\d+ \((\d+)\)')
+
+# Thread-count option of each command, used to apply a job's thread budget
+THREAD_OPTIONS = {
+    'feature_extractor': '--SiftExtraction.num_threads',
+    'exhaustive_matcher': '--SiftMatching.num_threads',
+    'sequential_matcher': '--SiftMatching.num_threads',
+    'spatial_matcher': '--SiftMatching.num_threads',
+    'vocab_tree_matcher': '--SiftMatching.num_threads',
+    'matches_importer': '--SiftMatching.num_threads',
+    'mapper': '--Mapper.num_threads',
+    'image_registrator': '--Mapper.num_threads',
+    'stereo_fusion': '--StereoFusion.num_threads',
+    'poisson_mesher': '--PoissonMeshing.num_threads',
+}
+
+_session = threading.local()
+_executable = None
+
+
+class CancelledError(Exception):
+    """Raised in a job whose cancellation was requested (see colmap_limits)"""
+
+
+def set_colmap_executable(path):
+    """Use `path` as the COLMAP executable, bypassing the lookup"""
+    global _executable
+    _executable = path
+
+
+def colmap_executable():
+    """Path of the COLMAP executable
+
+    Looked up once, in order: set_colmap_executable(), the COLMAP_PATH
+    environment variable, "colmap_path" in config.json (or the file named
+    by RECONSTRUCT_CONFIG), bin/colmap[.exe] next to the application,
+    `colmap` on the PATH and finally the original D:\colmap-main location.
+    """
+    global _executable
+    if _executable:
+        return _executable
+    candidates = [os.environ.get('COLMAP_PATH')]
+    config_path = os.environ.get('RECONSTRUCT_CONFIG', CONFIG_FILE)
+    try:
+        with open(config_path) as f:
+            candidates.append(json.load(f).get('colmap_path'))
+    except (OSError, ValueError):
+        pass
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    candidates += [os.path.join(app_dir, 'bin', 'colmap.exe' if os.name == 'nt' else 'colmap'),
+                   shutil.which('colmap'), _LEGACY_COLMAP_PATH]
+    for candidate in candidates:
+        if candidate and os.path.isfile(candidate):
+            _executable = candidate
+            return candidate
+    raise FileNotFoundError("COLMAP executable not found: set COLMAP_PATH, add \"colmap_path\" to "
+                            f"{config_path} or put colmap on the PATH")
+
+
+def parse_progress(line):
+    """(current, total) from a COLMAP log line, or None; total is None when unknown"""
+    for pattern in _PROGRESS_PATTERNS:
+        m = pattern.search(line)
+        if m:
+            return int(m.group(1)), int(m.group(2))
+    m = _BLOCK_PATTERN.search(line)
+    if m:
+        i, n, j, n2 = (int(g) for g in m.groups())
+        return (i - 1) * n2 + j, n * n2
+    m = _REGISTER_PATTERN.search(line)
+    if m:
+        return int(m.group(1)), None
+    return None
+
+
+@contextlib.contextmanager
+def colmap_logging(log_dir, progress=None, stage=None):
+    """Log and report the COLMAP commands run by this thread inside the block
+
+    The output of every command goes to `<log_dir>/<stage or command>.log`
+    and its timing is appended to `<log_dir>/timings.jsonl`. `progress`
+    receives {'event': 'colmap_progress', 'stage', 'command', 'current',
+    'total', 'elapsed', 'eta'} for every parsed progress line and
+    {'event': 'colmap_done', 'stage', 'command', 'elapsed', 'log'} at
+    the end of each command.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    with _session_update(log_dir=log_dir, progress=progress, stage=stage):
+        yield
+
+
+@contextlib.contextmanager
+def colmap_limits(num_threads=None, cancel_event=None):
+    """Thread budget and cancellation for the COLMAP commands of this thread
+
+    `num_threads` is passed to every command that has a thread-count
+    option (THREAD_OPTIONS). When `cancel_event` is set, the running
+    command is terminated and CancelledError is raised, as it is by
+    check_cancelled() between stages.
+    """
+    session = getattr(_session, 'current', None) or {}
+    values = {}
+    if num_threads:
+        # Nested budgets (a profile inside a scheduled job) can only shrink
+        values['num_threads'] = min(num_threads, session.get('num_threads') or num_threads)
+    if cancel_event is not None:
+        values['cancel_event'] = cancel_event
+    with _session_update(**values):
+        yield
+
+
+@contextlib.contextmanager
+def colmap_options(command_options):
+    """Extra options for the COLMAP commands of this thread
+
+    `command_options` maps a command name to {option: value}; options the
+    caller passes explicitly take precedence.
+    """
+    session = getattr(_session, 'current', None) or {}
+    merged = {command: dict(opts) for command, opts in (session.get('command_options') or {}).items()}
+    for command, opts in (command_options or {}).items():
+        merged.setdefault(command, {}).update(opts)
+    with _session_update(command_options=merged):
+        yield
+
+
+@contextlib.contextmanager
+def _session_update(**values):
+    previous = getattr(_session, 'current', None)
+    _session.current = {**(previous or {}), **values}
+    try:
+        yield
+    finally:
+        _session.current = previous
+
+
+def thread_budget():
+    """Thread count set by colmap_limits() for this thread, or None"""
+    return (getattr(_session, 'current', None) or {}).get('num_threads')
+
+
+def check_cancelled():
+    session = getattr(_session, 'current', None) or {}
+    if session.get('cancel_event') is not None and session['cancel_event'].is_set():
+        raise CancelledError("Job cancelled")
+
+
+def _emit(session, event):
+    if session.get('progress'):
+        session['progress'](event)
+
+
+def report_progress(command, current, total, elapsed):
+    """Publish a colmap_progress event (also for in-process stages such as utils.cpu_dense)"""
+    session = getattr(_session, 'current', None) or {}
+    eta = None
+    if total and current:
+        eta = round(elapsed / current * max(total - current, 0), 1)
+    _emit(session, {'event': 'colmap_progress', 'stage': session.get('stage'), 'command': command,
+                    'current': current, 'total': total, 'elapsed': round(elapsed, 1), 'eta': eta})
+
+
+def run_colmap(args, total=None):
+    """Run a COLMAP command, streaming its output line by line
+
+    Behaves like subprocess.run(args, check=True) (CalledProcessError on
+    failure), but echoes the output as it comes, parses per-image progress
+    and reports it with an ETA. `total` is the expected number of items
+    for commands that do not print it themselves (mapper, registrator).
+    Outside of colmap_logging() the output is only echoed. The thread
+    budget and cancellation of colmap_limits() and the extra options of
+    colmap_options() apply.
+    """
+    session = getattr(_session, 'current', None) or {}
+    command = os.path.basename(args[1]) if len(args) > 1 else os.path.basename(args[0])
+    extra = dict((session.get('command_options') or {}).get(command, {}))
+    if session.get('num_threads') and command in THREAD_OPTIONS:
+        extra[THREAD_OPTIONS[command]] = session['num_threads']
+    given = {str(a) for a in args}
+    for option, value in extra.items():
+        if option not in given:
+            args = list(args) + [option, str(value)]
+    check_cancelled()
+    cancel_event = session.get('cancel_event')
+    stage = session.get('stage')
+    log_path = None
+    log_file = None
+    if session.get('log_dir'):
+        log_path = os.path.join(session['log_dir'], f"{stage or command}.log")
+        log_file = open(log_path, 'a', encoding='utf-8', errors='replace')
+        log_file.write(f"$ {subprocess.list2cmdline([str(a) for a in args])}\n")
+
+    start = time.time()
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, errors='replace', bufsize=1)
+        if cancel_event is not None:
+            # Output may stall for minutes, so watch the event on the side
+            threading.Thread(target=_terminate_on_cancel, args=(proc, cancel_event), daemon=True).start()
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            if log_file:
+                log_file.write(line)
+            parsed = parse_progress(line)
+            if parsed is None:
+                continue
+            current, line_total = parsed
+            report_progress(command, current, line_total or total, time.time() - start)
+        returncode = proc.wait()
+    finally:
+        if log_file:
+            log_file.close()
+
+    elapsed = round(time.time() - start, 3)
+    if session.get('log_dir'):
+        with open(os.path.join(session['log_dir'], 'timings.jsonl'), 'a') as f:
+            f.write(json.dumps({'stage': stage, 'command': command, 'elapsed': elapsed,
+                                'returncode': returncode}) + '\n')
+    _emit(session, {'event': 'colmap_done', 'stage': stage, 'command': command,
+                    'elapsed': elapsed, 'log': log_path})
+    check_cancelled()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def _terminate_on_cancel(proc, cancel_event):
+    while proc.poll() is None:
+        if cancel_event.wait(0.5):
+            proc.terminate()
+            return
@@ -1,35 +1,185 @@
-import subprocess
 import os
 
-COLMAP_PATH = r'D:\colmap-main\bin\colmap.exe'
+from utils.colmap_runner import colmap_executable, run_colmap
 
-def run_colmap_sparse(image_dir, output_dir, database_path):
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Feature extraction
-    print("Running COLMAP feature extraction...")
-    subprocess.run([
-        COLMAP_PATH, 'feature_extractor',
+# Learned-feature options that affect extraction (the rest only affect matching)
+EXTRACT_OPTIONS = ('superpoint_config', 'max_size', 'device', 'batch_size', 'store')
+
+def _colmap_matcher_args(strategy, database_path, num_neighbors, vocab_tree_path):
+    """Command line for COLMAP's built-in matcher implementing `strategy`"""
+    if strategy == 'exhaustive':
+        return ['exhaustive_matcher', '--database_path', database_path]
+    if strategy == 'sequential':
+        return ['sequential_matcher', '--database_path', database_path,
+                '--SequentialMatching.overlap', str(num_neighbors)]
+    if strategy == 'spatial':
+        return ['spatial_matcher', '--database_path', database_path,
+                '--SpatialMatching.max_num_neighbors', str(num_neighbors)]
+    if strategy == 'vocab_tree':
+        if not vocab_tree_path:
+            raise ValueError("vocab_tree matching needs a vocabulary tree file")
+        return ['vocab_tree_matcher', '--database_path', database_path,
+                '--VocabTreeMatching.vocab_tree_path', vocab_tree_path,
+                '--VocabTreeMatching.num_images', str(num_neighbors)]
+    return None
+
+def _retrieval_pairs_file(image_dir, database_path, num_neighbors, store=None):
+    """Plan pairs from pooled SuperPoint descriptors and write them next to the database"""
+    from utils.colmap_import import list_images
+    from utils.feature_extraction import extract_superpoint_features_batch
+    from utils.pair_planner import plan_pairs, write_pairs
+
+    names = list_images(image_dir)
+    features = extract_superpoint_features_batch(
+        [os.path.join(image_dir, n) for n in names], store=store)
+    pairs = plan_pairs(names, 'retrieval', num_neighbors, dict(zip(names, features)))
+    pairs_path = os.path.join(os.path.dirname(os.path.abspath(database_path)), 'pairs.txt')
+    write_pairs(pairs, pairs_path)
+    return pairs_path, len(pairs)
+
+def run_feature_extraction(image_dir, database_path, feature_type='sift', image_names=None,
+                           **learned_options):
+    """Create the database and fill it with SIFT or SuperPoint features
+
+    A full extraction always starts from a new database: COLMAP skips
+    images already present, so changed or removed images would otherwise
+    keep their old features. With `image_names`, only those images are
+    added to an existing database.
+    """
+    if image_names is not None:
+        return _add_images(image_dir, database_path, feature_type, image_names, **learned_options)
+    if feature_type == 'superpoint':
+        from utils.colmap_import import import_learned_keypoints
+        print("Importing SuperPoint features...")
+        import_learned_keypoints(colmap_executable(), image_dir, database_path, **learned_options)
+        print("✓ SuperPoint feature import completed")
+    elif feature_type == 'sift':
+        if os.path.exists(database_path):
+            os.remove(database_path)
+        print("Running COLMAP feature extraction...")
+        run_colmap([
+            colmap_executable(), 'feature_extractor',
+            '--database_path', database_path,
+            '--image_path', image_dir
+        ])
+        print("✓ Feature extraction completed")
+    else:
+        raise ValueError(f"Unknown feature type: {feature_type}")
+
+def _add_images(image_dir, database_path, feature_type, image_names, **learned_options):
+    if feature_type == 'superpoint':
+        from utils.colmap_import import add_learned_keypoints
+        add_learned_keypoints(image_dir, database_path, image_names, **learned_options)
+        return
+    list_path = os.path.join(os.path.dirname(os.path.abspath(database_path)), 'new_images.txt')
+    with open(list_path, 'w') as f:
+        f.write('\n'.join(image_names) + '\n')
+    print(f"Running COLMAP feature extraction on {len(image_names)} new images...")
+    run_colmap([
+        colmap_executable(), 'feature_extractor',
         '--database_path', database_path,
-        '--image_path', image_dir
-    ], check=True)
+        '--image_path', image_dir,
+        '--image_list_path', list_path
+    ])
     print("✓ Feature extraction completed")
-    
-    # Exhaustive matcher
-    print("Running COLMAP exhaustive matching...")
-    subprocess.run([
-        COLMAP_PATH, 'exhaustive_matcher',
-        '--database_path', database_path
-    ], check=True)
-    print("✓ Exhaustive matching completed")
-    
-    # Mapper
+
+def run_pairs_matching(database_path, pairs_path):
+    """Match exactly the pairs listed in `pairs_path`, keeping existing matches"""
+    run_colmap([
+        colmap_executable(), 'matches_importer',
+        '--database_path', database_path,
+        '--match_list_path', pairs_path,
+        '--match_type', 'pairs'
+    ])
+
+def run_matching(image_dir, database_path, feature_type='sift', pair_strategy='exhaustive',
+                 num_neighbors=10, vocab_tree_path=None, **learned_options):
+    """Match the images of the database, replacing any previous matches"""
+    if feature_type == 'superpoint':
+        from utils.colmap_import import import_learned_matches
+        print("Importing SuperGlue matches...")
+        import_learned_matches(image_dir, database_path, pair_strategy=pair_strategy,
+                               num_neighbors=num_neighbors, **learned_options)
+        print("✓ Learned match import completed")
+        return
+    if feature_type != 'sift':
+        raise ValueError(f"Unknown feature type: {feature_type}")
+
+    # COLMAP skips pairs that are already matched, so start from scratch
+    from utils.colmap_database import COLMAPDatabase
+    with COLMAPDatabase(database_path) as db:
+        db.clear_matches()
+
+    matcher_args = _colmap_matcher_args(pair_strategy, database_path, num_neighbors, vocab_tree_path)
+    if matcher_args is not None:
+        print(f"Running COLMAP {pair_strategy} matching...")
+        run_colmap([colmap_executable()] + matcher_args)
+        print(f"✓ {pair_strategy.capitalize()} matching completed")
+    elif pair_strategy == 'retrieval':
+        print("Selecting image pairs by SuperPoint retrieval...")
+        pairs_path, num_pairs = _retrieval_pairs_file(
+            image_dir, database_path, num_neighbors, learned_options.get('store'))
+        print(f"Running COLMAP matching on {num_pairs} retrieved pairs...")
+        run_pairs_matching(database_path, pairs_path)
+        print("✓ Retrieval matching completed")
+    else:
+        raise ValueError(f"Unknown pair selection strategy: {pair_strategy}")
+
+def run_mapper(image_dir, database_path, output_dir):
+    """Incremental mapping into `output_dir` (models are written to 0/, 1/, ...)"""
+    os.makedirs(output_dir, exist_ok=True)
     print("Running COLMAP mapping...")
-    subprocess.run([
-        COLMAP_PATH, 'mapper',
+    run_colmap([
+        colmap_executable(), 'mapper',
         '--database_path', database_path,
         '--image_path', image_dir,
         '--output_path', output_dir
-    ], check=True)
+    ], total=len(os.listdir(image_dir)))
     print("✓ Mapping completed")
 
+def run_image_registrator(database_path, input_path, output_path):
+    """Register images that are in the database but not yet in the model"""
+    os.makedirs(output_path, exist_ok=True)
+    print("Running COLMAP image registration...")
+    run_colmap([
+        colmap_executable(), 'image_registrator',
+        '--database_path', database_path,
+        '--input_path', input_path,
+        '--output_path', output_path
+    ])
+    print("✓ Image registration completed")
+
+def run_bundle_adjuster(input_path, output_path):
+    os.makedirs(output_path, exist_ok=True)
+    print("Running COLMAP bundle adjustment...")
+    run_colmap([
+        colmap_executable(), 'bundle_adjuster',
+        '--input_path', input_path,
+        '--output_path', output_path
+    ])
+    print("✓ Bundle adjustment completed")
+
+def run_colmap_sparse(image_dir, output_dir, database_path, feature_type='sift',
+                      pair_strategy='exhaustive', num_neighbors=10, vocab_tree_path=None,
+                      **learned_options):
+    """Run sparse reconstruction
+
+    feature_type='sift' uses COLMAP's own feature extraction and matching.
+    feature_type='superpoint' imports SuperPoint features and SuperGlue
+    matches into the database instead (see utils.colmap_import), so only
+    the mapper is run by COLMAP.
+
+    pair_strategy selects which image pairs are matched (see
+    utils.pair_planner): 'exhaustive', 'sequential', 'retrieval', and for
+    SIFT also COLMAP's 'vocab_tree' and 'spatial' matchers. num_neighbors
+    is the k of the sequential/retrieval/vocab-tree/spatial strategies.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    
+    extract_options = {}
+    if feature_type == 'superpoint':
+        extract_options = {k: v for k, v in learned_options.items() if k in EXTRACT_OPTIONS}
+    run_feature_extraction(image_dir, database_path, feature_type, **extract_options)
+    run_matching(image_dir, database_path, feature_type, pair_strategy, num_neighbors,
+                 vocab_tree_path, **learned_options)
+    run_mapper(image_dir, database_path, output_dir)
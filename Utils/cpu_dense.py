@@ -0,0 +1,276 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from utils.colmap_model import csr_indices, id_lookup, read_model
+from utils.colmap_runner import check_cancelled, report_progress
+from utils.ply_io import write_ply
+
+DEFAULT_CPU_DENSE_OPTIONS = {
+    'max_image_size': 2000,
+    'window_radius': 5,    # SGBM block size is 2 * (window_radius // 2) + 1
+    'num_neighbors': 2,    # stereo partners per reference view
+    'min_views': 2,        # reference views that must see a voxel for it to be kept
+    'voxel_pixels': 2.0,   # fusion voxel size, in pixels at the median scene depth
+}
+# A stereo partner must share enough sparse points and have a usable baseline
+MIN_COVISIBLE = 30
+MIN_BASELINE_RATIO = 0.02
+MAX_BASELINE_RATIO = 0.6
+MAX_DISPARITIES = 384
+_KEY_OFFSET = 1 << 20
+
+
+def _read_model(model_dir):
+    """Images, sparse points and co-visibility of an undistorted COLMAP model"""
+    model = read_model(model_dir)
+    cameras, points = model['cameras'], model['points3D']
+    for name in cameras['models']:
+        if name not in ('SIMPLE_PINHOLE', 'PINHOLE'):
+            raise ValueError(f"Expected an undistorted model, got {name} cameras")
+    K = dict(zip(cameras['ids'].tolist(), cameras['K']))
+    model_images = model['images']
+    image_ids = model_images['ids'].tolist()
+    images = {image_id: {'name': name, 'R': R, 't': t, 'K': K[camera_id]}
+              for image_id, name, R, t, camera_id in zip(image_ids, model_images['names'], model_images['R'],
+                                                         model_images['tvec'], model_images['camera_ids'].tolist())}
+
+    rows = id_lookup(points['ids'])(model_images['point3D_ids'])
+    ptr = model_images['points2D_ptr']
+    image_points = {}
+    covisible = {}
+    for image_id, start, end in zip(image_ids, ptr[:-1], ptr[1:]):
+        seen = np.unique(rows[start:end][rows[start:end] >= 0])
+        image_points[image_id] = seen
+        # Images observing the same points, from the tracks of those points
+        others, counts = np.unique(points['track_image_ids'][csr_indices(points['track_ptr'], seen)],
+                                   return_counts=True)
+        for other, count in zip(others.tolist(), counts.tolist()):
+            if other > image_id:
+                covisible[(image_id, other)] = count
+    return images, points['xyz'], image_points, covisible
+
+
+def _depth_stats(images, xyz, image_points):
+    """(5th percentile, median, 95th percentile) depth of the sparse points of every image"""
+    stats = {}
+    for image_id, image in images.items():
+        points = xyz[image_points.get(image_id, [])]
+        if len(points) < MIN_COVISIBLE:
+            continue
+        depth = (points @ image['R'].T + image['t'])[:, 2]
+        depth = depth[depth > 0]
+        if len(depth):
+            stats[image_id] = tuple(np.percentile(depth, [5, 50, 95]))
+    return stats
+
+
+def _stereo_partners(ref, images, covisible, depths, k):
+    center = -images[ref]['R'].T @ images[ref]['t']
+    candidates = []
+    for other, image in images.items():
+        count = covisible.get((min(ref, other), max(ref, other)), 0)
+        if other == ref or count < MIN_COVISIBLE:
+            continue
+        baseline = np.linalg.norm(center + image['R'].T @ image['t'])
+        if MIN_BASELINE_RATIO <= baseline / depths[ref][1] <= MAX_BASELINE_RATIO:
+            candidates.append((count, other))
+    return [other for _, other in sorted(candidates, reverse=True)[:k]]
+
+
+def _load_scaled(path, max_size):
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise FileNotFoundError(f"Image not found: {path}")
+    scale = min(1.0, max_size / max(img.shape[:2]))
+    if scale < 1.0:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img, scale
+
+
+def _scaled_K(K, scale):
+    K = K.copy()
+    K[:2] *= scale
+    return K
+
+
+def _stereo_points(ref_img, ref, other_img, other, depth_range, block):
+    """World points, normals and colors of `ref` from SGBM against `other`"""
+    h, w = ref_img.shape[:2]
+    R = other['R'] @ ref['R'].T
+    T = other['t'] - R @ ref['t']
+    R1, R2, P1, P2, _, _, _ = cv2.stereoRectify(ref['K'], None, other['K'], None, (w, h), R, T, alpha=0)
+    maps0 = cv2.initUndistortRectifyMap(ref['K'], None, R1, P1, (w, h), cv2.CV_32FC1)
+    maps1 = cv2.initUndistortRectifyMap(other['K'], None, R2, P2, (w, h), cv2.CV_32FC1)
+    rect0 = cv2.remap(ref_img, *maps0, cv2.INTER_LINEAR)
+    rect1 = cv2.remap(other_img, *maps1, cv2.INTER_LINEAR)
+
+    # SGBM wants the partner to the right: transpose vertical pairs, mirror reversed ones
+    vertical = abs(P2[1, 3]) > abs(P2[0, 3])
+    shift = P2[1, 3] if vertical else P2[0, 3]
+    flip = shift > 0
+    f = P1[0, 0]
+    baseline = abs(shift) / f
+    gray0 = cv2.cvtColor(rect0, cv2.COLOR_BGR2GRAY)
+    gray1 = cv2.cvtColor(rect1, cv2.COLOR_BGR2GRAY)
+    if vertical:
+        gray0, gray1 = gray0.T, gray1.T
+    if flip:
+        gray0, gray1 = gray0[:, ::-1], gray1[:, ::-1]
+
+    z_near, _, z_far = depth_range
+    min_disp = max(0, int(np.floor(f * baseline / (z_far * 1.5))))
+    max_disp = f * baseline / (z_near * 0.7)
+    num_disp = int(np.clip(np.ceil((max_disp - min_disp) / 16) * 16, 16, MAX_DISPARITIES))
+    matcher = cv2.StereoSGBM_create(
+        minDisparity=min_disp, numDisparities=num_disp, blockSize=block,
+        P1=8 * block * block, P2=32 * block * block, disp12MaxDiff=1, uniquenessRatio=10,
+        speckleWindowSize=100, speckleRange=2, mode=cv2.STEREO_SGBM_MODE_SGBM_3WAY)
+    disp = matcher.compute(np.ascontiguousarray(gray0), np.ascontiguousarray(gray1)).astype(np.float32) / 16
+    if flip:
+        disp = disp[:, ::-1]
+    if vertical:
+        disp = disp.T
+
+    valid = (disp >= max(min_disp, 1e-3)) & (disp > 0)
+    depth = np.where(valid, f * baseline / np.maximum(disp, 1e-6), 0)
+    valid &= (depth > z_near * 0.5) & (depth < z_far * 2)
+    v, u = np.mgrid[0:h, 0:w].astype(np.float32)
+    points = np.dstack([(u - P1[0, 2]) * depth / f, (v - P1[1, 2]) * depth / f, depth])
+
+    # Normals from the depth map grid, facing the camera
+    normals = np.cross(points[:-1, 1:] - points[:-1, :-1], points[1:, :-1] - points[:-1, :-1])
+    valid = valid[:-1, :-1] & valid[1:, :-1] & valid[:-1, 1:]
+    norm = np.linalg.norm(normals, axis=2)
+    valid &= norm > 0
+    points = points[:-1, :-1][valid]
+    normals = normals[valid] / norm[valid][:, None]
+    normals[np.sum(normals * points, axis=1) > 0] *= -1
+    colors = rect0[:-1, :-1][valid][:, ::-1]
+
+    # Rectified camera -> reference camera -> world
+    to_world = ref['R'].T @ R1.T
+    xyz = points @ to_world.T - ref['R'].T @ ref['t']
+    return xyz, normals @ to_world.T, colors
+
+
+def _voxel_keys(xyz, voxel_size):
+    ijk = np.floor(xyz / voxel_size).astype(np.int64) + _KEY_OFFSET
+    ijk = np.clip(ijk, 0, 2 * _KEY_OFFSET - 1)
+    return (ijk[:, 0] << 42) | (ijk[:, 1] << 21) | ijk[:, 2]
+
+
+def _group_sum(inverse, n, values):
+    return np.stack([np.bincount(inverse, weights=values[:, c], minlength=n)
+                     for c in range(values.shape[1])], axis=1)
+
+
+class _VoxelFusion:
+    """Streaming voxel-grid fusion of the per-view point sets
+
+    Every voxel keeps the sums of the positions, normals and colors that
+    fell in it and the number of reference views that saw it, so the
+    memory is bounded by the number of occupied voxels, not of points.
+    """
+
+    def __init__(self, voxel_size):
+        self.voxel_size = voxel_size
+        self.keys = np.empty(0, np.int64)
+        self.sums = np.empty((0, 9))
+        self.counts = np.empty(0)
+        self.views = np.empty(0)
+        self._pending = []
+
+    def add_view(self, xyz, normals, colors):
+        keys = _voxel_keys(xyz, self.voxel_size)
+        unique, inverse = np.unique(keys, return_inverse=True)
+        values = np.hstack([xyz, normals, colors.astype(np.float64)])
+        self._pending.append((unique, _group_sum(inverse, len(unique), values),
+                              np.bincount(inverse, minlength=len(unique)).astype(np.float64),
+                              np.ones(len(unique))))
+
+    def merge(self):
+        if not self._pending:
+            return
+        parts = [(self.keys, self.sums, self.counts, self.views)] + self._pending
+        self._pending = []
+        keys = np.concatenate([p[0] for p in parts])
+        unique, inverse = np.unique(keys, return_inverse=True)
+        n = len(unique)
+        self.sums = _group_sum(inverse, n, np.concatenate([p[1] for p in parts]))
+        self.counts = np.bincount(inverse, weights=np.concatenate([p[2] for p in parts]), minlength=n)
+        self.views = np.bincount(inverse, weights=np.concatenate([p[3] for p in parts]), minlength=n)
+        self.keys = unique
+
+    def result(self, min_views):
+        self.merge()
+        keep = self.views >= min_views
+        sums, counts = self.sums[keep], self.counts[keep][:, None]
+        xyz = (sums[:, :3] / counts).astype(np.float32)
+        normals = sums[:, 3:6]
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+        colors = np.clip(np.round(sums[:, 6:] / counts), 0, 255).astype(np.uint8)
+        return xyz, normals.astype(np.float32), colors
+
+
+def run_cpu_dense(dense_dir, options=None, num_workers=None):
+    """Dense point cloud without CUDA, written to `<dense_dir>/fused.ply`
+
+    Works on the output of `colmap image_undistorter`. Every registered
+    image is a reference view: it is rectified against its `num_neighbors`
+    best stereo partners (most shared sparse points, baseline within
+    2-60% of the scene depth), matched with OpenCV's semi-global block
+    matching, and the depth maps are back-projected with normals and
+    colors. The points of all views are fused on a voxel grid and voxels
+    seen by fewer than `min_views` reference views are dropped. Returns
+    the number of fused points.
+    """
+    options = {**DEFAULT_CPU_DENSE_OPTIONS, **(options or {})}
+    num_workers = num_workers or os.cpu_count() or 1
+    images, xyz, image_points, covisible = _read_model(os.path.join(dense_dir, 'sparse'))
+    depths = _depth_stats(images, xyz, image_points)
+    refs = [image_id for image_id in sorted(images) if image_id in depths]
+    if not refs:
+        raise RuntimeError("No image has enough sparse points for CPU dense reconstruction")
+
+    # Fusion voxel: `voxel_pixels` pixels at the median depth and working resolution
+    scale = min(1.0, options['max_image_size'] / max(2 * images[refs[0]]['K'][0, 2],
+                                                       2 * images[refs[0]]['K'][1, 2]))
+    focal = np.median([images[i]['K'][0, 0] for i in refs]) * scale
+    voxel_size = options['voxel_pixels'] * np.median([depths[i][1] for i in refs]) / focal
+    fusion = _VoxelFusion(voxel_size)
+    block = 2 * (options['window_radius'] // 2) + 1
+    image_dir = os.path.join(dense_dir, 'images')
+
+    def process(ref):
+        ref_img, ref_scale = _load_scaled(os.path.join(image_dir, images[ref]['name']), options['max_image_size'])
+        ref_view = {**images[ref], 'K': _scaled_K(images[ref]['K'], ref_scale)}
+        results = []
+        for other in _stereo_partners(ref, images, covisible, depths, options['num_neighbors']):
+            other_img, other_scale = _load_scaled(os.path.join(image_dir, images[other]['name']),
+                                                  options['max_image_size'])
+            other_view = {**images[other], 'K': _scaled_K(images[other]['K'], other_scale)}
+            results.append(_stereo_points(ref_img, ref_view, other_img, other_view, depths[ref], block))
+        return results
+
+    start = time.time()
+    done = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for batch_start in range(0, len(refs), num_workers):
+            check_cancelled()
+            for results in pool.map(process, refs[batch_start:batch_start + num_workers]):
+                if results:
+                    fusion.add_view(*(np.concatenate(parts) for parts in zip(*results)))
+                done += 1
+                report_progress('cpu_stereo', done, len(refs), time.time() - start)
+            fusion.merge()
+
+    points, normals, colors = fusion.result(options['min_views'])
+    if not len(points):
+        raise RuntimeError("CPU dense reconstruction produced no points")
+    write_ply(os.path.join(dense_dir, 'fused.ply'), points, normals, colors)
+    print(f"✓ CPU dense reconstruction completed: {len(points)} points")
+    return len(points)
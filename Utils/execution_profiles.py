@@ -0,0 +1,127 @@
+import math
+import os
+import shutil
+import subprocess
+
+# Named trade-offs between speed and density. max_image_size applies to
+# both SIFT extraction and dense stereo and is further capped by the RAM.
+PROFILES = {
+    'fast': {
+        'max_image_size': 1600,
+        'max_num_features': 4096,
+        'patch_match': {'window_radius': 4, 'num_samples': 10, 'num_iterations': 3},
+    },
+    'balanced': {
+        'max_image_size': 2400,
+        'max_num_features': 8192,
+        'patch_match': {'window_radius': 5, 'num_samples': 15, 'num_iterations': 5},
+    },
+    'quality': {
+        'max_image_size': 4000,
+        'max_num_features': 8192,
+        'patch_match': {'window_radius': 7, 'num_samples': 20, 'num_iterations': 5},
+    },
+}
+DENSE_BACKENDS = ('auto', 'colmap', 'cpu')
+MIN_IMAGE_SIZE = 800
+# Share of the RAM the dense stage may plan for
+MEMORY_FRACTION = 0.5
+# Height/width assumed when turning max_image_size into pixels (4:3 photos)
+ASPECT = 0.75
+
+_cuda = None
+
+
+def physical_memory():
+    """Total physical memory in bytes, or None when it cannot be determined"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+        return status.ullTotalPhys
+    except Exception:
+        return None
+
+
+def has_cuda():
+    """Whether a CUDA device is usable (by nvidia-smi), cached"""
+    global _cuda
+    if _cuda is None:
+        _cuda = False
+        if os.environ.get('CUDA_VISIBLE_DEVICES', None) not in ('', '-1'):
+            smi = shutil.which('nvidia-smi')
+            if smi:
+                try:
+                    out = subprocess.run([smi, '-L'], capture_output=True, text=True, timeout=10)
+                    _cuda = out.returncode == 0 and 'GPU' in out.stdout
+                except (OSError, subprocess.SubprocessError):
+                    pass
+    return _cuda
+
+
+def resolve_dense_backend(backend='auto'):
+    """'colmap' (CUDA patch match stereo) or 'cpu' (utils.cpu_dense)"""
+    if backend not in DENSE_BACKENDS:
+        raise ValueError(f"Unknown dense backend: {backend}")
+    if backend == 'auto':
+        return 'colmap' if has_cuda() else 'cpu'
+    return backend
+
+
+def resolve_profile(name, num_images=None):
+    """Concrete settings of a profile on this machine
+
+    Returns {'num_threads', 'patch_match_options', 'command_options',
+    'max_image_size'}. The dense image size is lowered until the depth maps
+    of `num_images` views fit in MEMORY_FRACTION of the RAM, the thread
+    count is the number of cores, lowered when each SIFT thread's scale
+    space would not fit, and SIFT runs on the CPU without CUDA.
+    """
+    from utils.job_scheduler import EXTRACTION_BYTES_PER_PIXEL, FUSION_BYTES_PER_PIXEL
+
+    if name not in PROFILES:
+        raise ValueError(f"Unknown execution profile: {name}")
+    profile = PROFILES[name]
+    memory = physical_memory()
+    max_image_size = profile['max_image_size']
+    if memory and num_images:
+        budget = memory * MEMORY_FRACTION / (num_images * FUSION_BYTES_PER_PIXEL)
+        fitting = int(math.sqrt(budget / ASPECT)) // 100 * 100
+        max_image_size = max(MIN_IMAGE_SIZE, min(max_image_size, fitting))
+
+    num_threads = os.cpu_count() or 1
+    if memory:
+        per_thread = profile['max_image_size'] ** 2 * ASPECT * EXTRACTION_BYTES_PER_PIXEL
+        num_threads = max(1, min(num_threads, int(memory * MEMORY_FRACTION / per_thread)))
+
+    use_gpu = int(has_cuda())
+    command_options = {
+        'feature_extractor': {
+            '--SiftExtraction.max_image_size': profile['max_image_size'],
+            '--SiftExtraction.max_num_features': profile['max_num_features'],
+            '--SiftExtraction.use_gpu': use_gpu,
+        },
+    }
+    for matcher in ('exhaustive_matcher', 'sequential_matcher', 'spatial_matcher',
+                    'vocab_tree_matcher', 'matches_importer'):
+        command_options[matcher] = {'--SiftMatching.use_gpu': use_gpu}
+    return {
+        'num_threads': num_threads,
+        'max_image_size': max_image_size,
+        'patch_match_options': {'geom_consistency': 'true', 'max_image_size': max_image_size,
+                                **profile['patch_match']},
+        'command_options': command_options,
+    }
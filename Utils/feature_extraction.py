@@ -1,26 +1,40 @@
 import torch
 import numpy as np
 from models.superpoint import SuperPoint
-from utils.image_processing import load_image, resize_image
+from utils.image_processing import load_resized_image, prefetch_images
+from utils.model_registry import get_model, resolve_device
 
-def extract_superpoint_features(image_path, device='auto'):
-    """Extract SuperPoint features from an image"""
+# How images are decoded and resized (see load_resized_image); part of the cache key
+RESIZE_MODE = 'reduced_decode+area'
+
+def _cache_config(config, max_size):
+    """Everything that changes the extracted features, used in the cache key"""
+    return {**SuperPoint.default_config, **(config or {}), 'max_size': max_size, 'resize': RESIZE_MODE}
+
+def extract_superpoint_features(image_path, device='auto', config=None, max_size=1024, store=None):
+    """Extract SuperPoint features from an image
+
+    When a FeatureStore is given, features are looked up by image content
+    and config first and stored after extraction.
+    """
     try:
-        # Auto-detect device
-        if device == 'auto':
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if store is not None:
+            key = store.key(image_path, _cache_config(config, max_size))
+            cached = store.get(key)
+            if cached is not None:
+                return cached
+
+        device = resolve_device(device)
         
-        # Load and preprocess image
-        img = load_image(image_path)
-        img = resize_image(img)
+        # Load and preprocess image exactly as the batch path does, so both fill the cache alike
+        img = load_resized_image(image_path, max_size)
         img = img.astype(np.float32) / 255.0
         
         # Convert to tensor
         img_tensor = torch.from_numpy(img)[None, None].to(device)
         
-        # Load model
-        model = SuperPoint({}).to(device)
-        model.eval()
+        # Fetch the (cached) model
+        model = get_model(SuperPoint, config or {}, device)
         
         # Extract features
         with torch.no_grad():
@@ -30,8 +44,92 @@ def extract_superpoint_features(image_path, device='auto'):
         keypoints = result['keypoints'][0].cpu().numpy()
         descriptors = result['descriptors'][0].cpu().numpy()
         scores = result['scores'][0].cpu().numpy()
+
+        if store is not None:
+            store.put(key, keypoints, descriptors, scores)
         
         return keypoints, descriptors, scores
         
     except Exception as e:
-        raise RuntimeError(f"Failed to extract SuperPoint features: {str(e)}") 
\ No newline at end of file
+        raise RuntimeError(f"Failed to extract SuperPoint features: {str(e)}")
+
+
+def _bucket_shape(shape, granularity):
+    """Round an (h, w) shape up to the bucket grid (a multiple of 8)"""
+    g = max(8, granularity - granularity % 8)
+    return tuple(-(-d // g) * g for d in shape)
+
+
+def _run_batch(model, device, images, shape):
+    """Zero-pad `images` to `shape`, run SuperPoint once and unpack per image"""
+    bh, bw = shape
+    batch = np.zeros((len(images), 1, bh, bw), dtype=np.float32)
+    sizes = []
+    for j, img in enumerate(images):
+        h, w = img.shape[:2]
+        batch[j, 0, :h, :w] = img.astype(np.float32) / 255.0
+        sizes.append((h, w))
+
+    with torch.no_grad():
+        result = model({'image': torch.from_numpy(batch).to(device),
+                        'image_size': sizes})
+
+    return [(result['keypoints'][j].cpu().numpy(),
+             result['descriptors'][j].cpu().numpy(),
+             result['scores'][j].cpu().numpy())
+            for j in range(len(images))]
+
+
+def extract_superpoint_features_batch(image_paths, batch_size=8, device='auto',
+                                      config=None, max_size=1024, granularity=64,
+                                      num_workers=None, prefetch=16, store=None):
+    """Extract SuperPoint features from many images with batched forward passes
+
+    Images are decoded and resized by a prefetching worker pool while the
+    network runs. They are grouped into buckets of similar size, and each
+    bucket is zero-padded and sent through SuperPoint as soon as it holds
+    `batch_size` images. Keypoints falling inside the padding are discarded.
+    Images already present in `store` are not decoded at all. Returns a
+    list of (keypoints, descriptors, scores) tuples in the order of
+    `image_paths`.
+    """
+    try:
+        results = [None] * len(image_paths)
+        keys = [None] * len(image_paths)
+        if store is not None:
+            cache_config = _cache_config(config, max_size)
+            for i, path in enumerate(image_paths):
+                keys[i] = store.key(path, cache_config)
+                results[i] = store.get(keys[i])
+        todo = [i for i, r in enumerate(results) if r is None]
+        if not todo:
+            return results
+
+        device = resolve_device(device)
+        model = get_model(SuperPoint, config or {}, device)
+
+        def flush(shape, bucket):
+            indices, images = zip(*bucket)
+            for i, features in zip(indices, _run_batch(model, device, images, shape)):
+                results[i] = features
+                if store is not None:
+                    store.put(keys[i], *features)
+
+        buckets = {}
+        todo_paths = [image_paths[i] for i in todo]
+        for j, _, img in prefetch_images(todo_paths, max_size, num_workers=num_workers,
+                                         prefetch=prefetch):
+            shape = _bucket_shape(img.shape[:2], granularity)
+            bucket = buckets.setdefault(shape, [])
+            bucket.append((todo[j], img))
+            if len(bucket) >= batch_size:
+                flush(shape, buckets.pop(shape))
+
+        # Flush the partially filled buckets
+        for shape, bucket in buckets.items():
+            flush(shape, bucket)
+
+        return results
+
+    except Exception as e:
+        raise RuntimeError(f"Failed to extract SuperPoint features: {str(e)}")
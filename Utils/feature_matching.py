@@ -1,9 +1,19 @@
+import numpy as np
 import torch
 from models.superglue import SuperGlue
+from utils.model_registry import get_model, resolve_device
 
-def match_superglue(desc0, desc1, kpts0, kpts1, scores0, scores1, device='cuda'):
-    model = SuperGlue({}).to(device)
-    model.eval()
+def match_superglue(desc0, desc1, kpts0, kpts1, scores0, scores1, device='auto', config=None,
+                    shape0=None, shape1=None):
+    """Match one image pair with SuperGlue
+
+    `shape0` / `shape1` are the (height, width) of the images the keypoints
+    were detected in; they are needed to normalize keypoint locations.
+    """
+    if shape0 is None or shape1 is None:
+        raise ValueError("match_superglue needs the image shapes of both images")
+    device = resolve_device(device)
+    model = get_model(SuperGlue, config or {}, device)
     data = {
         'keypoints0': torch.from_numpy(kpts0).unsqueeze(0).to(device),
         'keypoints1': torch.from_numpy(kpts1).unsqueeze(0).to(device),
@@ -11,8 +21,162 @@ def match_superglue(desc0, desc1, kpts0, kpts1, scores0, scores1, device='cuda')
         'descriptors1': torch.from_numpy(desc1).unsqueeze(0).to(device),
         'scores0': torch.from_numpy(scores0).unsqueeze(0).to(device),
         'scores1': torch.from_numpy(scores1).unsqueeze(0).to(device),
+        'image_shape0': tuple(shape0),
+        'image_shape1': tuple(shape1),
     }
     with torch.no_grad():
         result = model(data)
     matches = result['matches0'][0].cpu().numpy()
-    return matches 
\ No newline at end of file
+    return matches
+
+
+def _schedule_pairs(pairs, sizes, batch_size):
+    """Sort pairs by keypoint counts and chunk them into batches of similar size"""
+    order = sorted(pairs, key=lambda p: (max(sizes[p[0]], sizes[p[1]]), min(sizes[p[0]], sizes[p[1]])))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def _pad(arrays, length, axis):
+    """Stack arrays after zero-padding them to `length` along `axis`"""
+    padded = []
+    for a in arrays:
+        widths = [(0, 0)] * a.ndim
+        widths[axis] = (0, length - a.shape[axis])
+        padded.append(np.pad(a, widths))
+    return np.stack(padded)
+
+
+def match_superglue_pairs(features, pairs, shapes, batch_size=16, device='auto', config=None):
+    """Match many image pairs with batched SuperGlue forward passes
+
+    `features` maps image name -> (keypoints, descriptors, scores) as
+    returned by extract_superpoint_features, and `shapes` maps image name
+    -> (height, width) of the image the keypoints were detected in. Pairs
+    with similar keypoint counts are grouped, zero-padded and masked into
+    one forward pass per batch. Yields (name0, name1, matches0, scores0)
+    as each batch finishes, in scheduling order rather than input order.
+    """
+    device = resolve_device(device)
+    model = get_model(SuperGlue, config or {}, device)
+    sizes = {name: len(f[0]) for name, f in features.items()}
+
+    # Pairs where one side has no keypoints cannot match anything
+    empty = [p for p in pairs if sizes[p[0]] == 0 or sizes[p[1]] == 0]
+    for name0, name1 in empty:
+        n = sizes[name0]
+        yield name0, name1, np.full(n, -1, np.int64), np.zeros(n, np.float32)
+    pairs = [p for p in pairs if sizes[p[0]] > 0 and sizes[p[1]] > 0]
+
+    def to_tensor(x):
+        return torch.from_numpy(x).to(device)
+
+    for batch in _schedule_pairs(pairs, sizes, batch_size):
+        m = max(sizes[a] for a, _ in batch)
+        n = max(sizes[b] for _, b in batch)
+        f0 = [features[a] for a, _ in batch]
+        f1 = [features[b] for _, b in batch]
+        data = {
+            'keypoints0': to_tensor(_pad([f[0].astype(np.float32) for f in f0], m, 0)),
+            'keypoints1': to_tensor(_pad([f[0].astype(np.float32) for f in f1], n, 0)),
+            'descriptors0': to_tensor(_pad([f[1].astype(np.float32) for f in f0], m, 1)),
+            'descriptors1': to_tensor(_pad([f[1].astype(np.float32) for f in f1], n, 1)),
+            'scores0': to_tensor(_pad([f[2].astype(np.float32) for f in f0], m, 0)),
+            'scores1': to_tensor(_pad([f[2].astype(np.float32) for f in f1], n, 0)),
+            'image_shape0': to_tensor(np.array([shapes[a] for a, _ in batch], np.float32)),
+            'image_shape1': to_tensor(np.array([shapes[b] for _, b in batch], np.float32)),
+            'mask0': to_tensor(np.arange(m)[None] < np.array([sizes[a] for a, _ in batch])[:, None]),
+            'mask1': to_tensor(np.arange(n)[None] < np.array([sizes[b] for _, b in batch])[:, None]),
+        }
+        with torch.no_grad():
+            result = model(data)
+        matches = result['matches0'].cpu().numpy()
+        scores = result['matching_scores0'].cpu().numpy()
+        for j, (name0, name1) in enumerate(batch):
+            k = sizes[name0]
+            yield name0, name1, matches[j, :k], scores[j, :k]
+
+
+def match_mutual_nn(desc0, desc1, ratio=0.8, min_score=0.0, block_size=1024):
+    """Mutual nearest-neighbor matching with Lowe's ratio test
+
+    `desc0` (D x N) and `desc1` (D x M) are L2-normalized SuperPoint
+    descriptors. Similarities are computed `block_size` rows at a time, so
+    the full N x M matrix is never held in memory. Returns the same keys as
+    SuperGlue.forward, as numpy arrays without the batch dimension.
+    """
+    desc0 = np.asarray(desc0, np.float32)
+    desc1 = np.asarray(desc1, np.float32)
+    n, m = desc0.shape[1], desc1.shape[1]
+    matches0 = np.full(n, -1, np.int64)
+    matches1 = np.full(m, -1, np.int64)
+    scores0 = np.zeros(n, np.float32)
+    scores1 = np.zeros(m, np.float32)
+    if n == 0 or m == 0:
+        return {'matches0': matches0, 'matches1': matches1,
+                'matching_scores0': scores0, 'matching_scores1': scores1}
+
+    best0 = np.empty(n, np.int64)
+    sim0 = np.empty(n, np.float32)
+    passes_ratio = np.ones(n, bool)
+    best1 = np.zeros(m, np.int64)
+    sim1 = np.full(m, -np.inf, np.float32)
+    for start in range(0, n, block_size):
+        sim = desc0[:, start:start + block_size].T @ desc1  # block x M
+        rows = np.arange(sim.shape[0])
+        if m > 1:
+            top2 = np.argpartition(-sim, 1, axis=1)[:, :2]
+            s_a, s_b = sim[rows, top2[:, 0]], sim[rows, top2[:, 1]]
+            first = np.where(s_a >= s_b, top2[:, 0], top2[:, 1])
+            s1, s2 = np.maximum(s_a, s_b), np.minimum(s_a, s_b)
+            # Ratio of descriptor distances, with d = sqrt(2 - 2 * similarity)
+            d1 = np.sqrt(np.maximum(2 - 2 * s1, 0))
+            d2 = np.sqrt(np.maximum(2 - 2 * s2, 0))
+            passes_ratio[start:start + len(rows)] = d1 < ratio * d2
+        else:
+            first = np.zeros(len(rows), np.int64)
+            s1 = sim[:, 0]
+        best0[start:start + len(rows)] = first
+        sim0[start:start + len(rows)] = s1
+
+        block_best = sim.argmax(0)
+        block_sim = sim[block_best, np.arange(m)]
+        better = block_sim > sim1
+        best1[better] = block_best[better] + start
+        sim1[better] = block_sim[better]
+
+    mutual = best1[best0] == np.arange(n)
+    valid = mutual & passes_ratio & (sim0 > min_score)
+    idx0 = np.where(valid)[0]
+    matches0[idx0] = best0[idx0]
+    scores0[idx0] = sim0[idx0]
+    matches1[best0[idx0]] = idx0
+    scores1[best0[idx0]] = sim0[idx0]
+    return {'matches0': matches0, 'matches1': matches1,
+            'matching_scores0': scores0, 'matching_scores1': scores1}
+
+
+def match_pairs_with_fallback(features, pairs, shapes, min_inliers=50, count_inliers=None,
+                              ratio=0.8, batch_size=16, device='auto', config=None):
+    """Match pairs with mutual NN first and escalate hard pairs to SuperGlue
+
+    Every pair is matched with match_mutual_nn. Pairs with fewer than
+    `min_inliers` matches (or inliers, when `count_inliers(name0, name1,
+    matches0)` is given, e.g. a RANSAC check) are re-matched with batched
+    SuperGlue. Yields (name0, name1, matches0, scores0) like
+    match_superglue_pairs.
+    """
+    hard = []
+    for name0, name1 in pairs:
+        result = match_mutual_nn(features[name0][1], features[name1][1], ratio)
+        matches0 = result['matches0']
+        if count_inliers is not None:
+            num_inliers = count_inliers(name0, name1, matches0)
+        else:
+            num_inliers = int((matches0 > -1).sum())
+        if num_inliers >= min_inliers:
+            yield name0, name1, matches0, result['matching_scores0']
+        else:
+            hard.append((name0, name1))
+    if hard:
+        print(f"Escalating {len(hard)}/{len(pairs)} pairs to SuperGlue")
+        yield from match_superglue_pairs(features, hard, shapes, batch_size, device, config)
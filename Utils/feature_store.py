@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+
+FEATURE_CACHE_DIR = os.path.join('outputs', '.feature_cache')
+DEFAULT_MAX_BYTES = 4 * 1024**3
+
+_ARRAYS = ('keypoints', 'scores', 'descriptors')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-1 of a file's contents"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FeatureStore:
+    """Persistent cache of SuperPoint features keyed by image content.
+
+    Every entry is a directory holding `keypoints.npy`, `scores.npy` and
+    float16 `descriptors.npy`, named after the hash of the image bytes and
+    the extraction config, so the same photo is only processed once across
+    runs. Entries are read back memory-mapped. The directory mtime serves as
+    the LRU clock; the oldest entries are removed once the store exceeds
+    `max_bytes`.
+    """
+
+    def __init__(self, root=FEATURE_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._approx_bytes = None  # lazily initialised from a directory scan
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, image_path, config):
+        """Cache key for an image under a given SuperPoint/resize config"""
+        config_str = json.dumps(config, sort_keys=True, default=str)
+        h = hashlib.sha1(file_hash(image_path).encode())
+        h.update(config_str.encode())
+        return h.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Return (keypoints, descriptors, scores) or None on a miss"""
+        entry = self._entry_dir(key)
+        try:
+            arrays = {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+                      for name in _ARRAYS}
+            os.utime(entry)  # mark as recently used
+        except (OSError, ValueError):
+            return None
+        return (np.asarray(arrays['keypoints']),
+                arrays['descriptors'].astype(np.float32),
+                np.asarray(arrays['scores']))
+
+    def put(self, key, keypoints, descriptors, scores):
+        entry = self._entry_dir(key)
+        if os.path.isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = entry + '.tmp-' + uuid.uuid4().hex
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'keypoints.npy'), np.ascontiguousarray(keypoints, dtype=np.float32))
+        np.save(os.path.join(tmp, 'scores.npy'), np.ascontiguousarray(scores, dtype=np.float32))
+        np.save(os.path.join(tmp, 'descriptors.npy'), np.ascontiguousarray(descriptors, dtype=np.float16))
+        size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another writer stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        with self._lock:
+            if self._approx_bytes is not None:
+                self._approx_bytes += size
+            over = self._approx_bytes is None or self._approx_bytes > (self.max_bytes or float('inf'))
+        if over:
+            self.evict()
+
+    def _entries(self):
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if '.tmp-' in name:
+                    continue
+                entry = os.path.join(prefix_dir, name)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                    yield os.path.getmtime(entry), size, entry
+                except OSError:
+                    continue
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Remove least recently used entries until the store fits `max_bytes`"""
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+            self._approx_bytes = total
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.makedirs(self.root, exist_ok=True)
+            self._approx_bytes = 0
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_feature_store():
+    """Return the shared on-disk feature store"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = FeatureStore()
+        return _default_store
@@ -1,6 +1,18 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
+_REDUCED_FLAGS = {
+    True: ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+           (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)),
+    False: ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2)),
+}
+_JPEG_EXTENSIONS = ('.jpg', '.jpeg', '.jpe', '.jfif')
+
 def load_image(path, grayscale=True):
     flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
     img = cv2.imread(path, flag)
@@ -13,4 +25,71 @@ def resize_image(img, max_size=1024):
     scale = max_size / max(h, w)
     if scale < 1.0:
         img = cv2.resize(img, (int(w*scale), int(h*scale)))
-    return img 
\ No newline at end of file
+    return img
+
+def resized_shape(shape, max_size=1024):
+    """(height, width) that `resize_image` produces for an image of `shape`"""
+    h, w = shape[:2]
+    scale = max_size / max(h, w)
+    if scale < 1.0:
+        return int(h*scale), int(w*scale)
+    return h, w
+
+def image_size(path):
+    """Read (height, width) from the file header without decoding pixels"""
+    try:
+        from PIL import Image
+        with Image.open(path) as im:
+            w, h = im.size
+        return h, w
+    except Exception:
+        return None
+
+def load_resized_image(path, max_size=1024, grayscale=True, fast_decode=True):
+    """Load and resize an image, decoding JPEGs at reduced resolution when possible
+
+    libjpeg can decode directly at 1/2, 1/4 or 1/8 scale, which is much
+    cheaper than a full decode followed by a resize. The reduced image is
+    resized to exactly the shape `resize_image` would produce.
+    """
+    size = None
+    if fast_decode and path.lower().endswith(_JPEG_EXTENSIONS):
+        size = image_size(path)
+    if size is not None:
+        h, w = size
+        scale = max_size / max(h, w)
+        for factor, flag in _REDUCED_FLAGS[grayscale]:
+            if scale * factor <= 1.0:
+                img = cv2.imread(path, flag)
+                if img is None:
+                    break
+                if (img.shape[0] > img.shape[1]) != (h > w):
+                    h, w = w, h  # EXIF orientation was applied by imread
+                target = (int(w*scale), int(h*scale))
+                if (img.shape[1], img.shape[0]) != target:
+                    img = cv2.resize(img, target, interpolation=cv2.INTER_AREA)
+                return img
+    return resize_image(load_image(path, grayscale), max_size)
+
+def prefetch_images(paths, max_size=1024, grayscale=True, num_workers=None,
+                    prefetch=8, use_processes=False, fast_decode=True):
+    """Decode and resize images in a worker pool, yielding (index, path, image) in order
+
+    At most `prefetch` images are decoded ahead of the consumer, so memory
+    stays bounded and the workers block when the consumer falls behind.
+    """
+    num_workers = num_workers or min(8, os.cpu_count() or 1)
+    prefetch = max(1, prefetch)
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    paths = list(paths)
+    with executor_cls(max_workers=num_workers) as pool:
+        pending = deque()
+        next_index = 0
+        while next_index < len(paths) or pending:
+            while next_index < len(paths) and len(pending) < prefetch:
+                future = pool.submit(load_resized_image, paths[next_index],
+                                     max_size, grayscale, fast_decode)
+                pending.append((next_index, future))
+                next_index += 1
+            index, future = pending.popleft()
+            yield index, paths[index], future.result()
@@ -0,0 +1,81 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.feature_store import file_hash
+
+
+def _link(src, dst, mode):
+    """Hardlink or symlink `src` to `dst`; returns False when a copy is needed"""
+    if mode in ('auto', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass  # other filesystem, or links not supported
+    if mode in ('auto', 'symlink'):
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return True
+        except (OSError, NotImplementedError):
+            pass  # e.g. Windows without symlink privilege
+    return False
+
+
+def _unique_name(name, taken):
+    stem, ext = os.path.splitext(name)
+    i = 1
+    while name in taken:
+        name = f"{stem}_{i}{ext}"
+        i += 1
+    return name
+
+
+def stage_images(image_paths, images_dir, mode='auto', hash_fn=file_hash, num_workers=8,
+                 prune=False):
+    """Populate a per-run image workspace without copying where possible
+
+    Each image is hardlinked into `images_dir`, or symlinked when hardlinks
+    are not possible; only what can be linked neither way is copied, in
+    parallel. Byte-identical duplicates (by content hash) are staged once,
+    and different files sharing a basename get a numbered suffix. Files
+    already in `images_dir` are reused, so a workspace can be extended or
+    restaged cheaply; with `prune`, files not among `image_paths` are
+    removed. Symlinks whose source moved away are removed and reported, so
+    passing the moved file again stages it under its old name. Returns a dict mapping each input path to its staged file name.
+    """
+    os.makedirs(images_dir, exist_ok=True)
+    broken = [name for name in os.listdir(images_dir) if not os.path.exists(os.path.join(images_dir, name))]
+    for name in broken:
+        os.remove(os.path.join(images_dir, name))
+    if broken:
+        print(f"Removed {len(broken)} links to moved images from {images_dir}: {', '.join(sorted(broken))}")
+    existing = {name: hash_fn(os.path.join(images_dir, name)) for name in os.listdir(images_dir)
+                if os.path.isfile(os.path.join(images_dir, name))}
+    by_hash = {digest: name for name, digest in existing.items()}
+    taken = set(existing)
+
+    staged, copies = {}, []
+    for path in image_paths:
+        digest = hash_fn(path)
+        if digest in by_hash:  # already staged (or a duplicate of a staged image)
+            staged[path] = by_hash[digest]
+            continue
+        name = _unique_name(os.path.basename(path), taken)
+        taken.add(name)
+        by_hash[digest] = name
+        staged[path] = name
+        dst = os.path.join(images_dir, name)
+        if mode == 'copy' or not _link(path, dst, mode):
+            copies.append((path, dst))
+
+    if copies:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            list(pool.map(lambda job: shutil.copy2(*job), copies))
+
+    if prune:
+        keep = set(staged.values())
+        for name in existing:
+            if name not in keep:
+                os.remove(os.path.join(images_dir, name))
+    return staged
@@ -0,0 +1,313 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from utils.colmap_runner import CancelledError, colmap_limits
+from utils.execution_profiles import physical_memory
+from utils.image_processing import image_size
+
+JOBS_DB = 'jobs.db'
+
+# Coefficients of the peak memory estimate (see estimate_memory)
+BASE_MEMORY = 512 << 20
+SPARSE_BYTES_PER_IMAGE = 8 << 20
+EXTRACTION_BYTES_PER_PIXEL = 24   # float image and scale space of one SIFT worker
+FUSION_BYTES_PER_PIXEL = 20       # depth, normal and mask maps kept by stereo_fusion
+SIZE_SAMPLE = 32
+# A running job whose process has not refreshed its heartbeat for this long is queued again
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    name TEXT,
+    run_dir TEXT,
+    image_paths TEXT NOT NULL,
+    options TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',  -- queued, running, done, failed or cancelled
+    memory INTEGER NOT NULL,
+    threads INTEGER,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    heartbeat REAL,
+    finished REAL,
+    error TEXT
+)
+'''
+
+
+def estimate_memory(image_paths, options=None, num_threads=1):
+    """Rough peak memory of a reconstruction in bytes
+
+    Driven by the image count and resolution (read from the headers of a
+    sample of the images): the larger of sparse reconstruction, with one
+    SIFT scale space per extraction thread, and stereo fusion, which keeps
+    the depth and normal maps of every view at the patch-match resolution.
+    """
+    from utils.colmap_dense import DEFAULT_PATCH_MATCH_OPTIONS
+
+    options = options or {}
+    n = len(image_paths)
+    step = max(1, n // SIZE_SAMPLE)
+    sizes = [s for s in (image_size(p) for p in image_paths[::step]) if s]
+    pixels = sum(h * w for h, w in sizes) / len(sizes) if sizes else 12e6
+    sparse = num_threads * pixels * EXTRACTION_BYTES_PER_PIXEL + n * SPARSE_BYTES_PER_IMAGE
+    dense = 0
+    if options.get('dense', True):
+        max_size = {**DEFAULT_PATCH_MATCH_OPTIONS,
+                    **(options.get('patch_match_options') or {})}['max_image_size']
+        dense = n * min(pixels, max_size ** 2) * FUSION_BYTES_PER_PIXEL
+    return int(BASE_MEMORY + max(sparse, dense))
+
+
+class JobScheduler:
+    """Persistent queue running several reconstructions at once
+
+    Jobs are kept in a SQLite database, so the queue survives restarts.
+    Several processes (the app, `reconstruct --worker`) may run the same
+    queue: each claims a job atomically and refreshes its heartbeat while
+    running it, and a job whose heartbeat is older than HEARTBEAT_TIMEOUT
+    (its process died) is queued again and resumes at its first stale
+    stage (see utils.checkpoints). Up to `max_jobs` run at
+    the same time, each with a fixed share of `total_threads` passed to
+    COLMAP. A job is only admitted while the memory estimates of the running
+    jobs plus its own stay within `memory_budget` (by default 75% of the
+    physical memory); a job too large for the budget still runs, alone.
+    Queued jobs start by descending priority, then in submission order.
+
+    `progress(job_id, event)` receives the pipeline events of every job and
+    {'event': 'job', 'job_id', 'status', ...} whenever a job changes status.
+    """
+
+    def __init__(self, db_path, max_jobs=3, total_threads=None, memory_budget=None, progress=None):
+        self.db_path = db_path
+        self.max_jobs = max_jobs
+        self.total_threads = total_threads or os.cpu_count() or 1
+        self.threads_per_job = max(1, self.total_threads // max_jobs)
+        if memory_budget is None:
+            total = physical_memory()
+            memory_budget = int(total * 0.75) if total else None
+        self.memory_budget = memory_budget
+        self.progress = progress
+        self._running = {}  # job id -> (thread, cancel event, memory)
+        self._cond = threading.Condition()
+        self._dispatcher = None
+        self._stopping = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(_SCHEMA)
+            # Queues created before heartbeats were recorded
+            if 'heartbeat' not in {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+        self._last_beat = 0.0
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Connection committed on success and always closed"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _update(self, job_id, **fields):
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                         list(fields.values()) + [job_id])
+        if 'status' in fields:
+            self._emit(job_id, {'event': 'job', 'job_id': job_id, **fields})
+
+    def _emit(self, job_id, event):
+        if self.progress is not None:
+            self.progress(job_id, event)
+
+    def submit(self, image_paths, name=None, options=None, priority=0, run_dir=None):
+        """Queue a new reconstruction named `name`, or an extension of `run_dir`"""
+        from utils.pipeline import DEFAULT_OPTIONS, make_run_name
+
+        options = dict(options or {})
+        kind = 'extend' if run_dir else 'reconstruct'
+        if kind == 'reconstruct':
+            # Fix the run name now so a requeued job resumes into the same directory
+            name = make_run_name(name, options.get('timestamp_run_name', DEFAULT_OPTIONS['timestamp_run_name']))
+            options['timestamp_run_name'] = False
+        image_paths = [os.path.abspath(p) for p in image_paths]
+        memory = estimate_memory(image_paths, {**DEFAULT_OPTIONS, **options}, self.threads_per_job)
+        with self._cond:
+            with self._connect() as conn:
+                job_id = conn.execute(
+                    "INSERT INTO jobs (kind, name, run_dir, image_paths, options, priority, memory, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (kind, name, run_dir, json.dumps(image_paths), json.dumps(options, default=str),
+                     priority, memory, time.time())).lastrowid
+            self._emit(job_id, {'event': 'job', 'job_id': job_id, 'status': 'queued', 'memory': memory})
+            self._cond.notify()
+        return job_id
+
+    @contextlib.contextmanager
+    def dispatch_paused(self):
+        """Block in which this process starts no job, e.g. to record a submitted job's id before its first event"""
+        with self._cond:
+            yield
+
+    def cancel(self, job_id):
+        """Drop a queued job, or stop a running one at its next COLMAP command or stage
+
+        Jobs running in another process (e.g. a `reconstruct --worker`) are
+        flagged in the database and stopped by that process.
+        """
+        with self._cond:
+            if job_id in self._running:
+                self._running[job_id][1].set()
+                return
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+            updated = conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? "
+                                   "WHERE id = ? AND status = 'queued'", (time.time(), job_id)).rowcount
+        if updated:
+            self._emit(job_id, {'event': 'job', 'job_id': job_id, 'status': 'cancelled'})
+
+    def set_priority(self, job_id, priority):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET priority = ? WHERE id = ?", (priority, job_id))
+        with self._cond:
+            self._cond.notify()
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def jobs(self, status=None):
+        query = "SELECT * FROM jobs"
+        params = ()
+        if status:
+            query += " WHERE status = ?"
+            params = (status,)
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(query + " ORDER BY id", params)]
+
+    def start(self):
+        """Start running queued jobs, alongside any other process running this queue"""
+        if self._dispatcher is None:
+            self._stopping = False
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+            self._dispatcher.start()
+
+    def stop(self, cancel_running=False):
+        """Stop admitting jobs; running jobs finish unless `cancel_running`"""
+        with self._cond:
+            self._stopping = True
+            if cancel_running:
+                for _, cancel_event, _ in self._running.values():
+                    cancel_event.set()
+            self._cond.notify()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+            self._dispatcher = None
+        for thread, _, _ in list(self._running.values()):
+            thread.join()
+
+    def run_until_empty(self):
+        """Run the queue until no job is queued or running (for headless workers)"""
+        self.start()
+        with self._cond:
+            while self._running or self.jobs('queued'):
+                self._cond.wait(1.0)
+        self.stop()
+
+    def _dispatch_loop(self):
+        # Keeps beating after stop() until the running jobs finish
+        with self._cond:
+            while not self._stopping or self._running:
+                self._beat()
+                if not self._stopping:
+                    self._admit()
+                self._cond.wait(1.0)
+
+    def _beat(self):
+        """Refresh the heartbeat of this process's jobs and requeue the jobs of dead processes (lock held)"""
+        now = time.time()
+        if now - self._last_beat < HEARTBEAT_INTERVAL:
+            return
+        self._last_beat = now
+        with self._connect() as conn:
+            if self._running:
+                conn.execute(f"UPDATE jobs SET heartbeat = ? WHERE id IN ({', '.join('?' * len(self._running))})",
+                             [now, *self._running])
+            stale = [row['id'] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)",
+                (now - HEARTBEAT_TIMEOUT,)) if row['id'] not in self._running]
+            conn.executemany("UPDATE jobs SET status = 'queued', started = NULL, heartbeat = NULL, "
+                             "cancel_requested = 0 WHERE id = ? AND status = 'running'",
+                             [(job_id,) for job_id in stale])
+        for job_id in stale:
+            self._emit(job_id, {'event': 'job', 'job_id': job_id, 'status': 'queued'})
+
+    def _admit(self):
+        """Start queued jobs while job slots and the memory budget allow (lock held)"""
+        with self._connect() as conn:
+            queued = [dict(row) for row in conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, id")]
+            for row in conn.execute("SELECT id FROM jobs WHERE cancel_requested = 1 AND status = 'running'"):
+                if row['id'] in self._running:
+                    self._running[row['id']][1].set()
+        for job in queued:
+            if len(self._running) >= self.max_jobs:
+                return
+            used = sum(memory for _, _, memory in self._running.values())
+            if self.memory_budget and self._running and used + job['memory'] > self.memory_budget:
+                continue  # a smaller job further down may still fit
+            # Another process running this queue may have claimed the job first
+            now = time.time()
+            with self._connect() as conn:
+                claimed = conn.execute(
+                    "UPDATE jobs SET status = 'running', started = ?, heartbeat = ?, threads = ? "
+                    "WHERE id = ? AND status = 'queued'",
+                    (now, now, self.threads_per_job, job['id'])).rowcount
+            if not claimed:
+                continue
+            cancel_event = threading.Event()
+            thread = threading.Thread(target=self._run_job, args=(job, cancel_event), daemon=True)
+            self._running[job['id']] = (thread, cancel_event, job['memory'])
+            self._emit(job['id'], {'event': 'job', 'job_id': job['id'], 'status': 'running',
+                                   'started': now, 'threads': self.threads_per_job})
+            thread.start()
+
+    def _run_job(self, job, cancel_event):
+        from utils.pipeline import extend_run, run_pipeline
+
+        job_id = job['id']
+        image_paths = json.loads(job['image_paths'])
+        options = json.loads(job['options'])
+
+        def progress(event):
+            self._emit(job_id, event)
+
+        try:
+            with colmap_limits(self.threads_per_job, cancel_event):
+                if job['kind'] == 'extend':
+                    run_dir = extend_run(job['run_dir'], image_paths, options, progress)
+                else:
+                    run_dir = run_pipeline(image_paths, job['name'], options, progress)
+            self._update(job_id, status='done', finished=time.time(), run_dir=run_dir)
+        except CancelledError:
+            self._update(job_id, status='cancelled', finished=time.time())
+        except Exception as e:
+            traceback.print_exc()
+            self._update(job_id, status='failed', finished=time.time(), error=str(e))
+        finally:
+            with self._cond:
+                self._running.pop(job_id, None)
+                self._cond.notify_all()
@@ -1,19 +1,24 @@
-import open3d as o3d
 import numpy as np
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def create_simple_mesh_from_pointcloud(pointcloud_path, output_path):
+def create_simple_mesh_from_pointcloud(pointcloud_path, output_path, viewpoints=None):
     """Create a simple mesh from point cloud using Open3D"""
+    import open3d as o3d
+    from utils.normal_estimation import ensure_normals
+    from utils.ply_io import read_point_cloud, to_open3d
+    
     try:
         # Load point cloud
-        pcd = o3d.io.read_point_cloud(pointcloud_path)
+        cloud = read_point_cloud(pointcloud_path)
         
-        if len(pcd.points) == 0:
+        if len(cloud['xyz']) == 0:
             raise ValueError("Point cloud is empty")
         
-        # Estimate normals if not present
-        if not pcd.has_normals():
-            pcd.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
+        # Estimate normals if not present, at a radius scaled to the point spacing
+        ensure_normals(cloud, viewpoints)
+        pcd = to_open3d(cloud)
         
         # Create mesh using Poisson reconstruction
         mesh, densities = o3d.geometry.TriangleMesh.create_from_point_cloud_poisson(pcd, depth=8)
@@ -33,17 +38,199 @@ def create_simple_mesh_from_pointcloud(pointcloud_path, output_path):
 
 def run_colmap_mesher(sparse_dir, dense_dir, mesh_dir):
     """Run COLMAP mesher as fallback"""
-    import subprocess
-    from utils.colmap_sparse import COLMAP_PATH
+    from utils.colmap_runner import colmap_executable, run_colmap
     
     try:
         # Use COLMAP's Poisson mesher
-        subprocess.run([
-            COLMAP_PATH, 'poisson_mesher',
+        run_colmap([
+            colmap_executable(), 'poisson_mesher',
             '--input_path', os.path.join(sparse_dir, '0'),
             '--output_path', os.path.join(mesh_dir, 'mesh.ply')
-        ], check=True)
+        ])
         return True
     except Exception as e:
         print(f"COLMAP mesher failed: {e}")
-        return False 
\ No newline at end of file
+        return False 
+
+DEFAULT_MESH_OPTIONS = {
+    'tile_points': 2_000_000,  # target points per tile (without the overlap)
+    'overlap': 0.1,            # tile margin, as a fraction of the tile size
+    'leaf_spacing': 1.5,       # Poisson octree leaf size, in point spacings
+    'min_depth': 6,
+    'max_depth': 12,
+    'density_quantile': 0.1,   # per tile, vertices below this density quantile are dropped
+    'min_tile_points': 100,    # smaller tiles are merged into a neighbouring tile
+}
+
+
+def _tile_grid(xyz, tile_points):
+    """Tile edges over the two largest axes of the cloud, the third is not split"""
+    extent = xyz.max(axis=0) - xyz.min(axis=0)
+    axes = np.argsort(extent)[::-1][:2]
+    num_tiles = max(1, -(-len(xyz) // tile_points))
+    # Split both axes in proportion to their extent
+    ratio = extent[axes[0]] / max(extent[axes[1]], 1e-12)
+    counts = [min(num_tiles, max(1, int(round(np.sqrt(num_tiles * ratio))))), 0]
+    counts[1] = max(1, -(-num_tiles // counts[0]))
+    # Quantile edges balance the points between tiles
+    edges = [np.quantile(xyz[:, axis], np.linspace(0, 1, count + 1)) for axis, count in zip(axes, counts)]
+    for e in edges:
+        e[0], e[-1] = -np.inf, np.inf
+    return axes, edges
+
+
+def _cell_index(xyz, axes, edges):
+    """Flat index of the grid cell holding each point, row-major over `edges`"""
+    i = np.searchsorted(edges[0][1:-1], xyz[:, axes[0]], side='right')
+    j = np.searchsorted(edges[1][1:-1], xyz[:, axes[1]], side='right')
+    return i * (len(edges[1]) - 1) + j
+
+
+def _merge_cells(cells, shape, min_points):
+    """Tile label of each grid cell, with cells merged until every tile has `min_points`
+
+    The smallest tile is repeatedly merged into its smallest edge neighbour,
+    so sparse cells are meshed with the points next to them instead of
+    being dropped. Labels are consecutive from 0.
+    """
+    labels = np.arange(shape[0] * shape[1])
+    sizes = np.bincount(cells, minlength=len(labels))
+    while True:
+        alive = np.unique(labels)
+        smallest = alive[np.argmin(sizes[alive])]
+        if len(alive) == 1 or sizes[smallest] >= max(min_points, 1):
+            break
+        i, j = np.divmod(np.flatnonzero(labels == smallest), shape[1])
+        neighbours = set()
+        for di, dj in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            ni, nj = i + di, j + dj
+            valid = (ni >= 0) & (ni < shape[0]) & (nj >= 0) & (nj < shape[1])
+            neighbours.update(labels[ni[valid] * shape[1] + nj[valid]].tolist())
+        neighbours.discard(smallest)
+        target = min(neighbours, key=lambda label: sizes[label])
+        labels[labels == smallest] = target
+        sizes[target] += sizes[smallest]
+        sizes[smallest] = 0
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def _poisson_depth(xyz, spacing, options):
+    """Octree depth giving leaves of about `leaf_spacing` point spacings over this tile"""
+    cube = 1.1 * float((xyz.max(axis=0) - xyz.min(axis=0)).max())  # Open3D's default scale
+    depth = int(np.ceil(np.log2(max(cube / (options['leaf_spacing'] * spacing), 1.0))))
+    return int(np.clip(depth, options['min_depth'], options['max_depth']))
+
+
+def _mesh_tile(task):
+    """Poisson mesh of one tile, cropped to the tile's core (run in a worker process)"""
+    import open3d as o3d
+    from utils.ply_io import to_open3d
+
+    cloud, depth, axes, edges, labels, label, density_quantile, num_threads = task
+    pcd = to_open3d(cloud)
+    mesh, densities = o3d.geometry.TriangleMesh.create_from_point_cloud_poisson(
+        pcd, depth=depth, n_threads=num_threads)
+    densities = np.asarray(densities)
+    if len(densities):
+        mesh.remove_vertices_by_mask(densities < np.quantile(densities, density_quantile))
+    vertices = np.asarray(mesh.vertices)
+    triangles = np.asarray(mesh.triangles)
+    colors = np.asarray(mesh.vertex_colors) if mesh.has_vertex_colors() else None
+
+    # Keep the triangles centred in the tile's cells; the overlap only steadies the surface at the seams
+    centroids = vertices[triangles].mean(axis=1)
+    triangles = triangles[labels[_cell_index(centroids, axes, edges)] == label]
+    used, triangles = np.unique(triangles, return_inverse=True)
+    triangles = triangles.reshape(-1, 3)
+    return vertices[used], triangles, colors[used] if colors is not None else None, depth
+
+
+def create_tiled_mesh(pointcloud_path, output_path, options=None, num_workers=None, viewpoints=None):
+    """Poisson mesh of a large point cloud, built tile by tile in parallel
+
+    The cloud is split into about len / `tile_points` tiles over its two
+    largest axes, each grown by `overlap`; tiles with fewer than
+    `min_tile_points` points are merged into a neighbour. Each tile gets its own
+    Poisson depth from its point spacing, so dense areas keep their detail
+    without running the whole scene at that depth. Tiles are meshed in a
+    process pool of `num_workers` (the thread budget of the job or all
+    cores), which share that budget for their Poisson threads, trimmed of their low-density vertices and cropped back to
+    their core before the pieces are merged. Missing normals are estimated
+    on the whole cloud first and oriented towards the nearest of
+    `viewpoints` (camera centres). Returns True on success, like
+    create_simple_mesh_from_pointcloud.
+    """
+    import open3d as o3d
+    from utils.colmap_runner import check_cancelled, report_progress, thread_budget
+    from utils.normal_estimation import ensure_normals
+    from utils.point_cloud_cleaning import estimate_spacing
+    from utils.ply_io import read_point_cloud
+
+    options = {**DEFAULT_MESH_OPTIONS, **(options or {})}
+    cloud = read_point_cloud(pointcloud_path)
+    xyz = cloud['xyz']
+    if len(xyz) == 0:
+        print("Failed to create tiled mesh: point cloud is empty")
+        return False
+    estimated = ensure_normals(cloud, viewpoints, num_workers=num_workers)
+    if estimated:
+        print(f"Estimated {estimated} normals")
+    axes, edges = _tile_grid(xyz, options['tile_points'])
+    shape = (len(edges[0]) - 1, len(edges[1]) - 1)
+    cells = _cell_index(xyz, axes, edges)
+    labels = _merge_cells(cells, shape, options['min_tile_points'])
+    point_labels = labels[cells]
+    num_tiles = labels.max() + 1
+    budget = num_workers or thread_budget() or os.cpu_count() or 1
+    num_workers = min(budget, num_tiles)
+    # Split the budget between the workers; Open3D would otherwise use every core in each of them
+    num_threads = max(1, budget // num_workers)
+
+    tasks = []
+    for label in range(num_tiles):
+        core = point_labels == label
+        inside = np.ones(len(xyz), bool)
+        for axis in axes:
+            # Bounding box of the tile's points grown by a margin relative to its size
+            low, high = xyz[core, axis].min(), xyz[core, axis].max()
+            margin = options['overlap'] * (high - low)
+            inside &= (xyz[:, axis] >= low - margin) & (xyz[:, axis] <= high + margin)
+        tile = {column: values[inside] for column, values in cloud.items()}
+        depth = _poisson_depth(tile['xyz'], estimate_spacing(tile['xyz']) or 1.0, options)
+        tasks.append((tile, depth, axes, edges, labels, label, options['density_quantile'], num_threads))
+
+    print(f"Meshing {len(xyz)} points in {len(tasks)} tiles with {num_workers} workers")
+    parts = []
+    start = time.time()
+    pool = ProcessPoolExecutor(max_workers=num_workers)
+    try:
+        futures = [pool.submit(_mesh_tile, task) for task in tasks]
+        for future in as_completed(futures):
+            check_cancelled()
+            parts.append(future.result())
+            report_progress('poisson_tiles', len(parts), len(tasks), time.time() - start)
+    except BaseException:
+        # Do not wait for the queued tiles of a cancelled or failed job
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    vertices, triangles, colors = [], [], []
+    offset = 0
+    for part_vertices, part_triangles, part_colors, _ in parts:
+        vertices.append(part_vertices)
+        triangles.append(part_triangles + offset)
+        colors.append(part_colors)
+        offset += len(part_vertices)
+    if not offset:
+        print("Failed to create tiled mesh: no triangles")
+        return False
+    mesh = o3d.geometry.TriangleMesh()
+    mesh.vertices = o3d.utility.Vector3dVector(np.concatenate(vertices))
+    mesh.triangles = o3d.utility.Vector3iVector(np.concatenate(triangles).astype(np.int32))
+    if all(c is not None for c in colors):
+        mesh.vertex_colors = o3d.utility.Vector3dVector(np.concatenate(colors))
+    o3d.io.write_triangle_mesh(output_path, mesh)
+    print(f"✓ Tiled mesh: {len(mesh.triangles)} triangles, Poisson depth "
+          f"{min(p[3] for p in parts)}-{max(p[3] for p in parts)}")
+    return True
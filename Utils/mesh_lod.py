@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+LOD_LEVELS = (1.0, 0.25, 0.05, 0.01)
+LOD_DIR = 'lod'
+# Below this many triangles a level is not worth writing
+MIN_LOD_TRIANGLES = 1000
+
+
+def lod_path(mesh_path, level):
+    """File of a level: the mesh itself at 1.0, else lod/<name>_<percent>.ply next to it"""
+    if level >= 1.0:
+        return mesh_path
+    directory, name = os.path.split(mesh_path)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(directory, LOD_DIR, f"{stem}_{level * 100:g}pct{ext}")
+
+
+def _decimate(task):
+    """Quadric edge-collapse decimation of the mesh to one level (run in a worker process)"""
+    import open3d as o3d
+
+    mesh_path, output_path, target = task
+    mesh = o3d.io.read_triangle_mesh(mesh_path)
+    mesh = mesh.simplify_quadric_decimation(target_number_of_triangles=target)
+    mesh.remove_unreferenced_vertices()
+    o3d.io.write_triangle_mesh(output_path, mesh)
+    return len(mesh.triangles)
+
+
+def triangle_count(mesh_path):
+    """Number of faces of a PLY mesh, from its header"""
+    from utils.ply_io import read_ply_header
+
+    for name, count, _ in read_ply_header(mesh_path)['elements']:
+        if name == 'face':
+            return count
+    return 0
+
+
+def generate_lods(mesh_path, levels=LOD_LEVELS, num_workers=None):
+    """Write a level-of-detail pyramid of a mesh and return its levels
+
+    Each level below 1.0 keeps that fraction of the triangles, decimated
+    from the full mesh with quadric edge collapse in a process pool of
+    `num_workers` (the job's thread budget or all cores). Levels under
+    MIN_LOD_TRIANGLES are skipped. Returns [{'level', 'path',
+    'triangles'}] from the finest to the coarsest level, paths being
+    relative to the mesh's directory.
+    """
+    from utils.colmap_runner import thread_budget
+
+    total = triangle_count(mesh_path)
+    directory = os.path.dirname(mesh_path)
+    os.makedirs(os.path.join(directory, LOD_DIR), exist_ok=True)
+    tasks = {}
+    for level in sorted(set(levels), reverse=True):
+        target = int(total * level)
+        if level < 1.0 and target >= MIN_LOD_TRIANGLES:
+            tasks[level] = (mesh_path, lod_path(mesh_path, level), target)
+
+    counts = {1.0: total}
+    if tasks:
+        num_workers = min(num_workers or thread_budget() or os.cpu_count() or 1, len(tasks))
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            counts.update(zip(tasks, pool.map(_decimate, tasks.values())))
+    lods = [{'level': level, 'path': os.path.relpath(lod_path(mesh_path, level), directory),
+             'triangles': counts[level]} for level in sorted(counts, reverse=True)]
+    print("✓ Mesh LOD pyramid: " + ", ".join(f"{lod['level']:g}: {lod['triangles']}" for lod in lods))
+    return lods
+
+
+def select_lod(lods, max_triangles, base_dir=''):
+    """Path of the finest level within `max_triangles` (the coarsest one if none is)"""
+    fitting = [lod for lod in lods if lod['triangles'] <= max_triangles]
+    lod = max(fitting, key=lambda l: l['triangles']) if fitting else min(lods, key=lambda l: l['triangles'])
+    return os.path.join(base_dir, lod['path'])
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def resolve_device(device='auto'):
+    """Resolve 'auto' to cuda when available, otherwise cpu"""
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def _freeze(value):
+    """Turn a (possibly nested) config into something hashable"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _model_nbytes(model):
+    params = sum(p.numel() * p.element_size() for p in model.parameters())
+    buffers = sum(b.numel() * b.element_size() for b in model.buffers())
+    return params + buffers
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded networks.
+
+    Models are keyed by (model class, config, device, dtype) and are built
+    at most once per key. Entries are kept in LRU order; the least recently
+    used ones are evicted once the total weight size exceeds `max_bytes`
+    or when they have been idle for longer than `idle_timeout` seconds.
+    Idle models are dropped on every get() and by a daemon timer armed
+    for the next expiry, so they are also released when the registry is
+    not used again.
+    """
+
+    def __init__(self, max_bytes=None, idle_timeout=None):
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self._models = OrderedDict()  # key -> [model, nbytes, last_used]
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self._timer = None
+
+    def _key(self, model_cls, config, device, dtype):
+        return (model_cls.__module__, model_cls.__qualname__,
+                _freeze(config or {}), str(device), str(dtype))
+
+    def get(self, model_cls, config=None, device='auto', dtype=torch.float32):
+        """Return a warm, eval-mode instance of `model_cls`"""
+        device = resolve_device(device)
+        key = self._key(model_cls, config, device, dtype)
+
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                entry[2] = time.monotonic()
+                self._models.move_to_end(key)
+                self._evict(keep=key)
+                return entry[0]
+            self._evict()
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Build outside the registry lock so different models load in parallel,
+        # while concurrent requests for the same key wait for a single load.
+        with key_lock:
+            with self._lock:
+                entry = self._models.get(key)
+                if entry is not None:
+                    entry[2] = time.monotonic()
+                    return entry[0]
+            model = model_cls(dict(config or {})).to(device=device, dtype=dtype)
+            model.eval()
+            with self._lock:
+                self._models[key] = [model, _model_nbytes(model), time.monotonic()]
+                self._key_locks.pop(key, None)
+                self._evict(keep=key)
+            return model
+
+    def _evict(self, keep=None):
+        now = time.monotonic()
+        victims = []
+        if self.idle_timeout is not None:
+            victims += [k for k, e in self._models.items()
+                        if k != keep and now - e[2] > self.idle_timeout]
+        for key in victims:
+            del self._models[key]
+        if self.max_bytes is not None:
+            while self.total_bytes() > self.max_bytes:
+                victim = next((k for k in self._models if k != keep), None)
+                if victim is None:
+                    break
+                del self._models[victim]
+                victims.append(victim)
+        if victims and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self._schedule_sweep()
+
+    def _schedule_sweep(self):
+        """Arm the timer for the next idle expiry (called with the lock held)"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.idle_timeout is None or not self._models:
+            return
+        oldest = min(e[2] for e in self._models.values())
+        delay = max(0.0, oldest + self.idle_timeout - time.monotonic()) + 0.01
+        self._timer = threading.Timer(delay, self.evict_idle)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def evict_idle(self):
+        """Drop models that exceeded the idle timeout"""
+        with self._lock:
+            self._evict()
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(e[1] for e in self._models.values())
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._schedule_sweep()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._models)
+
+
+_registry = ModelRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+def get_model(model_cls, config=None, device='auto', dtype=torch.float32):
+    """Fetch a model from the process-wide registry"""
+    return _registry.get(model_cls, config, device, dtype)
+
+
+def configure_registry(max_bytes=None, idle_timeout=None):
+    """Set the memory limit (bytes) and idle timeout (seconds) of the registry"""
+    with _registry._lock:
+        _registry.max_bytes = max_bytes
+        _registry.idle_timeout = idle_timeout
+        _registry._evict()
@@ -0,0 +1,104 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_NORMAL_OPTIONS = {
+    'radius_spacings': 5.0,  # neighbourhood radius, in median point spacings
+    'max_nn': 30,
+    'min_nn': 5,             # points with fewer neighbours in the radius use their max_nn nearest
+    'chunk_size': 100_000,
+}
+
+
+def _pca_normals(xyz, centres, neighbours):
+    """Normal of each neighbourhood (rows of indices into xyz, len(xyz) = padding)"""
+    valid = neighbours < len(xyz)
+    # Relative to the query point, so the covariance does not lose precision far from the origin
+    points = xyz[np.where(valid, neighbours, 0)] - centres[:, None]
+    points *= valid[..., None]
+    counts = np.maximum(valid.sum(axis=1), 1)[:, None]
+    mean = points.sum(axis=1) / counts
+    covariance = np.matmul(points.transpose(0, 2, 1), points) / counts[..., None]
+    covariance -= mean[:, :, None] * mean[:, None, :]
+    # Eigenvector of the smallest eigenvalue
+    return np.linalg.eigh(covariance)[1][:, :, 0]
+
+
+def estimate_normals(xyz, spacing=None, options=None, num_workers=None, indices=None):
+    """Unoriented normals by local PCA, with a radius scaled to the cloud
+
+    The neighbourhood radius is `radius_spacings` times the point spacing
+    (by default estimated from a subsample, see
+    utils.point_cloud_cleaning.estimate_spacing), so the result does not
+    depend on the arbitrary scale of the COLMAP model. One KD-tree is
+    shared by `num_workers` threads that each handle `chunk_size` points.
+    With `indices`, only the normals of those points are computed.
+    """
+    from scipy.spatial import cKDTree
+    from utils.colmap_runner import thread_budget
+    from utils.point_cloud_cleaning import estimate_spacing
+
+    options = {**DEFAULT_NORMAL_OPTIONS, **(options or {})}
+    xyz = np.asarray(xyz, np.float64)
+    targets = xyz if indices is None else xyz[indices]
+    if len(xyz) < 3:
+        return np.tile([0.0, 0.0, 1.0], (len(targets), 1))
+    spacing = spacing or estimate_spacing(xyz) or 1.0
+    radius = options['radius_spacings'] * spacing
+    k = min(options['max_nn'], len(xyz))
+    tree = cKDTree(xyz)
+
+    def chunk_normals(start):
+        chunk = targets[start:start + options['chunk_size']]
+        neighbours = tree.query(chunk, k=k, distance_upper_bound=radius)[1].reshape(len(chunk), k)
+        sparse = (neighbours < len(xyz)).sum(axis=1) < options['min_nn']
+        if sparse.any():
+            neighbours[sparse] = tree.query(chunk[sparse], k=k)[1].reshape(-1, k)
+        return _pca_normals(xyz, chunk, neighbours)
+
+    num_workers = num_workers or thread_budget() or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        parts = list(pool.map(chunk_normals, range(0, len(targets), options['chunk_size'])))
+    return np.concatenate(parts) if parts else np.empty((0, 3))
+
+
+def orient_normals(xyz, normals, viewpoints=None):
+    """Flip normals towards the nearest viewpoint (e.g. camera centre), in place
+
+    Without viewpoints they are pointed away from the centroid of the
+    cloud, which suits single objects.
+    """
+    from scipy.spatial import cKDTree
+
+    if viewpoints is not None and len(viewpoints):
+        viewpoints = np.asarray(viewpoints, np.float64)
+        towards = viewpoints[cKDTree(viewpoints).query(xyz, workers=-1)[1]] - xyz
+    else:
+        towards = xyz - xyz.mean(axis=0)
+    normals[np.einsum('ij,ij->i', normals, towards) < 0] *= -1
+    return normals
+
+
+def ensure_normals(cloud, viewpoints=None, options=None, num_workers=None):
+    """Give a {'xyz', 'normals', 'rgb'} cloud oriented normals, in place
+
+    Normals already present (from patch match stereo, the CPU dense backend
+    or the cleaning stage) are kept; only missing or zero ones are
+    estimated and oriented. Returns the number of estimated normals.
+    """
+    xyz = cloud['xyz']
+    normals = cloud.get('normals')
+    if normals is None:
+        missing = np.ones(len(xyz), bool)
+        normals = np.zeros((len(xyz), 3), np.float32)
+    else:
+        missing = ~(np.abs(normals) > 1e-6).any(axis=1)
+    if missing.any():
+        # Neighbourhoods come from the whole cloud, including the points that have normals
+        indices = None if missing.all() else np.flatnonzero(missing)
+        estimated = estimate_normals(xyz, options=options, num_workers=num_workers, indices=indices)
+        normals = normals.copy()
+        normals[missing] = orient_normals(np.asarray(xyz[missing], np.float64), estimated, viewpoints)
+    cloud['normals'] = normals
+    return int(missing.sum())
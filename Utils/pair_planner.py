@@ -0,0 +1,127 @@
+import numpy as np
+
+# Strategies planned here, as an explicit list of image pairs
+NATIVE_STRATEGIES = ('exhaustive', 'sequential', 'retrieval')
+# Strategies delegated to COLMAP's own matchers (SIFT front-end only)
+COLMAP_STRATEGIES = ('vocab_tree', 'spatial')
+STRATEGIES = NATIVE_STRATEGIES + COLMAP_STRATEGIES
+
+DEFAULT_NUM_NEIGHBORS = 10
+
+
+def strategies_for(feature_type):
+    """Pair selection strategies available with a feature type"""
+    return STRATEGIES if feature_type == 'sift' else NATIVE_STRATEGIES
+
+
+def check_strategy(feature_type, strategy):
+    """Raise ValueError unless `strategy` works with `feature_type`, before any work is done"""
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown pair selection strategy: {strategy}")
+    if strategy not in strategies_for(feature_type):
+        raise ValueError(f"'{strategy}' pair selection needs SIFT features; with {feature_type} "
+                         f"use one of {', '.join(strategies_for(feature_type))}")
+
+
+def exhaustive_pairs(names):
+    return [(names[i], names[j]) for i in range(len(names)) for j in range(i + 1, len(names))]
+
+
+def sequential_pairs(names, k=DEFAULT_NUM_NEIGHBORS):
+    """Pair every image with the next `k` images in capture order"""
+    return [(names[i], names[j]) for i in range(len(names))
+            for j in range(i + 1, min(i + 1 + k, len(names)))]
+
+
+def global_descriptor(descriptors, scores=None):
+    """Pool local SuperPoint descriptors (D x N) into one L2-normalized vector"""
+    descriptors = np.asarray(descriptors, np.float32)
+    if descriptors.shape[1] == 0:
+        return np.zeros(descriptors.shape[0], np.float32)
+    weights = np.ones(descriptors.shape[1], np.float32) if scores is None else np.asarray(scores, np.float32)
+    pooled = descriptors @ weights
+    # Power normalization reduces the weight of bursty, repeated structures
+    pooled = np.sign(pooled) * np.sqrt(np.abs(pooled))
+    norm = np.linalg.norm(pooled)
+    return pooled / norm if norm > 0 else pooled
+
+
+def retrieval_pairs(names, global_descriptors, k=DEFAULT_NUM_NEIGHBORS):
+    """Pair every image with its `k` most similar images by global descriptor"""
+    n = len(names)
+    if n < 2:
+        return []
+    k = min(k, n - 1)
+    g = np.stack(global_descriptors).astype(np.float32)
+    sim = g @ g.T
+    np.fill_diagonal(sim, -np.inf)
+    top = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+    pairs = set()
+    for i in range(n):
+        for j in top[i]:
+            pairs.add((min(i, j), max(i, j)))
+    return [(names[i], names[j]) for i, j in sorted(pairs)]
+
+
+def plan_pairs(names, strategy='exhaustive', k=DEFAULT_NUM_NEIGHBORS, features=None):
+    """Return the list of (name0, name1) pairs to match
+
+    `features` maps image name -> (keypoints, descriptors, scores) and is
+    required by the 'retrieval' strategy.
+    """
+    if strategy == 'exhaustive':
+        return exhaustive_pairs(names)
+    if strategy == 'sequential':
+        return sequential_pairs(names, k)
+    if strategy == 'retrieval':
+        if features is None:
+            raise ValueError("Retrieval pair selection needs SuperPoint features")
+        globals_ = [global_descriptor(features[n][1], features[n][2]) for n in names]
+        return retrieval_pairs(names, globals_, k)
+    if strategy in COLMAP_STRATEGIES:
+        raise ValueError(f"'{strategy}' pairs are selected by COLMAP's own matcher")
+    raise ValueError(f"Unknown pair selection strategy: {strategy}")
+
+
+def write_pairs(pairs, path):
+    """Write pairs in the format of `colmap matches_importer --match_type pairs`"""
+    with open(path, 'w') as f:
+        for name0, name1 in pairs:
+            f.write(f"{name0} {name1}\n")
+
+
+def read_pairs(path):
+    with open(path) as f:
+        return [tuple(line.split()) for line in f if line.strip()]
+
+
+def extension_pairs(new_names, old_names, strategy='retrieval', k=DEFAULT_NUM_NEIGHBORS,
+                    features=None):
+    """Pairs for adding `new_names` to a model built from `old_names`
+
+    New images are matched exhaustively among themselves and against the
+    relevant existing images only: all of them ('exhaustive'), the `k`
+    closest in capture order ('sequential') or the `k` most similar by
+    global descriptor ('retrieval', also used for COLMAP's own strategies).
+    """
+    new_names = sorted(new_names)
+    old_names = sorted(old_names)
+    pairs = exhaustive_pairs(new_names)
+    if not old_names:
+        return pairs
+    if strategy == 'exhaustive':
+        return pairs + [(n, o) for n in new_names for o in old_names]
+    if strategy == 'sequential':
+        position = {name: i for i, name in enumerate(sorted(old_names + new_names))}
+        for n in new_names:
+            nearby = sorted(old_names, key=lambda o: abs(position[o] - position[n]))
+            pairs += [(n, o) for o in nearby[:k]]
+        return pairs
+    if features is None:
+        raise ValueError("Retrieval pair selection needs SuperPoint features")
+    old_globals = np.stack([global_descriptor(features[o][1], features[o][2]) for o in old_names])
+    for n in new_names:
+        sim = old_globals @ global_descriptor(features[n][1], features[n][2])
+        top = np.argsort(-sim)[:k]
+        pairs += [(n, old_names[j]) for j in top]
+    return pairs
@@ -0,0 +1,580 @@
+import contextlib
+import datetime
+import json
+import os
+import shutil
+
+from utils.checkpoints import MANIFEST_DIR, StageCheckpoints
+from utils.colmap_runner import LOGS_DIR, check_cancelled, colmap_limits, colmap_logging, colmap_options
+from utils.image_staging import stage_images
+from utils.colmap_sparse import (EXTRACT_OPTIONS, run_feature_extraction, run_matching, run_mapper,
+                                 run_pairs_matching, run_image_registrator, run_bundle_adjuster)
+from utils.colmap_dense import (run_image_undistorter, run_patch_match_stereo, run_stereo_fusion,
+                                write_patch_match_config)
+from utils.execution_profiles import resolve_dense_backend, resolve_profile
+
+OUTPUTS_DIR = 'outputs'
+TOTAL_STEPS = 6
+RUN_INFO = 'run.json'
+CLEANED_PLY = 'cleaned.ply'
+MESHERS = ('tiled', 'simple', 'colmap')
+STAGES = ('extract', 'match', 'map', 'undistort', 'patch_match', 'fuse', 'cpu_dense', 'point_cloud_lod',
+          'clean', 'mesh', 'mesh_lod')
+
+# Options that must stay the same when a run is extended later
+_RUN_INFO_OPTIONS = ('feature_type', 'pair_strategy', 'num_neighbors', 'vocab_tree_path',
+                     'learned_options', 'profile', 'dense_backend', 'patch_match_options',
+                     'cpu_dense_options', 'fusion_min_num_pixels', 'dense', 'point_cloud_lod', 'clean',
+                     'clean_options', 'mesh', 'mesher', 'mesh_options', 'mesh_lod_levels')
+
+DEFAULT_OPTIONS = {
+    'outputs_dir': OUTPUTS_DIR,
+    'staging_mode': 'auto',  # 'auto', 'hardlink', 'symlink' or 'copy', see utils.image_staging
+    'timestamp_run_name': True,
+    'feature_type': 'sift',
+    'pair_strategy': 'exhaustive',
+    'num_neighbors': 10,
+    'vocab_tree_path': None,
+    'learned_options': {},  # SuperPoint/SuperGlue options, see utils.colmap_import
+    'use_feature_cache': True,
+    'profile': None,  # 'fast', 'balanced' or 'quality', see utils.execution_profiles
+    'dense_backend': 'auto',  # 'colmap' (CUDA), 'cpu' (utils.cpu_dense) or 'auto'
+    'patch_match_options': None,  # overrides of DEFAULT_PATCH_MATCH_OPTIONS or the profile
+    'cpu_dense_options': None,  # overrides of DEFAULT_CPU_DENSE_OPTIONS or the profile
+    'fusion_min_num_pixels': 3,
+    'dense': True,
+    'point_cloud_lod': True,  # coarse-to-fine octree of the fused cloud for the viewer
+    'clean': True,  # voxel downsampling and outlier removal before meshing
+    'clean_options': None,  # overrides of DEFAULT_CLEAN_OPTIONS, see utils.point_cloud_cleaning
+    'mesh': True,
+    'mesher': 'tiled',  # 'tiled', 'simple' or 'colmap', see generate_mesh
+    'mesh_options': None,  # overrides of DEFAULT_MESH_OPTIONS, see utils.mesh_generation
+    'mesh_lod_levels': [1.0, 0.25, 0.05, 0.01],  # triangle fractions of the LOD pyramid, [] for none
+}
+
+
+def make_run_name(name, timestamp=True):
+    if not timestamp:
+        return name
+    return f"run_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{name}"
+
+
+def _emit(progress, event, **fields):
+    if progress is not None:
+        progress({'event': event, **fields})
+
+
+def _log(progress, message):
+    _emit(progress, 'log', message=message)
+
+
+def _step(progress, stage, name, step):
+    _emit(progress, 'step', stage=stage, name=name, step=step, total_steps=TOTAL_STEPS)
+
+
+def _substep(progress, name):
+    _emit(progress, 'substep', name=name)
+
+
+def load_run_info(run_dir):
+    """Image sources and options a run was built with, or None for older runs"""
+    try:
+        with open(os.path.join(run_dir, RUN_INFO)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_run_info(run_dir, image_paths, options, extensions=None):
+    update_run_info(run_dir, images=[os.path.abspath(p) for p in image_paths],
+                    options={k: options[k] for k in _RUN_INFO_OPTIONS}, extensions=extensions or [])
+
+
+def update_run_info(run_dir, **fields):
+    """Set fields of the run's run.json, keeping the others (e.g. the mesh LOD levels)
+
+    Fields set to None are removed.
+    """
+    info = {**(load_run_info(run_dir) or {}), **fields}
+    info = {k: v for k, v in info.items() if v is not None}
+    with open(os.path.join(run_dir, RUN_INFO), 'w') as f:
+        json.dump(info, f, indent=2, default=str)
+
+
+def run_mesh(run_dir, max_triangles=None):
+    """Mesh file of a run, the finest LOD level within `max_triangles` when given
+
+    Levels are listed under 'mesh_lods' in run.json (see utils.mesh_lod);
+    runs without them always give mesh/mesh.ply.
+    """
+    from utils.mesh_lod import select_lod
+
+    mesh_dir = os.path.join(run_dir, 'mesh')
+    lods = (load_run_info(run_dir) or {}).get('mesh_lods')
+    if max_triangles is None or not lods:
+        return os.path.join(mesh_dir, 'mesh.ply')
+    return select_lod(lods, max_triangles, mesh_dir)
+
+
+def build_point_cloud_lod(dense_dir):
+    """Octree levels of dense/fused.ply for progressive display, in dense/octree"""
+    from utils.point_cloud_lod import OCTREE_DIR, build_octree_lod
+
+    build_octree_lod(os.path.join(dense_dir, 'fused.ply'), os.path.join(dense_dir, OCTREE_DIR))
+
+
+def archive_run(run_dir, lossless=False, options=None):
+    """Replace dense/fused.ply of a run by a compressed archive (see utils.point_cloud_archive)
+
+    The archive is recorded in run.json. Without the PLY the fuse stage is
+    no longer up to date, so call restore_run() before resuming the run.
+    """
+    from utils.point_cloud_archive import ARCHIVE_NAME, archive_point_cloud
+
+    ply_path = os.path.join(run_dir, 'dense', 'fused.ply')
+    archive_point_cloud(ply_path, os.path.join(run_dir, 'dense', ARCHIVE_NAME), lossless, options)
+    os.remove(ply_path)
+    update_run_info(run_dir, point_cloud_archive={'path': os.path.join('dense', ARCHIVE_NAME),
+                                                  'lossless': bool(lossless)})
+
+
+def restore_run(run_dir):
+    """Write dense/fused.ply of an archived run back (exactly as it was for lossless archives)
+
+    The archive and its run.json record are removed, undoing archive_run().
+    """
+    from utils.point_cloud_archive import ARCHIVE_NAME, extract_ply
+
+    archive_path = os.path.join(run_dir, 'dense', ARCHIVE_NAME)
+    extract_ply(archive_path, os.path.join(run_dir, 'dense', 'fused.ply'))
+    os.remove(archive_path)
+    update_run_info(run_dir, point_cloud_archive=None)
+
+
+def generate_mesh_lods(mesh_dir, run_dir, levels):
+    """LOD pyramid of mesh/mesh.ply, recorded in run.json"""
+    from utils.mesh_lod import LOD_DIR, generate_lods
+
+    shutil.rmtree(os.path.join(mesh_dir, LOD_DIR), ignore_errors=True)
+    update_run_info(run_dir, mesh_lods=generate_lods(os.path.join(mesh_dir, 'mesh.ply'), levels))
+
+
+def remove_mesh_lods(mesh_dir, run_dir):
+    """Delete the LOD pyramid and its run.json record, e.g. when the mesh is rebuilt without one"""
+    from utils.mesh_lod import LOD_DIR
+
+    shutil.rmtree(os.path.join(mesh_dir, LOD_DIR), ignore_errors=True)
+    update_run_info(run_dir, mesh_lods=None)
+
+
+def generate_mesh(sparse_dir, dense_dir, mesh_dir, progress=None, pointcloud_path=None,
+                  mesher='tiled', mesh_options=None):
+    """Mesh `pointcloud_path` (default: the fused cloud) into `<mesh_dir>/mesh.ply`
+
+    `mesher` is 'tiled' (parallel per-tile Poisson, see
+    utils.mesh_generation.create_tiled_mesh), 'simple' (one global Open3D
+    Poisson) or 'colmap' (COLMAP's mesher, falling back to 'tiled').
+    """
+    from utils.colmap_model import read_camera_centers
+    from utils.mesh_generation import create_simple_mesh_from_pointcloud, create_tiled_mesh, run_colmap_mesher
+
+    if mesher not in MESHERS:
+        raise ValueError(f"Unknown mesher: {mesher}")
+    if mesher == 'colmap':
+        _log(progress, "  → Running COLMAP mesher...")
+        try:
+            if run_colmap_mesher(sparse_dir, dense_dir, mesh_dir):
+                _log(progress, " COLMAP mesh generation completed")
+                return
+            raise Exception("COLMAP mesher reported failure")
+        except Exception as e:
+            _log(progress, f" COLMAP mesher failed: {str(e)}")
+            _log(progress, "   Trying Open3D mesh generation...")
+
+    dense_ply = pointcloud_path or os.path.join(dense_dir, 'fused.ply')
+    mesh_ply = os.path.join(mesh_dir, 'mesh.ply')
+    try:
+        # Estimated normals are oriented towards the cameras
+        viewpoints = read_camera_centers(os.path.join(sparse_dir, '0'))
+    except (OSError, ValueError):
+        viewpoints = None
+    try:
+        if mesher == 'simple':
+            ok = create_simple_mesh_from_pointcloud(dense_ply, mesh_ply, viewpoints)
+        else:
+            ok = create_tiled_mesh(dense_ply, mesh_ply, mesh_options, viewpoints=viewpoints)
+        if not ok:
+            raise Exception("Open3D mesh generation reported failure")
+        _log(progress, " Open3D mesh generation completed")
+    except Exception as fallback_error:
+        _log(progress, f" Mesh generation failed: {str(fallback_error)}")
+        raise
+
+
+def _sparse_stage_params(options, profile=None):
+    extract = {'feature_type': options['feature_type']}
+    if profile and options['feature_type'] == 'sift':
+        extract['sift_options'] = profile['command_options']['feature_extractor']
+    match = {
+        'feature_type': options['feature_type'],
+        'pair_strategy': options['pair_strategy'],
+        'num_neighbors': options['num_neighbors'],
+        'vocab_tree_path': options['vocab_tree_path'],
+    }
+    if options['feature_type'] == 'superpoint':
+        extract.update({k: v for k, v in options['learned_options'].items() if k in EXTRACT_OPTIONS})
+        match.update(options['learned_options'])
+    return extract, match
+
+
+def _dense_settings(options, profile=None):
+    """Dense backend and its options: the profile's, overridden by the explicit ones"""
+    backend = resolve_dense_backend(options['dense_backend'])
+    if backend == 'cpu':
+        dense_options = {}
+        if profile:
+            dense_options = {'max_image_size': profile['max_image_size'],
+                             'window_radius': profile['patch_match_options']['window_radius']}
+        dense_options.update(options['cpu_dense_options'] or {})
+    else:
+        dense_options = dict(profile['patch_match_options']) if profile else {}
+        dense_options.update(options['patch_match_options'] or {})
+    return backend, dense_options
+
+
+def _execution_context(profile):
+    """Thread count and COLMAP options of an execution profile (no-op without one)"""
+    stack = contextlib.ExitStack()
+    if profile:
+        stack.enter_context(colmap_limits(profile['num_threads']))
+        stack.enter_context(colmap_options(profile['command_options']))
+    return stack
+
+
+def mesh_input(dense_dir, options):
+    """Point cloud the mesh is built from: the cleaned cloud when the clean stage runs"""
+    return os.path.join(dense_dir, CLEANED_PLY if options['clean'] and options['dense'] else 'fused.ply')
+
+
+def _clear_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def run_pipeline(image_paths, name, options=None, progress=None):
+    """Run image preparation → sparse → dense → mesh and return the run directory
+
+    `options` overrides DEFAULT_OPTIONS. `progress` is called with event
+    dicts: {'event': 'step', 'stage', 'name', 'step', 'total_steps'},
+    {'event': 'substep', 'name'}, {'event': 'log', 'message'},
+    {'event': 'stage', 'stage', 'skipped'}, the COLMAP progress events of
+    utils.colmap_runner and finally {'event': 'done', 'run_dir'}.
+    Exceptions propagate to the caller. This module does not import any
+    GUI or visualization packages. COLMAP output is logged per stage in
+    `<run_dir>/logs`.
+
+    The stages extract, match, map, undistort, patch_match, fuse,
+    point_cloud_lod, clean, mesh and mesh_lod are checkpointed (see
+    utils.checkpoints): running again into an existing run directory
+    skips every stage whose inputs and parameters are unchanged and
+    resumes at the first stale one; images added by extend_run() and the
+    extension history in run.json are kept. Without CUDA (or with
+    dense_backend='cpu') the patch_match and fuse stages are replaced by
+    cpu_dense.
+    """
+    from utils.pair_planner import check_strategy
+
+    options = {**DEFAULT_OPTIONS, **(options or {})}
+    check_strategy(options['feature_type'], options['pair_strategy'])
+    profile = resolve_profile(options['profile'], len(image_paths)) if options['profile'] else None
+
+    # Prepare output directories
+    _step(progress, 'setup', "Setting up output directories", 1)
+    run_name = make_run_name(name, options['timestamp_run_name'])
+    run_dir = os.path.join(options['outputs_dir'], run_name)
+    images_dir = os.path.join(run_dir, 'images')
+    sparse_dir = os.path.join(run_dir, 'sparse')
+    dense_dir = os.path.join(run_dir, 'dense')
+    mesh_dir = os.path.join(run_dir, 'mesh')
+    database_path = os.path.join(run_dir, 'database.db')
+    resumed = os.path.isdir(os.path.join(run_dir, MANIFEST_DIR))
+    os.makedirs(sparse_dir, exist_ok=True)
+    os.makedirs(dense_dir, exist_ok=True)
+    os.makedirs(mesh_dir, exist_ok=True)
+    _log(progress, f"{'Resuming' if resumed else 'Created'} output directory: {run_name}")
+
+    # Resuming keeps the images and history of any extend_run() on this run
+    info = (load_run_info(run_dir) if resumed else None) or {}
+    image_paths = [os.path.abspath(p) for p in image_paths]
+    previous = info.get('images', [])
+    save_run_info(run_dir, list(dict.fromkeys(image_paths + previous)), options, info.get('extensions'))
+    checkpoints = StageCheckpoints(run_dir)
+
+    # Link the images into the run's own workspace
+    _step(progress, 'prepare', "Staging images", 2)
+    kept = [p for p in previous if os.path.exists(p)]
+    # A previous source that moved away may now exist only in the workspace, so do not prune then
+    staged = stage_images(list(dict.fromkeys(image_paths + kept)), images_dir, options['staging_mode'],
+                          hash_fn=checkpoints.file_digest, prune=len(kept) == len(previous))
+    checkpoints.save_hash_cache()
+    _log(progress, f"Staged {len(set(staged.values()))} images in {images_dir}")
+
+    logs_dir = os.path.join(run_dir, LOGS_DIR)
+
+    def logged(stage_name, fn):
+        def run():
+            check_cancelled()
+            with _execution_context(profile), colmap_logging(logs_dir, progress, stage_name):
+                fn()
+        return run
+
+    def stage(stage_name, fn, inputs, params, outputs):
+        key, skipped = checkpoints.run(stage_name, logged(stage_name, fn), inputs, params, outputs)
+        _emit(progress, 'stage', stage=stage_name, skipped=skipped)
+        if skipped:
+            _log(progress, f"  ↷ {stage_name}: up to date, skipped")
+        return key
+
+    images_key = checkpoints.files_digest(
+        [os.path.join(images_dir, n) for n in set(staged.values())])
+
+    # Sparse reconstruction
+    _step(progress, 'sparse', "Running sparse reconstruction", 3)
+    _substep(progress, "Feature extraction, matching, mapping")
+    learned_options = dict(options['learned_options'])
+    if options['use_feature_cache']:
+        from utils.feature_store import get_feature_store
+        learned_options['store'] = get_feature_store()
+    if options['feature_type'] == 'superpoint':
+        _log(progress, "Extracting SuperPoint features and SuperGlue matches...")
+        extract_kwargs = {k: v for k, v in learned_options.items() if k in EXTRACT_OPTIONS}
+    else:
+        _log(progress, "Extracting SIFT features from images...")
+        extract_kwargs = {}
+    extract_params, match_params = _sparse_stage_params(options, profile)
+
+    extract_key = stage(
+        'extract',
+        lambda: run_feature_extraction(images_dir, database_path, options['feature_type'], **extract_kwargs),
+        {'images': images_key}, extract_params, ['database.db'])
+    match_key = stage(
+        'match',
+        lambda: run_matching(images_dir, database_path, options['feature_type'],
+                             options['pair_strategy'], options['num_neighbors'],
+                             options['vocab_tree_path'], **learned_options),
+        {'extract': extract_key}, match_params, ['database.db'])
+
+    def map_stage():
+        _clear_dir(sparse_dir)
+        run_mapper(images_dir, database_path, sparse_dir)
+
+    map_key = stage('map', map_stage, {'match': match_key, 'images': images_key}, {},
+                    [os.path.join('sparse', '0')])
+    _log(progress, "✓ Sparse reconstruction completed")
+
+    # Dense reconstruction
+    if options['dense']:
+        _step(progress, 'dense', "Running dense reconstruction", 4)
+        _substep(progress, "Depth estimation, point cloud fusion")
+        _log(progress, "  → Undistorting images for dense reconstruction...")
+        undistort_key = stage(
+            'undistort', lambda: run_image_undistorter(sparse_dir, images_dir, dense_dir),
+            {'map': map_key, 'images': images_key}, {},
+            [os.path.join('dense', 'images'), os.path.join('dense', 'sparse')])
+        backend, dense_options = _dense_settings(options, profile)
+        if backend == 'cpu':
+            from utils.cpu_dense import run_cpu_dense
+            _log(progress, "  → No CUDA: computing depth with CPU semi-global matching...")
+            fuse_key = stage(
+                'cpu_dense',
+                lambda: run_cpu_dense(dense_dir, dense_options, profile and profile['num_threads']),
+                {'undistort': undistort_key}, dense_options, [os.path.join('dense', 'fused.ply')])
+        else:
+            patch_match_key = stage(
+                'patch_match', lambda: run_patch_match_stereo(dense_dir, dense_options),
+                {'undistort': undistort_key}, dense_options, [os.path.join('dense', 'stereo')])
+            fuse_key = stage(
+                'fuse', lambda: run_stereo_fusion(dense_dir, options['fusion_min_num_pixels']),
+                {'patch_match': patch_match_key}, {'min_num_pixels': options['fusion_min_num_pixels']},
+                [os.path.join('dense', 'fused.ply')])
+        if options['point_cloud_lod']:
+            _log(progress, "  → Building the point cloud octree for the viewer...")
+            stage('point_cloud_lod', lambda: build_point_cloud_lod(dense_dir), {'fuse': fuse_key}, {},
+                  [os.path.join('dense', 'octree')])
+        if options['clean']:
+            from utils.point_cloud_cleaning import clean_point_cloud
+            _log(progress, "  → Downsampling the point cloud and removing outliers...")
+            fuse_key = stage(
+                'clean',
+                lambda: clean_point_cloud(os.path.join(dense_dir, 'fused.ply'),
+                                          os.path.join(dense_dir, CLEANED_PLY), options['clean_options']),
+                {'fuse': fuse_key}, options['clean_options'] or {}, [os.path.join('dense', CLEANED_PLY)])
+        _log(progress, " Dense reconstruction completed")
+    else:
+        fuse_key = None
+
+    # Mesh generation
+    if options['mesh']:
+        _step(progress, 'mesh', "Generating mesh model", 5)
+        _substep(progress, "Meshing (COLMAP/Open3D)")
+        mesh_key = stage('mesh', lambda: generate_mesh(sparse_dir, dense_dir, mesh_dir, progress,
+                                                       mesh_input(dense_dir, options), options['mesher'],
+                                                       options['mesh_options']),
+                         {'map': map_key, 'fuse': fuse_key},
+                         {'mesher': options['mesher'], 'mesh_options': options['mesh_options'] or {}},
+                         [os.path.join('mesh', 'mesh.ply')])
+        if options['mesh_lod_levels']:
+            _substep(progress, "Mesh level-of-detail pyramid")
+            stage('mesh_lod', lambda: generate_mesh_lods(mesh_dir, run_dir, options['mesh_lod_levels']),
+                  {'mesh': mesh_key}, {'levels': options['mesh_lod_levels']},
+                  [os.path.join('mesh', 'lod')])
+        else:
+            # Levels of an earlier mesh would be served by run_mesh() otherwise
+            remove_mesh_lods(mesh_dir, run_dir)
+            checkpoints.invalidate('mesh_lod')
+
+    _step(progress, 'finalize', "Finalizing reconstruction", 6)
+    _emit(progress, 'done', run_dir=run_dir)
+    return run_dir
+
+
+def extend_run(run_dir, new_image_paths, options=None, progress=None):
+    """Add images to an existing run without rebuilding it
+
+    Only the new images are added to the run's database. They are matched
+    among themselves and against the relevant existing images (see
+    utils.pair_planner.extension_pairs), registered into sparse/0 with
+    `image_registrator` and refined with `bundle_adjuster`. Patch match
+    stereo is recomputed only for the new images and the existing images
+    they were matched with, then the whole model is fused and meshed
+    again. The feature type of the original run is kept.
+    """
+    from utils.colmap_database import COLMAPDatabase
+    from utils.pair_planner import extension_pairs, write_pairs
+
+    info = load_run_info(run_dir)
+    if info is None:
+        raise ValueError(f"{run_dir} has no {RUN_INFO}; only runs created by this version can be extended")
+    options = {**DEFAULT_OPTIONS, **info['options'], **(options or {}),
+               'feature_type': info['options']['feature_type']}
+    images_dir = os.path.join(run_dir, 'images')
+    sparse_dir = os.path.join(run_dir, 'sparse')
+    dense_dir = os.path.join(run_dir, 'dense')
+    mesh_dir = os.path.join(run_dir, 'mesh')
+    database_path = os.path.join(run_dir, 'database.db')
+
+    logs_dir = os.path.join(run_dir, LOGS_DIR)
+
+    def logged(stage_name, fn, *args, **kwargs):
+        check_cancelled()
+        with _execution_context(profile), colmap_logging(logs_dir, progress, stage_name):
+            return fn(*args, **kwargs)
+
+    # Add the new images to the run's workspace
+    _step(progress, 'prepare', "Staging images", 1)
+    checkpoints = StageCheckpoints(run_dir)
+    # Old sources that moved away are fine when hardlinked or copied; their symlinks break (checked below)
+    sources = list(dict.fromkeys([p for p in info['images'] if os.path.exists(p)]
+                                 + [os.path.abspath(p) for p in new_image_paths]))
+    staged = stage_images(sources, images_dir, options['staging_mode'], hash_fn=checkpoints.file_digest)
+    checkpoints.save_hash_cache()
+    profile = resolve_profile(options['profile'], len(set(staged.values()))) if options['profile'] else None
+
+    _step(progress, 'setup', "Finding new images", 2)
+    with COLMAPDatabase(database_path) as db:
+        old_names = sorted(db.image_ids())
+    missing = [n for n in old_names if not os.path.exists(os.path.join(images_dir, n))]
+    if missing:
+        raise FileNotFoundError(f"Sources of {len(missing)} symlinked images of {run_dir} moved away "
+                                f"({', '.join(missing[:5])}); pass the moved files again to restage them")
+    new_names = sorted(set(staged[os.path.abspath(p)] for p in new_image_paths) - set(old_names))
+    if not new_names:
+        _log(progress, "All selected images are already part of this model")
+        _emit(progress, 'done', run_dir=run_dir)
+        return run_dir
+    _log(progress, f"Extending {os.path.basename(run_dir)} with {len(new_names)} new images")
+
+    # Sparse: features and matches for the new images, then registration
+    _step(progress, 'sparse', "Registering new images", 3)
+    learned_options = dict(options['learned_options'])
+    if options['use_feature_cache']:
+        from utils.feature_store import get_feature_store
+        learned_options['store'] = get_feature_store()
+    feature_type = options['feature_type']
+    extract_kwargs = {}
+    if feature_type == 'superpoint':
+        extract_kwargs = {k: v for k, v in learned_options.items() if k in EXTRACT_OPTIONS}
+    _substep(progress, "Feature extraction")
+    logged('extend_extract', run_feature_extraction, images_dir, database_path, feature_type,
+           image_names=new_names, **extract_kwargs)
+
+    _substep(progress, "Matching against existing images")
+    features = None
+    if options['pair_strategy'] not in ('exhaustive', 'sequential'):
+        from utils.feature_extraction import extract_superpoint_features_batch
+        all_names = old_names + new_names
+        features = dict(zip(all_names, extract_superpoint_features_batch(
+            [os.path.join(images_dir, n) for n in all_names], store=learned_options.get('store'))))
+    pairs = extension_pairs(new_names, old_names, options['pair_strategy'],
+                            options['num_neighbors'], features)
+    pairs_path = os.path.join(run_dir, 'extension_pairs.txt')
+    write_pairs(pairs, pairs_path)
+    if feature_type == 'superpoint':
+        from utils.colmap_import import import_learned_matches
+        import_learned_matches(images_dir, database_path, pairs=pairs, replace=False, **learned_options)
+    else:
+        logged('extend_match', run_pairs_matching, database_path, pairs_path)
+
+    _substep(progress, "Image registration and bundle adjustment")
+    model_dir = os.path.join(sparse_dir, '0')
+    extended_dir = os.path.join(sparse_dir, '0_extended')
+    _clear_dir(extended_dir)
+    logged('extend_register', run_image_registrator, database_path, model_dir, extended_dir)
+    logged('extend_register', run_bundle_adjuster, extended_dir, extended_dir)
+    shutil.rmtree(model_dir)
+    os.rename(extended_dir, model_dir)
+    _log(progress, "✓ New images registered")
+
+    # Dense: recompute depth maps for the affected views only
+    if options['dense']:
+        _step(progress, 'dense', "Updating dense reconstruction", 4)
+        backend, dense_options = _dense_settings(options, profile)
+        logged('extend_undistort', run_image_undistorter, sparse_dir, images_dir, dense_dir)
+        if backend == 'cpu':
+            # CPU depth maps are not kept, so the whole cloud is recomputed
+            from utils.cpu_dense import run_cpu_dense
+            _log(progress, "  → Recomputing the CPU dense point cloud...")
+            logged('extend_cpu_dense', run_cpu_dense, dense_dir, dense_options,
+                   profile and profile['num_threads'])
+        else:
+            affected = sorted(set(new_names) | {o for _, o in pairs if o in old_names})
+            _log(progress, f"  → Recomputing depth maps for {len(affected)} affected views...")
+            write_patch_match_config(dense_dir, affected)
+            logged('extend_patch_match', run_patch_match_stereo, dense_dir, dense_options)
+            logged('extend_fuse', run_stereo_fusion, dense_dir, options['fusion_min_num_pixels'])
+        if options['point_cloud_lod']:
+            logged('extend_point_cloud_lod', build_point_cloud_lod, dense_dir)
+        if options['clean']:
+            from utils.point_cloud_cleaning import clean_point_cloud
+            logged('extend_clean', clean_point_cloud, os.path.join(dense_dir, 'fused.ply'),
+                   os.path.join(dense_dir, CLEANED_PLY), options['clean_options'])
+        _log(progress, " Dense reconstruction updated")
+
+    if options['mesh']:
+        _step(progress, 'mesh', "Generating mesh model", 5)
+        logged('extend_mesh', generate_mesh, sparse_dir, dense_dir, mesh_dir, progress,
+               mesh_input(dense_dir, options), options['mesher'], options['mesh_options'])
+        if options['mesh_lod_levels']:
+            logged('extend_mesh_lod', generate_mesh_lods, mesh_dir, run_dir, options['mesh_lod_levels'])
+        else:
+            remove_mesh_lods(mesh_dir, run_dir)
+
+    # The stage manifests describe the model before the extension
+    for stage_name in STAGES:
+        checkpoints.invalidate(stage_name)
+    save_run_info(run_dir, list(dict.fromkeys(info['images'] + sources)), options,
+                  info['extensions'] + [{'images': new_names,
+                                         'date': datetime.datetime.now().isoformat(timespec='seconds')}])
+    _step(progress, 'finalize', "Finalizing reconstruction", 6)
+    _emit(progress, 'done', run_dir=run_dir)
+    return run_dir
@@ -0,0 +1,214 @@
+import os
+
+import numpy as np
+
+# PLY scalar types (both naming schemes) -> NumPy type without byte order
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+_TYPE_NAMES = {'i1': 'char', 'u1': 'uchar', 'i2': 'short', 'u2': 'ushort',
+               'i4': 'int', 'u4': 'uint', 'f4': 'float', 'f8': 'double'}
+_BYTE_ORDER = {'binary_little_endian': '<', 'binary_big_endian': '>'}
+# Column groups returned as (n, 3) arrays
+COLUMN_GROUPS = {
+    'xyz': ('x', 'y', 'z'),
+    'normals': ('nx', 'ny', 'nz'),
+    'rgb': ('red', 'green', 'blue'),
+}
+DEFAULT_CHUNK_SIZE = 1 << 20
+# Width of the vertex count written by PlyWriter, patched in when it is closed
+_COUNT_DIGITS = 15
+
+
+def read_ply_header(path):
+    """Format, elements and data offset of a PLY file
+
+    Returns {'format', 'elements': [(name, count, properties)], 'offset'},
+    properties being (name, type) pairs, or (name, ('list', count type,
+    item type)) for list properties such as mesh faces.
+    """
+    elements = []
+    fmt = None
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError(f"Not a PLY file: {path}")
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"Truncated PLY header: {path}")
+            fields = line.decode('ascii', errors='replace').split()
+            if not fields or fields[0] in ('comment', 'obj_info'):
+                continue
+            if fields[0] == 'end_header':
+                return {'format': fmt, 'elements': elements, 'offset': f.tell()}
+            if fields[0] == 'format':
+                fmt = fields[1]
+            elif fields[0] == 'element':
+                elements.append((fields[1], int(fields[2]), []))
+            elif fields[0] == 'property' and fields[1] == 'list':
+                elements[-1][2].append((fields[4], ('list', fields[2], fields[3])))
+            elif fields[0] == 'property':
+                elements[-1][2].append((fields[2], fields[1]))
+
+
+def _element_dtype(properties, byte_order):
+    return np.dtype([(name, byte_order + PLY_TYPES[kind]) for name, kind in properties])
+
+
+def open_ply(path, element='vertex', mode='r'):
+    """Memory-mapped structured array of one element of a binary PLY file
+
+    Nothing is read until the array is accessed, so this is cheap even for
+    clouds of tens of millions of points; fields are the PLY properties
+    (x, y, z, nx, ny, nz, red, green, blue for COLMAP's fused.ply). Only
+    elements that no list-property element (e.g. faces) precedes can be
+    mapped, which covers the vertices of every file written here or by
+    COLMAP. `mode='r+'` edits the file in place.
+    """
+    header = read_ply_header(path)
+    byte_order = _BYTE_ORDER.get(header['format'])
+    if byte_order is None:
+        raise ValueError(f"Only binary PLY files can be memory-mapped, {path} is {header['format']}")
+    offset = header['offset']
+    for name, count, properties in header['elements']:
+        if any(isinstance(kind, tuple) for _, kind in properties):
+            break
+        dtype = _element_dtype(properties, byte_order)
+        if name == element:
+            if count == 0:
+                return np.empty(0, dtype)
+            return np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(count,))
+        offset += count * dtype.itemsize
+    raise ValueError(f"No memory-mappable '{element}' element in {path}")
+
+
+def has_columns(vertices, column):
+    """Whether `vertices` has a column or all fields of a column group"""
+    return all(name in vertices.dtype.names for name in COLUMN_GROUPS.get(column, (column,)))
+
+
+def read_columns(vertices, column, start=0, stop=None, dtype=None):
+    """Rows start:stop of one column, or of a group as an (n, 3) array
+
+    `vertices` comes from open_ply(); only the requested fields of those
+    rows are read from disk.
+    """
+    rows = vertices[start:stop]
+    if column not in COLUMN_GROUPS:
+        return np.asarray(rows[column], dtype)
+    names = COLUMN_GROUPS[column]
+    out = np.empty((len(rows), len(names)), dtype or rows.dtype[names[0]].newbyteorder('='))
+    for i, name in enumerate(names):
+        out[:, i] = rows[name]
+    return out
+
+
+def iter_chunks(path, columns=('xyz',), chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (start, {column: array}) for consecutive blocks of vertices
+
+    Only `chunk_size` rows of the requested columns are in memory at a
+    time; columns missing from the file are skipped.
+    """
+    vertices = open_ply(path)
+    columns = [c for c in columns if has_columns(vertices, c)]
+    for start in range(0, len(vertices), chunk_size):
+        yield start, {c: read_columns(vertices, c, start, start + chunk_size) for c in columns}
+
+
+def read_point_cloud(path, columns=('xyz', 'normals', 'rgb')):
+    """{column: array} with the requested columns the file has, fully loaded"""
+    vertices = open_ply(path)
+    return {c: read_columns(vertices, c) for c in columns if has_columns(vertices, c)}
+
+
+def _vertex_dtype(normals=False, colors=False):
+    fields = [(name, '<f4') for name in COLUMN_GROUPS['xyz']]
+    if normals:
+        fields += [(name, '<f4') for name in COLUMN_GROUPS['normals']]
+    if colors:
+        fields += [(name, 'u1') for name in COLUMN_GROUPS['rgb']]
+    return np.dtype(fields)
+
+
+def _vertices(dtype, xyz, normals=None, colors=None):
+    vertex = np.empty(len(xyz), dtype)
+    for column, values in (('xyz', xyz), ('normals', normals), ('rgb', colors)):
+        if has_columns(vertex, column):
+            for i, name in enumerate(COLUMN_GROUPS[column]):
+                vertex[name] = values[:, i]
+    return vertex
+
+
+def _header(dtype, count, digits=None):
+    count = str(count).zfill(digits) if digits else str(count)
+    lines = ['ply', 'format binary_little_endian 1.0', f'element vertex {count}']
+    lines += [f'property {_TYPE_NAMES[dtype[name].str[1:]]} {name}' for name in dtype.names]
+    return ('\n'.join(lines + ['end_header']) + '\n').encode('ascii')
+
+
+def write_ply(path, xyz, normals=None, colors=None):
+    """Binary little-endian PLY point cloud, float32 positions/normals and uchar colors
+
+    With normals and colors this is the vertex layout of COLMAP's fused.ply.
+    """
+    dtype = _vertex_dtype(normals is not None, colors is not None)
+    with open(path, 'wb') as f:
+        f.write(_header(dtype, len(xyz)))
+        _vertices(dtype, xyz, normals, colors).tofile(f)
+
+
+class PlyWriter:
+    """Point cloud PLY written chunk by chunk, for clouds that do not fit in memory
+
+        with PlyWriter(path, normals=True, colors=True) as writer:
+            for chunk in chunks:
+                writer.write(chunk['xyz'], chunk['normals'], chunk['rgb'])
+
+    The vertex count is filled in when the writer is closed.
+    """
+
+    def __init__(self, path, normals=False, colors=False):
+        self.path = path
+        self.count = 0
+        self._dtype = _vertex_dtype(normals, colors)
+        self._file = open(path, 'wb')
+        self._file.write(_header(self._dtype, 0, _COUNT_DIGITS))
+
+    def write(self, xyz, normals=None, colors=None):
+        if len(xyz):
+            _vertices(self._dtype, xyz, normals, colors).tofile(self._file)
+            self.count += len(xyz)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        self._file.write(_header(self._dtype, self.count, _COUNT_DIGITS))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        if exc_type is not None:
+            os.remove(self.path)
+
+
+def to_open3d(cloud):
+    """open3d PointCloud from {'xyz', 'normals', 'rgb'} arrays (e.g. read_point_cloud())"""
+    import open3d as o3d
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(np.asarray(cloud['xyz'], np.float64))
+    if cloud.get('normals') is not None:
+        pcd.normals = o3d.utility.Vector3dVector(np.asarray(cloud['normals'], np.float64))
+    if cloud.get('rgb') is not None:
+        colors = np.asarray(cloud['rgb'], np.float64)
+        if cloud['rgb'].dtype == np.uint8:
+            colors /= 255
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+    return pcd
@@ -0,0 +1,305 @@
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ARCHIVE_NAME = 'fused.pcz'
+MAGIC = b'PCZ1'
+# Trailer: offset of the JSON index, then the magic again
+TRAILER = struct.Struct('<Q4s')
+DEFAULT_ARCHIVE_OPTIONS = {
+    'codec': None,               # 'zstd', 'lz4' or 'zlib'; None: the best one installed
+    'position_step': None,       # quantization step in model units; None: from the point spacing
+    'step_spacings': 0.05,       # default step, in point spacings
+    'chunk_size': 1 << 16,       # points per compressed chunk
+}
+MORTON_BITS = 10
+
+
+def _codecs():
+    """Available codecs as {name: (compress, decompress)}, best first"""
+    codecs = {}
+    try:
+        import zstandard
+        codecs['zstd'] = (lambda data: zstandard.ZstdCompressor(level=9).compress(data),
+                          lambda data: zstandard.ZstdDecompressor().decompress(data))
+    except ImportError:
+        pass
+    try:
+        import lz4.frame
+        codecs['lz4'] = (lambda data: lz4.frame.compress(data, compression_level=9), lz4.frame.decompress)
+    except ImportError:
+        pass
+    codecs['zlib'] = (lambda data: zlib.compress(data, 6), zlib.decompress)
+    return codecs
+
+
+def _codec(name):
+    codecs = _codecs()
+    name = name or next(iter(codecs))
+    if name not in codecs:
+        raise ValueError(f"Compression codec {name!r} is not available (installed: {', '.join(codecs)})")
+    return name, codecs[name]
+
+
+def encode_octahedral(normals):
+    """Unit normals as 2 bytes each: octahedral projection quantized to uint8"""
+    normals = np.asarray(normals, np.float64)
+    n = normals / np.maximum(np.abs(normals).sum(axis=1, keepdims=True), 1e-12)
+    x, y, z = n[:, 0], n[:, 1], n[:, 2]
+    sign_x, sign_y = np.where(x >= 0, 1.0, -1.0), np.where(y >= 0, 1.0, -1.0)
+    folded = z < 0
+    u = np.where(folded, (1 - np.abs(y)) * sign_x, x)
+    v = np.where(folded, (1 - np.abs(x)) * sign_y, y)
+    return np.round((np.stack([u, v], axis=1) * 0.5 + 0.5) * 255).astype(np.uint8)
+
+
+def decode_octahedral(encoded):
+    """Inverse of encode_octahedral(), as float32 unit vectors"""
+    uv = encoded.astype(np.float32) / 255 * 2 - 1
+    x, y = uv[:, 0], uv[:, 1]
+    z = 1 - np.abs(x) - np.abs(y)
+    fold = np.maximum(-z, 0)
+    x = x - fold * np.where(x >= 0, 1, -1)
+    y = y - fold * np.where(y >= 0, 1, -1)
+    normals = np.stack([x, y, z], axis=1)
+    return normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+
+def _spread_bits(values):
+    """Interleave two zero bits after each of the low MORTON_BITS bits"""
+    values = values.astype(np.uint64)
+    result = np.zeros_like(values)
+    for bit in range(MORTON_BITS):
+        result |= ((values >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * bit)
+    return result
+
+
+def _morton_order(path):
+    """Order of the points along a Morton curve, so that chunks are spatially compact"""
+    from utils.ply_io import iter_chunks
+
+    low, high = np.full(3, np.inf), np.full(3, -np.inf)
+    for _, chunk in iter_chunks(path, ('xyz',)):
+        low = np.minimum(low, chunk['xyz'].min(axis=0))
+        high = np.maximum(high, chunk['xyz'].max(axis=0))
+    size = float((high - low).max()) or 1.0
+    cells = (1 << MORTON_BITS) - 1
+    keys = []
+    for _, chunk in iter_chunks(path, ('xyz',)):
+        ijk = np.clip(((chunk['xyz'] - low) / size * cells).astype(np.int64), 0, cells)
+        keys.append(_spread_bits(ijk[:, 0]) | _spread_bits(ijk[:, 1]) << np.uint64(1)
+                    | _spread_bits(ijk[:, 2]) << np.uint64(2))
+    return np.argsort(np.concatenate(keys), kind='stable')
+
+
+def _shuffle_bytes(records):
+    """Byte planes of fixed-size records (byte 0 of every record, then byte 1, ...), which compress better"""
+    return np.ascontiguousarray(records.view(np.uint8).reshape(len(records), -1).T).tobytes()
+
+
+def _unshuffle_bytes(data, dtype, count):
+    return np.ascontiguousarray(np.frombuffer(data, np.uint8).reshape(-1, count).T).view(dtype).ravel()
+
+
+def _quantize_chunk(rows, step, has_normals, has_colors):
+    """Payload and index entry of one quantized chunk (rows in Morton order)
+
+    Positions are integer steps from the chunk minimum, stored as the
+    zigzag-encoded differences between consecutive points, which stay
+    small along the Morton curve; normals and colors compress better as
+    plain planes.
+    """
+    from utils.ply_io import read_columns
+
+    xyz = read_columns(rows, 'xyz', dtype=np.float64)
+    origin = xyz.min(axis=0)
+    deltas = np.diff(np.round((xyz - origin) / step).astype(np.int64), axis=0, prepend=0)
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+    # 16 bits unless a jump spans more steps
+    largest = zigzag.max(initial=0)
+    dtype = next(np.dtype(t) for t in ('<u2', '<u4', '<u8') if largest <= np.iinfo(t).max)
+    planes = [_shuffle_bytes(np.ascontiguousarray(zigzag.T.astype(dtype)).ravel())]
+    if has_normals:
+        planes.append(np.ascontiguousarray(encode_octahedral(read_columns(rows, 'normals')).T).tobytes())
+    if has_colors:
+        planes.append(np.ascontiguousarray(read_columns(rows, 'rgb', dtype=np.uint8).T).tobytes())
+    entry = {'origin': origin.tolist(), 'bits': dtype.itemsize * 8}
+    return b''.join(planes), entry
+
+
+def archive_point_cloud(ply_path, archive_path, lossless=False, options=None, num_workers=None):
+    """Write a chunked, compressed archive of a binary PLY point cloud
+
+    By default positions are quantized to `position_step` (a fraction of
+    the point spacing) as uint16 offsets from a per-chunk origin (uint32
+    or uint64 for chunks spanning more steps), normals are octahedral-encoded in 2
+    bytes and colors kept as uint8; points are reordered along a Morton
+    curve so that chunks are spatially compact. With `lossless`, the
+    vertex records are stored unchanged (byte-shuffled) with the PLY
+    header, and extract_ply() restores the file bit for bit. Chunks are
+    compressed independently (zstd, lz4 or zlib) in `num_workers` threads
+    and listed in an index at the end of the file. Returns the index.
+    """
+    from utils.colmap_runner import thread_budget
+    from utils.ply_io import has_columns, open_ply, read_ply_header
+    from utils.point_cloud_cleaning import estimate_spacing
+
+    options = {**DEFAULT_ARCHIVE_OPTIONS, **(options or {})}
+    codec, (compress, _) = _codec(options['codec'])
+    vertices = open_ply(ply_path)
+    n, chunk_size = len(vertices), options['chunk_size']
+    index = {'version': 1, 'codec': codec, 'count': n, 'lossless': bool(lossless), 'chunks': []}
+    has_normals, has_colors = has_columns(vertices, 'normals'), has_columns(vertices, 'rgb')
+
+    if lossless:
+        index['dtype'] = vertices.dtype.descr
+        start = getattr(vertices, 'offset', read_ply_header(ply_path)['offset'])
+        # The header (and any element before the vertices) and whatever follows them
+        sections = {'prefix': (0, start), 'trailing': (start + vertices.nbytes, os.path.getsize(ply_path))}
+
+        def payload(start):
+            return _shuffle_bytes(np.asarray(vertices[start:start + chunk_size])), {}
+    else:
+        index['columns'] = ['xyz'] + ['normals'] * has_normals + ['rgb'] * has_colors
+        step = options['position_step'] or options['step_spacings'] * (estimate_spacing(vertices) or 0)
+        if not step and n:
+            raise ValueError(f"Cannot determine a quantization step for {ply_path}; set position_step")
+        index['step'] = step
+        sections = {}
+        order = _morton_order(ply_path) if n else None
+
+        def payload(start):
+            # Read in file order so the memory-map reads are sequential, then put back in Morton order
+            indices = order[start:start + chunk_size]
+            sorter = np.argsort(indices)
+            rows = np.empty(len(indices), vertices.dtype)
+            rows[sorter] = vertices[indices[sorter]]
+            return _quantize_chunk(rows, step, has_normals, has_colors)
+
+    def compressed(start):
+        data, entry = payload(start)
+        return compress(data), {**entry, 'count': min(chunk_size, n - start)}
+
+    num_workers = num_workers or thread_budget() or os.cpu_count() or 1
+    with open(archive_path + '.tmp', 'wb') as f, ThreadPoolExecutor(max_workers=num_workers) as pool:
+        f.write(MAGIC)
+        for data, entry in pool.map(compressed, range(0, n, chunk_size)):
+            index['chunks'].append({**entry, 'offset': f.tell(), 'size': len(data)})
+            f.write(data)
+        for name, (begin, end) in sections.items():
+            data = compress(_read_bytes(ply_path, begin, end - begin))
+            index[name] = {'offset': f.tell(), 'size': len(data)}
+            f.write(data)
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode())
+        f.write(TRAILER.pack(index_offset, MAGIC))
+    os.replace(archive_path + '.tmp', archive_path)
+    ratio = os.path.getsize(ply_path) / max(os.path.getsize(archive_path), 1)
+    print(f"✓ Point cloud archived: {n} points, {len(index['chunks'])} {codec} chunks, "
+          f"{ratio:.1f}x smaller{' (lossless)' if lossless else ''}")
+    return index
+
+
+def read_archive_index(archive_path):
+    """The JSON index at the end of an archive"""
+    with open(archive_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a point cloud archive: {archive_path}")
+        f.seek(-TRAILER.size, os.SEEK_END)
+        index_offset, magic = TRAILER.unpack(f.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError(f"Truncated point cloud archive: {archive_path}")
+        f.seek(index_offset)
+        return json.loads(f.read()[:-TRAILER.size])
+
+
+def _read_bytes(archive_path, offset, size):
+    with open(archive_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def read_chunk(archive_path, index, i, columns=None):
+    """Decode chunk `i` into {'xyz' float64, 'normals' float32, 'rgb' uint8}
+
+    Only `columns` (default: all stored ones) are decoded. Lossless
+    archives give the exact values of the original file.
+    """
+    from utils.ply_io import COLUMN_GROUPS, has_columns, read_columns
+
+    chunk = index['chunks'][i]
+    _, (_, decompress) = _codec(index['codec'])
+    data = decompress(_read_bytes(archive_path, chunk['offset'], chunk['size']))
+    count = chunk['count']
+    if index['lossless']:
+        dtype = np.dtype([tuple(field) for field in index['dtype']])
+        rows = _unshuffle_bytes(data, dtype, count)
+        # Like the quantized chunks, requested columns the cloud does not have are left out
+        columns = [c for c in columns or COLUMN_GROUPS if has_columns(rows, c)]
+        return {c: read_columns(rows, c, dtype=np.float64 if c == 'xyz' else None) for c in columns}
+
+    columns = columns or index['columns']
+    position_dtype = np.dtype(f"<u{chunk['bits'] // 8}")
+    layout = {'xyz': (position_dtype, 3), 'normals': (np.dtype(np.uint8), 2), 'rgb': (np.dtype(np.uint8), 3)}
+    cloud, offset = {}, 0
+    for column in index['columns']:
+        dtype, width = layout[column]
+        size = dtype.itemsize * width * count
+        if column == 'xyz' and column in columns:
+            zigzag = _unshuffle_bytes(data[offset:offset + size], dtype, width * count).astype(np.int64)
+            deltas = (zigzag >> 1) ^ -(zigzag & 1)
+            steps = np.cumsum(deltas.reshape(width, count), axis=1).T
+            cloud[column] = steps * index['step'] + np.asarray(chunk['origin'])
+        elif column in columns:
+            planes = np.frombuffer(data, dtype, width * count, offset).reshape(width, count).T
+            if column == 'normals':
+                cloud[column] = decode_octahedral(planes)
+            else:
+                cloud[column] = np.ascontiguousarray(planes)
+        offset += size
+    return cloud
+
+
+def load_archive(archive_path, columns=None, num_workers=None):
+    """Whole point cloud of an archive, its chunks decompressed and decoded in parallel"""
+    index = read_archive_index(archive_path)
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count() or 1) as pool:
+        chunks = list(pool.map(lambda i: read_chunk(archive_path, index, i, columns),
+                               range(len(index['chunks']))))
+    if not chunks:
+        return {'xyz': np.empty((0, 3))}
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in chunks[0]}
+
+
+def extract_ply(archive_path, ply_path, num_workers=None):
+    """Write the point cloud of an archive back to a PLY file
+
+    Lossless archives reproduce the original file exactly; quantized ones
+    give a binary PLY with the decoded points (in Morton order).
+    """
+    from utils.ply_io import write_ply
+
+    index = read_archive_index(archive_path)
+    if not index['lossless']:
+        cloud = load_archive(archive_path, num_workers=num_workers)
+        write_ply(ply_path, cloud['xyz'], cloud.get('normals'), cloud.get('rgb'))
+        return
+    _, (_, decompress) = _codec(index['codec'])
+    dtype = np.dtype([tuple(field) for field in index['dtype']])
+
+    def records(chunk):
+        data = decompress(_read_bytes(archive_path, chunk['offset'], chunk['size']))
+        return _unshuffle_bytes(data, dtype, chunk['count']).tobytes()
+
+    with open(ply_path + '.tmp', 'wb') as f, \
+            ThreadPoolExecutor(max_workers=num_workers or os.cpu_count() or 1) as pool:
+        prefix, trailing = index['prefix'], index['trailing']
+        f.write(decompress(_read_bytes(archive_path, prefix['offset'], prefix['size'])))
+        for data in pool.map(records, index['chunks']):
+            f.write(data)
+        f.write(decompress(_read_bytes(archive_path, trailing['offset'], trailing['size'])))
+    os.replace(ply_path + '.tmp', ply_path)
@@ -0,0 +1,208 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from utils.colmap_runner import check_cancelled, report_progress
+from utils.ply_io import DEFAULT_CHUNK_SIZE, PlyWriter, has_columns, iter_chunks, open_ply, read_columns
+
+DEFAULT_CLEAN_OPTIONS = {
+    'voxel_size': None,         # None: voxel_spacing times the estimated point spacing
+    'voxel_spacing': 2.0,
+    'outliers': 'statistical',  # 'statistical', 'radius' or None
+    'nb_neighbors': 20,         # statistical: neighbours of the mean distance
+    'std_ratio': 2.0,           # statistical: drop points above mean + std_ratio * std
+    'radius_voxels': 3.0,       # radius: neighbourhood radius, in voxels
+    'min_neighbors': 4,         # radius: neighbours a point needs to be kept
+    'slab_points': 4_000_000,   # input points held in memory at once
+}
+SPACING_SAMPLE = 100_000
+# Neighbouring slabs contribute the points this many voxels from the shared edge
+HALO_VOXELS = 8
+
+
+def estimate_spacing(vertices, sample=SPACING_SAMPLE):
+    """Typical distance between neighbouring points, from a subsample
+
+    The median nearest-neighbour distance of an evenly strided sample is
+    scaled back to the full cloud assuming the points lie on surfaces
+    (spacing ~ 1 / sqrt(density)). `vertices` comes from open_ply() or
+    is an (n, 3) array.
+    """
+    from scipy.spatial import cKDTree
+
+    step = max(1, len(vertices) // sample)
+    if vertices.dtype.names:
+        xyz = read_columns(vertices[::step], 'xyz', dtype=np.float64)
+    else:
+        xyz = np.asarray(vertices[::step], np.float64)
+    if len(xyz) < 2:
+        return None
+    distances = cKDTree(xyz).query(xyz, k=2, workers=-1)[0][:, 1]
+    distances = distances[distances > 0]
+    if not len(distances):
+        return None
+    return float(np.median(distances) * np.sqrt(len(xyz) / len(vertices)))
+
+
+def _bounds(path, chunk_size):
+    low, high = np.full(3, np.inf), np.full(3, -np.inf)
+    for _, chunk in iter_chunks(path, ('xyz',), chunk_size):
+        low = np.minimum(low, chunk['xyz'].min(axis=0))
+        high = np.maximum(high, chunk['xyz'].max(axis=0))
+    return low, high
+
+
+def _slab_edges(vertices, axis, count, origin, voxel_size):
+    """Inner slab boundaries along `axis`, balanced on a sample and snapped to the voxel grid"""
+    if count <= 1:
+        return np.empty(0)
+    step = max(1, len(vertices) // SPACING_SAMPLE)
+    sample = np.asarray(vertices[::step][('x', 'y', 'z')[axis]], np.float64)
+    quantiles = np.quantile(sample, np.linspace(0, 1, count + 1)[1:-1])
+    return np.unique(origin[axis] + np.floor((quantiles - origin[axis]) / voxel_size) * voxel_size)
+
+
+def _voxel_average(rows, origin, voxel_size):
+    """Average position, normal and color of the points in each occupied voxel"""
+    xyz = read_columns(rows, 'xyz', dtype=np.float64)
+    ijk = np.floor((xyz - origin) / voxel_size).astype(np.int64)
+    dims = ijk.max(axis=0) + 1
+    _, inverse, counts = np.unique((ijk[:, 0] * dims[1] + ijk[:, 1]) * dims[2] + ijk[:, 2],
+                                   return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+
+    def mean(values):
+        return np.stack([np.bincount(inverse, values[:, i], len(counts)) for i in range(values.shape[1])],
+                        axis=1) / counts[:, None]
+
+    result = {'xyz': mean(xyz)}
+    if has_columns(rows, 'normals'):
+        normals = mean(read_columns(rows, 'normals', dtype=np.float64))
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+        result['normals'] = normals.astype(np.float32)
+    if has_columns(rows, 'rgb'):
+        result['rgb'] = np.clip(np.round(mean(read_columns(rows, 'rgb', dtype=np.float64))),
+                                0, 255).astype(np.uint8)
+    return result
+
+
+def _slab_neighbourhood(tmp, slab, num_slabs, edges, axis, halo):
+    """Downsampled points of a slab followed by those of its neighbours within `halo`"""
+    own = np.load(os.path.join(tmp, f'{slab}_xyz.npy'))
+    parts = [own]
+    if slab > 0:
+        before = np.load(os.path.join(tmp, f'{slab - 1}_xyz.npy'), mmap_mode='r')
+        parts.append(before[before[:, axis] >= edges[slab - 1] - halo])
+    if slab < num_slabs - 1:
+        after = np.load(os.path.join(tmp, f'{slab + 1}_xyz.npy'), mmap_mode='r')
+        parts.append(after[after[:, axis] < edges[slab] + halo])
+    return own, np.concatenate(parts)
+
+
+def clean_point_cloud(input_path, output_path, options=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Voxel-downsample a point cloud and remove outliers, out of core
+
+    The input is streamed from `input_path` and split into slabs along its
+    longest axis (balanced on a sample, at most about `slab_points` points
+    each), so peak memory depends on `slab_points`, not on the cloud size.
+    Each slab is reduced to one point per occupied voxel with the average
+    position, normal and color of its points. Outliers are then removed
+    per slab, with the points near the neighbouring slabs taken into
+    account: 'statistical' drops points whose mean distance to their
+    `nb_neighbors` nearest neighbours exceeds the global mean by
+    `std_ratio` standard deviations, 'radius' drops points with fewer than
+    `min_neighbors` neighbours within `radius_voxels` voxels. Writes a
+    binary PLY to `output_path` and returns a summary dict.
+    """
+    from scipy.spatial import cKDTree
+
+    options = {**DEFAULT_CLEAN_OPTIONS, **(options or {})}
+    if options['outliers'] not in ('statistical', 'radius', None):
+        raise ValueError(f"Unknown outlier removal method: {options['outliers']}")
+    vertices = open_ply(input_path)
+    n = len(vertices)
+    if n == 0:
+        raise ValueError(f"Point cloud is empty: {input_path}")
+    voxel_size = options['voxel_size'] or options['voxel_spacing'] * (estimate_spacing(vertices) or 0)
+    if not voxel_size:
+        raise ValueError(f"Cannot determine a voxel size for {input_path}; set voxel_size")
+    low, high = _bounds(input_path, chunk_size)
+    axis = int(np.argmax(high - low))
+    edges = _slab_edges(vertices, axis, -(-n // options['slab_points']), low, voxel_size)
+    num_slabs = len(edges) + 1
+    has_normals, has_colors = has_columns(vertices, 'normals'), has_columns(vertices, 'rgb')
+    start = time.time()
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp:
+        # Spill the input into slab files
+        if num_slabs > 1:
+            for chunk_start in range(0, n, chunk_size):
+                check_cancelled()
+                rows = np.asarray(vertices[chunk_start:chunk_start + chunk_size])
+                slab = np.searchsorted(edges, rows[('x', 'y', 'z')[axis]], side='right')
+                for i in np.unique(slab):
+                    with open(os.path.join(tmp, f'{i}.raw'), 'ab') as f:
+                        rows[slab == i].tofile(f)
+                report_progress('voxel_downsample', min(chunk_start + chunk_size, n), 2 * n,
+                                time.time() - start)
+
+        # Downsample every slab
+        downsampled = 0
+        for i in range(num_slabs):
+            check_cancelled()
+            if num_slabs == 1:
+                rows = np.asarray(vertices)
+            else:
+                path = os.path.join(tmp, f'{i}.raw')
+                rows = np.fromfile(path, vertices.dtype) if os.path.exists(path) else vertices[:0]
+            result = _voxel_average(rows, low, voxel_size) if len(rows) else {
+                'xyz': np.empty((0, 3)), 'normals': np.empty((0, 3), np.float32),
+                'rgb': np.empty((0, 3), np.uint8)}
+            for column, values in result.items():
+                np.save(os.path.join(tmp, f'{i}_{column}.npy'), values)
+            downsampled += len(result['xyz'])
+            report_progress('voxel_downsample', n + (i + 1) * n // num_slabs, 2 * n, time.time() - start)
+            del rows, result
+
+        # Outlier scores per slab, then the global threshold
+        method = options['outliers']
+        radius = options['radius_voxels'] * voxel_size
+        halo = max(radius, HALO_VOXELS * voxel_size)
+        scores = []
+        start = time.time()
+        for i in range(num_slabs):
+            check_cancelled()
+            own, neighbourhood = _slab_neighbourhood(tmp, i, num_slabs, edges, axis, halo)
+            if method is None or not len(own):
+                scores.append(np.zeros(len(own)))
+                continue
+            tree = cKDTree(neighbourhood)
+            if method == 'statistical':
+                k = min(options['nb_neighbors'] + 1, len(neighbourhood))
+                distances = tree.query(own, k=k, workers=-1)[0].reshape(len(own), -1)
+                scores.append(distances[:, 1:].mean(axis=1) if k > 1 else np.zeros(len(own)))
+            else:
+                scores.append(tree.query_ball_point(own, radius, workers=-1, return_length=True) - 1)
+            report_progress('outlier_removal', i + 1, num_slabs, time.time() - start)
+        if method == 'statistical':
+            all_scores = np.concatenate(scores)
+            threshold = all_scores.mean() + options['std_ratio'] * all_scores.std()
+            keep = [s <= threshold for s in scores]
+        elif method == 'radius':
+            keep = [s >= options['min_neighbors'] for s in scores]
+        else:
+            keep = [np.ones(len(s), bool) for s in scores]
+
+        with PlyWriter(output_path, normals=has_normals, colors=has_colors) as writer:
+            for i, mask in enumerate(keep):
+                columns = [np.load(os.path.join(tmp, f'{i}_{column}.npy'))[mask] if present else None
+                           for column, present in (('xyz', True), ('normals', has_normals), ('rgb', has_colors))]
+                writer.write(*columns)
+            kept = writer.count
+
+    print(f"✓ Point cloud cleaned: {n} → {downsampled} points (voxel {voxel_size:.4g}) "
+          f"→ {kept} after outlier removal")
+    return {'input_points': n, 'voxel_size': voxel_size, 'downsampled_points': downsampled,
+            'output_points': kept}
@@ -0,0 +1,186 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+OCTREE_DIR = 'octree'
+OCTREE_META = 'meta.json'
+POINT_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                        ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+DEFAULT_OCTREE_OPTIONS = {
+    'root_resolution': 128,     # grid cells per axis of the coarsest level
+    'max_levels': 12,           # the last level takes all remaining points
+    'seed': 0,
+    'slab_points': 4_000_000,   # input points held in memory at once
+}
+DEFAULT_POINT_BUDGET = 5_000_000
+DEFAULT_CHUNK_SIZE = 250_000
+SLAB_SAMPLE = 100_000
+
+
+def _cell_keys(ijk, resolution):
+    return (ijk[:, 0] * resolution + ijk[:, 1]) * resolution + ijk[:, 2]
+
+
+def _cells(values, low, size, resolution):
+    return np.minimum(((values - low) / size * resolution).astype(np.int64), resolution - 1)
+
+
+def _records(chunk):
+    """POINT_DTYPE records of an iter_chunks() block; clouds without colors are light grey"""
+    records = np.empty(len(chunk['xyz']), POINT_DTYPE)
+    for i, axis in enumerate('xyz'):
+        records[axis] = chunk['xyz'][:, i]
+    for i, channel in enumerate(('red', 'green', 'blue')):
+        records[channel] = chunk['rgb'][:, i] if 'rgb' in chunk else 200
+    return records
+
+
+def _slab_edges(vertices, low, size, resolution, count):
+    """Inner slab boundaries in root cells along x, balanced on a sample of the points"""
+    if count <= 1:
+        return np.empty(0, np.int64)
+    step = max(1, len(vertices) // SLAB_SAMPLE)
+    cells = _cells(np.asarray(vertices[::step]['x'], np.float32), low[0], size, resolution)
+    quantiles = np.quantile(cells, np.linspace(0, 1, count + 1)[1:-1])
+    return np.unique(np.clip(np.round(quantiles).astype(np.int64), 1, resolution - 1))
+
+
+def _levels(records, low, size, options, rng):
+    """Records of each level within one slab, sorted by cell"""
+    xyz = np.stack([records['x'], records['y'], records['z']], axis=1)
+    remaining = rng.permutation(len(records))
+    for level in range(options['max_levels']):
+        if not len(remaining):
+            break
+        resolution = options['root_resolution'] << level
+        keys = _cell_keys(_cells(xyz[remaining], low, size, resolution), resolution)
+        if level == options['max_levels'] - 1:
+            chosen = remaining[np.argsort(keys, kind='stable')]
+            remaining = remaining[:0]
+        else:
+            # First point of every cell in the shuffled order, sorted by cell
+            _, first = np.unique(keys, return_index=True)
+            chosen = remaining[first]
+            keep = np.ones(len(remaining), bool)
+            keep[first] = False
+            remaining = remaining[keep]
+        yield records[chosen]
+
+
+def build_octree_lod(ply_path, out_dir, options=None):
+    """Coarse-to-fine level files of a point cloud, for progressive display
+
+    Like Potree's octree, level l keeps at most one point per cell of a
+    grid with root_resolution * 2^l cells per axis over the bounding cube,
+    taken from the points no coarser level kept (in a random order, so the
+    subsets are unbiased). Each level is a flat file of POINT_DTYPE
+    records sorted by cell, so any prefix of it is a memory-mappable,
+    spatially even chunk; meta.json lists the levels. Returns the meta dict.
+
+    The cloud is streamed and spilled into slabs of whole root cells along
+    x (at most about `slab_points` points each, balanced on a sample). A
+    cell of any level lies in a single slab and x is the most significant
+    part of the cell keys, so the slabs are processed one at a time and
+    appended to the level files in order.
+    """
+    from utils.colmap_runner import check_cancelled, report_progress
+    from utils.ply_io import iter_chunks, open_ply
+
+    options = {**DEFAULT_OCTREE_OPTIONS, **(options or {})}
+    vertices = open_ply(ply_path)
+    n = len(vertices)
+    low, high = np.full(3, np.inf, np.float32), np.full(3, -np.inf, np.float32)
+    for _, chunk in iter_chunks(ply_path, ('xyz',)):
+        low = np.minimum(low, chunk['xyz'].min(axis=0))
+        high = np.maximum(high, chunk['xyz'].max(axis=0))
+    if not n:
+        low, high = np.zeros(3, np.float32), np.zeros(3, np.float32)
+    low = low.astype(np.float32)
+    size = float((high - low).max()) or 1.0
+    edges = _slab_edges(vertices, low, size, options['root_resolution'], -(-n // options['slab_points']))
+    num_slabs = len(edges) + 1
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    rng = np.random.default_rng(options['seed'])
+    counts = []
+    start = time.time()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(out_dir))) as tmp:
+        # Spill the input into slab files
+        if num_slabs > 1:
+            for _, chunk in iter_chunks(ply_path, ('xyz', 'rgb')):
+                check_cancelled()
+                records = _records(chunk)
+                slab = np.searchsorted(edges, _cells(records['x'], low[0], size, options['root_resolution']),
+                                       side='right')
+                for i in np.unique(slab):
+                    with open(os.path.join(tmp, f'{i}.bin'), 'ab') as f:
+                        records[slab == i].tofile(f)
+
+        for i in range(num_slabs):
+            check_cancelled()
+            if num_slabs == 1:
+                parts = [_records(chunk) for _, chunk in iter_chunks(ply_path, ('xyz', 'rgb'))]
+                records = np.concatenate(parts) if parts else np.empty(0, POINT_DTYPE)
+            else:
+                path = os.path.join(tmp, f'{i}.bin')
+                records = np.fromfile(path, POINT_DTYPE) if os.path.exists(path) else np.empty(0, POINT_DTYPE)
+            for level, chosen in enumerate(_levels(records, low, size, options, rng)):
+                if level == len(counts):
+                    counts.append(0)
+                with open(os.path.join(out_dir, f'level_{level}.bin'), 'ab') as f:
+                    chosen.tofile(f)
+                counts[level] += len(chosen)
+            report_progress('point_cloud_lod', i + 1, num_slabs, time.time() - start)
+            del records
+
+    levels = [{'file': f'level_{level}.bin', 'count': count, 'resolution': options['root_resolution'] << level}
+              for level, count in enumerate(counts)]
+    meta = {'source': os.path.basename(ply_path), 'count': n, 'bounds_min': low.tolist(),
+            'size': size, 'dtype': POINT_DTYPE.descr, 'levels': levels}
+    with open(os.path.join(out_dir, OCTREE_META), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(f"✓ Point cloud LOD: {n} points in {len(levels)} levels "
+          f"({', '.join(str(l['count']) for l in levels)})")
+    return meta
+
+
+def load_octree_meta(octree_dir):
+    """meta.json of an octree written by build_octree_lod(), or None"""
+    try:
+        with open(os.path.join(octree_dir, OCTREE_META)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def iter_octree(octree_dir, point_budget=DEFAULT_POINT_BUDGET, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (xyz float64, rgb float64 in [0, 1]) chunks, coarse to fine, up to `point_budget` points
+
+    The first chunk is the whole coarsest level, so a viewer can show the
+    overall shape at once; finer levels follow in `chunk_size` pieces read
+    from memory maps. A level cut short by the budget still covers the
+    whole scene, its records being sorted by cell.
+    """
+    meta = load_octree_meta(octree_dir)
+    if meta is None:
+        raise FileNotFoundError(f"No point cloud octree in {octree_dir}")
+    remaining = point_budget
+    for index, level in enumerate(meta['levels']):
+        if remaining <= 0 or not level['count']:
+            break
+        records = np.memmap(os.path.join(octree_dir, level['file']), dtype=POINT_DTYPE, mode='r',
+                            shape=(level['count'],))
+        count = min(level['count'], remaining)
+        # Thin a partly shown level evenly over all its records instead of showing a spatial prefix
+        piece = count if index == 0 else chunk_size
+        for start in range(0, count, piece):
+            rows = records[np.arange(start, min(start + piece, count)) * level['count'] // count]
+            xyz = np.stack([rows['x'], rows['y'], rows['z']], axis=1).astype(np.float64)
+            rgb = np.stack([rows['red'], rows['green'], rows['blue']], axis=1) / 255.0
+            yield xyz, rgb
+        remaining -= count
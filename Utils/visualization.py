@@ -3,6 +3,9 @@ import matplotlib.pyplot as plt
 import cv2
 import numpy as np
 
+from utils.ply_io import to_open3d
+from utils.point_cloud_lod import DEFAULT_POINT_BUDGET, iter_octree
+
 def show_keypoints(image_path, keypoints, scores=None):
     """Display keypoints on an image"""
     # Load the image
@@ -32,12 +35,37 @@ def show_keypoints(image_path, keypoints, scores=None):
     plt.show()
 
 def show_point_cloud(points, colors=None):
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(points)
-    if colors is not None:
-        pcd.colors = o3d.utility.Vector3dVector(colors)
+    """Display points with optional colors (floats in [0, 1] or uint8)"""
+    pcd = to_open3d({'xyz': points, 'rgb': colors})
     o3d.visualization.draw_geometries([pcd])
 
+def show_point_cloud_lod(octree_dir, point_budget=DEFAULT_POINT_BUDGET):
+    """Display a point cloud octree (see utils.point_cloud_lod) progressively
+
+    The coarsest level is shown as soon as it is read; finer levels are
+    then streamed into the open window until `point_budget` points are
+    shown or the window is closed.
+    """
+    vis = o3d.visualization.Visualizer()
+    vis.create_window(window_name='Point Cloud')
+    pcd = o3d.geometry.PointCloud()
+    closed = False
+    for i, (xyz, rgb) in enumerate(iter_octree(octree_dir, point_budget)):
+        pcd.points.extend(o3d.utility.Vector3dVector(xyz))
+        pcd.colors.extend(o3d.utility.Vector3dVector(rgb))
+        if i == 0:
+            vis.add_geometry(pcd)
+        else:
+            # Keeps the camera the user may have moved already
+            vis.update_geometry(pcd)
+        if not vis.poll_events():
+            closed = True
+            break
+        vis.update_renderer()
+    if not closed:
+        vis.run()
+    vis.destroy_window()
+
 def show_mesh(mesh_path):
     mesh = o3d.io.read_triangle_mesh(mesh_path)
     mesh.compute_vertex_normals()
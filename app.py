@@ -1,20 +1,23 @@
 import os
-import shutil
-import datetime
-import threading
 import time
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from utils.colmap_sparse import run_colmap_sparse
-from utils.colmap_dense import run_colmap_dense
-from utils.mesh_generation import run_colmap_mesher
-from utils.visualization import show_keypoints, show_point_cloud, show_mesh
+from utils.pipeline import OUTPUTS_DIR, run_mesh
+from utils.job_scheduler import JOBS_DB, JobScheduler
+from utils.visualization import show_keypoints, show_point_cloud, show_point_cloud_lod, show_mesh
 from utils.feature_extraction import extract_superpoint_features
+from utils.feature_store import get_feature_store
+from utils.pair_planner import DEFAULT_NUM_NEIGHBORS, strategies_for
+from utils.execution_profiles import PROFILES
 from utils.image_processing import load_image
-import numpy as np
+from utils.ply_io import read_point_cloud
+from utils.point_cloud_archive import ARCHIVE_NAME, load_archive
+from utils.point_cloud_lod import OCTREE_DIR, OCTREE_META, load_octree_meta
 
-IMAGES_DIR = 'images'
-OUTPUTS_DIR = 'outputs'
+# Triangles the mesh viewer is given at most (see utils.mesh_lod)
+VIEW_MAX_TRIANGLES = 2_000_000
+# Points the point cloud viewer streams from the octree at most (see utils.point_cloud_lod)
+VIEW_POINT_BUDGET = 5_000_000
 
 class ThreeDModelApp:
     def __init__(self, root):
@@ -27,6 +30,10 @@ class ThreeDModelApp:
 
         self.image_paths = []
         self.latest_run_dir = None
+        # Reconstructions run as jobs of a persistent queue; the UI follows the last one submitted
+        self._active_job = None
+        self.scheduler = JobScheduler(os.path.join(OUTPUTS_DIR, JOBS_DB), progress=self._on_job_event)
+        self.scheduler.start()
         self.style = ttk.Style()
         self.style.theme_use('clam')
         self._configure_styles()
@@ -60,14 +67,29 @@ class ThreeDModelApp:
         self.image_list_preview_scrollbar = ttk.Scrollbar(upload_frame, orient=tk.VERTICAL, command=self.image_list_preview.yview)
         self.image_list_preview_scrollbar.pack(side=tk.LEFT, fill=tk.Y)
         self.image_list_preview.config(yscrollcommand=self.image_list_preview_scrollbar.set)
-        # Feature type radio buttons (removed, only SIFT is used)
-        # self.feature_type_var = tk.StringVar(value='sift')
-        # feature_frame = ttk.Frame(control_frame)
-        # feature_frame.pack(fill=tk.X, pady=5)
-        # ttk.Label(feature_frame, text="Feature Type:").pack(side=tk.LEFT, padx=(0, 10))
-        # ttk.Radiobutton(feature_frame, text="SIFT (Default)", variable=self.feature_type_var, value='sift').pack(side=tk.LEFT)
+        # Feature type radio buttons
+        self.feature_type_var = tk.StringVar(value='sift')
+        feature_frame = ttk.Frame(control_frame)
+        feature_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(feature_frame, text="Feature Type:").pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Radiobutton(feature_frame, text="SIFT (Default)", variable=self.feature_type_var, value='sift', command=self._update_pair_strategies).pack(side=tk.LEFT)
+        ttk.Radiobutton(feature_frame, text="SuperPoint + SuperGlue", variable=self.feature_type_var, value='superpoint', command=self._update_pair_strategies).pack(side=tk.LEFT, padx=(10, 0))
+        # Pair selection strategy and number of neighbors
+        self.pair_strategy_var = tk.StringVar(value='exhaustive')
+        self.num_neighbors_var = tk.IntVar(value=DEFAULT_NUM_NEIGHBORS)
+        ttk.Label(feature_frame, text="Pair Selection:").pack(side=tk.LEFT, padx=(30, 10))
+        self.pair_strategy_combo = ttk.Combobox(feature_frame, textvariable=self.pair_strategy_var, values=strategies_for('sift'), state='readonly', width=12)
+        self.pair_strategy_combo.pack(side=tk.LEFT)
+        ttk.Label(feature_frame, text="Neighbors (k):").pack(side=tk.LEFT, padx=(10, 5))
+        ttk.Spinbox(feature_frame, from_=1, to=200, textvariable=self.num_neighbors_var, width=5).pack(side=tk.LEFT)
+        # Execution profile ('default' keeps the fixed COLMAP settings)
+        self.profile_var = tk.StringVar(value='default')
+        ttk.Label(feature_frame, text="Profile:").pack(side=tk.LEFT, padx=(30, 10))
+        ttk.Combobox(feature_frame, textvariable=self.profile_var, values=('default',) + tuple(PROFILES), state='readonly', width=10).pack(side=tk.LEFT)
         self.start_reconstruction_btn = ttk.Button(control_frame, text="Start 3D Reconstruction", command=self._start_reconstruction, state=tk.DISABLED, style='Accent.TButton')
-        self.start_reconstruction_btn.pack(pady=20, ipadx=30, ipady=15)
+        self.start_reconstruction_btn.pack(pady=(20, 5), ipadx=30, ipady=15)
+        self.cancel_job_btn = ttk.Button(control_frame, text="Cancel", command=self._cancel_job, state=tk.DISABLED)
+        self.cancel_job_btn.pack(pady=(0, 10))
         self.progress_bar = ttk.Progressbar(control_frame, orient=tk.HORIZONTAL, length=400, mode='indeterminate')
         self.progress_bar.pack(pady=10, fill=tk.X, padx=20)
         self.progress_bar.stop()
@@ -88,6 +110,9 @@ class ThreeDModelApp:
         # Add button to load previous model
         self.load_model_btn = ttk.Button(view_options_frame, text="Load Previous Model", command=self._load_previous_model)
         self.load_model_btn.pack(side=tk.LEFT, padx=10, ipadx=10, ipady=5)
+        # Add button to extend the loaded model with the selected images
+        self.extend_model_btn = ttk.Button(view_options_frame, text="Extend Model with Selected Images", command=self._start_extend, state=tk.DISABLED)
+        self.extend_model_btn.pack(side=tk.LEFT, padx=10, ipadx=10, ipady=5)
         # Add button to view latest logs
         self.view_logs_btn = ttk.Button(view_options_frame, text="View Latest Logs", command=self._view_latest_logs)
         self.view_logs_btn.pack(side=tk.LEFT, padx=10, ipadx=10, ipady=5)
@@ -142,6 +167,22 @@ class ThreeDModelApp:
             self.step_label.config(text=f"Substep: {substep_name}")
         self.root.update_idletasks()
 
+    def _update_colmap_progress(self, event):
+        """Show a running COLMAP command as determinate progress with an ETA"""
+        if event['event'] == 'colmap_done':
+            self._update_log(f" {event['command']} finished in {event['elapsed']:.1f}s")
+            self.progress_bar.config(mode='indeterminate')
+            self.progress_bar.start(10)
+            return
+        text = f"{event['command']} {event['current']}"
+        if event['total']:
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate', maximum=event['total'], value=event['current'])
+            text += f"/{event['total']}"
+        if event['eta'] is not None:
+            text += f" (ETA {int(event['eta']) // 60}m{int(event['eta']) % 60:02d}s)"
+        self.status_label.config(text=f"Status: {text}")
+
     def _select_images(self):
         new_image_paths = filedialog.askopenfilenames(title="Select Images for 3D Reconstruction", filetypes=(("Image files", "*.jpg *.jpeg *.png *.bmp"), ("All files", "*.*")))
         if new_image_paths:
@@ -156,6 +197,7 @@ class ThreeDModelApp:
             self._update_log(f"Selected {len(self.image_paths)} images for reconstruction.")
             self._clear_visualization_area("Images selected. Click 'Start 3D Reconstruction'")
             self._disable_view_buttons()
+            self._update_extend_button()
         else:
             self.image_list_preview.delete(0, tk.END)
             self.image_count_label.config(text="No images selected.")
@@ -164,6 +206,13 @@ class ThreeDModelApp:
             self._clear_visualization_area("Upload images and click 'Start 3D Reconstruction'\n\n3D Visualization Output Area")
             self._disable_view_buttons()
 
+    def _update_pair_strategies(self):
+        """Only offer the pair selection strategies the chosen feature type supports"""
+        strategies = strategies_for(self.feature_type_var.get())
+        self.pair_strategy_combo.config(values=strategies)
+        if self.pair_strategy_var.get() not in strategies:
+            self.pair_strategy_var.set('exhaustive')
+
     def _start_reconstruction(self):
         if not self.image_paths:
             messagebox.showerror("Error", "Please select images first!")
@@ -175,95 +224,94 @@ class ThreeDModelApp:
             self._update_log("Reconstruction cancelled: No output folder name provided.")
             return
         self._output_folder_name = folder_name.strip()
+        self._vocab_tree_path = None
+        if self.pair_strategy_var.get() == 'vocab_tree':
+            self._vocab_tree_path = filedialog.askopenfilename(title="Select COLMAP Vocabulary Tree", filetypes=(("Vocabulary tree", "*.bin"), ("All files", "*.*")))
+            if not self._vocab_tree_path:
+                self._update_log("Reconstruction cancelled: No vocabulary tree selected.")
+                return
         self._set_ui_processing_state()
         self._update_log("Starting 3D reconstruction process...")
         self.status_label.config(text="Status: Processing... Please wait.")
         self._clear_visualization_area("Processing... This may take a while.\n\n(Running local pipeline)")
         self.progress_bar.start(10)
-        processing_thread = threading.Thread(target=self._run_reconstruction_in_background)
-        processing_thread.start()
-
-    def _run_reconstruction_in_background(self):
-        try:
-            # Prepare images directory
-            self.root.after(0, lambda: self._update_step("Preparing image directory", 1))
-            os.makedirs(IMAGES_DIR, exist_ok=True)
-            for f in os.listdir(IMAGES_DIR):
-                file_path = os.path.join(IMAGES_DIR, f)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-            for path in self.image_paths:
-                fname = os.path.basename(path)
-                dest = os.path.join(IMAGES_DIR, fname)
-                shutil.copy(path, dest)
-            self.root.after(0, lambda: self._update_log(f"Copied {len(self.image_paths)} images to working directory"))
-            
-            # Prepare output directories
-            self.root.after(0, lambda: self._update_step("Setting up output directories", 2))
-            run_name = f"run_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{self._output_folder_name}"
-            run_dir = os.path.join(OUTPUTS_DIR, run_name)
-            sparse_dir = os.path.join(run_dir, 'sparse')
-            dense_dir = os.path.join(run_dir, 'dense')
-            mesh_dir = os.path.join(run_dir, 'mesh')
-            database_path = os.path.join(run_dir, 'database.db')
-            os.makedirs(sparse_dir, exist_ok=True)
-            os.makedirs(dense_dir, exist_ok=True)
-            os.makedirs(mesh_dir, exist_ok=True)
-            self.root.after(0, lambda: self._update_log(f"Created output directory: {run_name}"))
-            
-            # Sparse reconstruction
-            self.root.after(0, lambda: self._update_step("Running sparse reconstruction", 3))
-            self.root.after(0, lambda: self._update_substep("Feature extraction, matching, mapping"))
-            self.root.after(0, lambda: self._update_log("Extracting SIFT features from images..."))
-            run_colmap_sparse(IMAGES_DIR, sparse_dir, database_path)
-            self.root.after(0, lambda: self._update_log("✓ Sparse reconstruction completed"))
-            
-            # Dense reconstruction
-            self.root.after(0, lambda: self._update_step("Running dense reconstruction", 4))
-            self.root.after(0, lambda: self._update_substep("Depth estimation, point cloud fusion"))
-            self.root.after(0, lambda: self._update_log("  → Undistorting images for dense reconstruction..."))
-            run_colmap_dense(sparse_dir, IMAGES_DIR, dense_dir)
-            self.root.after(0, lambda: self._update_log(" Dense reconstruction completed"))
-            
-            # Mesh generation
-            self.root.after(0, lambda: self._update_step("Generating mesh model", 5))
-            self.root.after(0, lambda: self._update_substep("Meshing (COLMAP/Open3D)"))
-            self.root.after(0, lambda: self._update_log("  → Running COLMAP mesher..."))
-
-            try:
-                from utils.mesh_generation import create_simple_mesh_from_pointcloud, run_colmap_mesher
-
-                # Try COLMAP mesher first
-                if run_colmap_mesher(sparse_dir, dense_dir, mesh_dir):
-                    self.root.after(0, lambda: self._update_log(" COLMAP mesh generation completed"))
-                else:
-                    raise Exception("COLMAP mesher reported failure")
-            except Exception as e:
-                self.root.after(0, lambda: self._update_log(f" COLMAP mesher failed: {str(e)}"))
-                self.root.after(0, lambda: self._update_log("   Trying Open3D mesh generation..."))
-
-                # Try Open3D mesh generation
-                try:
-                    dense_ply = os.path.join(dense_dir, 'fused.ply')
-                    mesh_ply = os.path.join(mesh_dir, 'mesh.ply')
-                    if create_simple_mesh_from_pointcloud(dense_ply, mesh_ply):
-                        self.root.after(0, lambda: self._update_log(" Open3D mesh generation completed"))
-                    else:
-                        raise Exception("Open3D mesh generation reported failure")
-                except Exception as fallback_error:
-                    self.root.after(0, lambda: self._update_log(f" Mesh generation failed: {str(fallback_error)}"))
-                    raise
-            
-            self.latest_run_dir = run_dir
-            self.root.after(0, lambda: self._update_step("Finalizing reconstruction", 6))
+        options = {
+            'outputs_dir': OUTPUTS_DIR,
+            'feature_type': self.feature_type_var.get(),
+            'pair_strategy': self.pair_strategy_var.get(),
+            'num_neighbors': self.num_neighbors_var.get(),
+            'vocab_tree_path': self._vocab_tree_path,
+            'profile': None if self.profile_var.get() == 'default' else self.profile_var.get(),
+        }
+        self._submit_job(self.image_paths, self._output_folder_name, options)
+
+    def _submit_job(self, image_paths, name=None, options=None, run_dir=None):
+        # Record the id before the job can start, so none of its events are dropped
+        with self.scheduler.dispatch_paused():
+            self._active_job = self.scheduler.submit(image_paths, name, options, run_dir=run_dir)
+        self.cancel_job_btn.config(state=tk.NORMAL)
+        running = len(self.scheduler.jobs('running'))
+        if running:
+            self._update_log(f"Job {self._active_job} queued ({running} job(s) running)")
+
+    def _cancel_job(self):
+        if self._active_job is not None:
+            self._update_log(f"Cancelling job {self._active_job}...")
+            self.scheduler.cancel(self._active_job)
+
+    def _on_job_event(self, job_id, event):
+        """Scheduler callback (worker threads): follow the active job"""
+        if event['event'] != 'job':
+            if job_id == self._active_job:
+                self._on_pipeline_progress(event)
+            return
+        status = event['status']
+        if job_id != self._active_job:
+            if status in ('done', 'failed', 'cancelled'):
+                self.root.after(0, lambda: self._update_log(f"Job {job_id} {status}"))
+            return
+        if status == 'done':
+            self.latest_run_dir = event['run_dir']
             self.root.after(0, self._reconstruction_finished_callback)
-        except Exception as e:
-            self.root.after(0, lambda: self._update_log(f" Error during reconstruction: {str(e)}"))
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Pipeline failed:\n{e}"))
-            self.latest_run_dir = None
+        elif status == 'failed':
+            self.root.after(0, lambda: self._update_log(f" Error during reconstruction: {event['error']}"))
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Pipeline failed:\n{event['error']}"))
+            self.root.after(0, self._reset_ui_after_error)
+        elif status == 'cancelled':
+            self.root.after(0, lambda: self._update_log(f"Job {job_id} cancelled"))
             self.root.after(0, self._reset_ui_after_error)
-        finally:
-            self.root.after(0, self.progress_bar.stop)
+        else:
+            return
+        self._active_job = None
+        self.root.after(0, lambda: self.cancel_job_btn.config(state=tk.DISABLED))
+
+    def _on_pipeline_progress(self, event):
+        """Forward pipeline progress events to the Tk thread"""
+        kind = event['event']
+        if kind == 'step':
+            self.root.after(0, lambda: self._update_step(event['name'], event['step'], event['total_steps']))
+        elif kind == 'substep':
+            self.root.after(0, lambda: self._update_substep(event['name']))
+        elif kind == 'log':
+            self.root.after(0, lambda: self._update_log(event['message']))
+        elif kind in ('colmap_progress', 'colmap_done'):
+            self.root.after(0, lambda: self._update_colmap_progress(event))
+
+    def _start_extend(self):
+        if not self.latest_run_dir:
+            messagebox.showerror("Error", "Load or create a model first!")
+            return
+        if not self.image_paths:
+            messagebox.showerror("Error", "Please select the new images first!")
+            return
+        if not messagebox.askyesno("Extend Model", f"Add {len(self.image_paths)} selected images to\n{self.latest_run_dir}?"):
+            return
+        self._set_ui_processing_state()
+        self._update_log(f"Extending {os.path.basename(self.latest_run_dir)} with {len(self.image_paths)} images...")
+        self.status_label.config(text="Status: Extending model... Please wait.")
+        self._clear_visualization_area("Extending model... This may take a while.")
+        self.progress_bar.start(10)
+        self._submit_job(self.image_paths, run_dir=self.latest_run_dir)
 
     def _reconstruction_finished_callback(self):
         self._update_log(" 3D reconstruction complete!")
@@ -286,6 +334,7 @@ class ThreeDModelApp:
 
     def _set_ui_processing_state(self):
         self.start_reconstruction_btn.config(state=tk.DISABLED)
+        self.extend_model_btn.config(state=tk.DISABLED)
         self.select_images_btn.config(state=tk.DISABLED)
         self._disable_view_buttons()
         self._update_step("Starting reconstruction...", 0, 6)
@@ -294,7 +343,13 @@ class ThreeDModelApp:
         self.start_reconstruction_btn.config(state=tk.NORMAL)
         self.select_images_btn.config(state=tk.NORMAL)
 
+    def _update_extend_button(self):
+        """Extending needs both a loaded model and a new image selection"""
+        state = tk.NORMAL if self.latest_run_dir and self.image_paths else tk.DISABLED
+        self.extend_model_btn.config(state=state)
+
     def _enable_view_buttons(self):
+        self._update_extend_button()
         self.show_superpoint_btn.config(state=tk.NORMAL)  # Enable SuperPoint button
         self.show_pointcloud_btn.config(state=tk.NORMAL)
         self.show_mesh_btn.config(state=tk.NORMAL)
@@ -325,7 +380,7 @@ class ThreeDModelApp:
             self._update_log(f"Extracting SuperPoint features from: {os.path.basename(image_path)}")
             
             # Extract features using SuperPoint
-            keypoints, descriptors, scores = extract_superpoint_features(image_path)
+            keypoints, descriptors, scores = extract_superpoint_features(image_path, store=get_feature_store())
             
             self._update_log(f"✓ Extracted {len(keypoints)} keypoints with SuperPoint")
             
@@ -349,18 +404,33 @@ class ThreeDModelApp:
             messagebox.showerror("Error", "No reconstruction output found.")
             return
         dense_ply = os.path.join(self.latest_run_dir, 'dense', 'fused.ply')
-        if not os.path.exists(dense_ply):
+        archive = os.path.join(self.latest_run_dir, 'dense', ARCHIVE_NAME)
+        if not (os.path.exists(dense_ply) or os.path.exists(archive)):
             messagebox.showerror("Error", f"Point cloud file not found: {dense_ply}")
             return
         try:
             self._update_step("Loading point cloud", 0, 6)
             self._update_log("Loading point cloud for visualization...")
-            import open3d as o3d
-            pcd = o3d.io.read_point_cloud(dense_ply)
-            if len(pcd.points) == 0:
+            octree_dir = os.path.join(self.latest_run_dir, 'dense', OCTREE_DIR)
+            meta = load_octree_meta(octree_dir)
+            # The octree is only current if fused.ply was not rewritten after it
+            if meta and (not os.path.exists(dense_ply) or
+                         os.path.getmtime(os.path.join(octree_dir, OCTREE_META)) >= os.path.getmtime(dense_ply)):
+                if not meta['count']:
+                    messagebox.showinfo("Empty Point Cloud", "No points found in the dense point cloud.")
+                    return
+                show_point_cloud_lod(octree_dir, VIEW_POINT_BUDGET)
+                self._update_log(" Point cloud visualized successfully.")
+                self._update_step("Point cloud visualization complete", 0, 6)
+                return
+            if os.path.exists(dense_ply):
+                cloud = read_point_cloud(dense_ply, ('xyz', 'rgb'))
+            else:
+                cloud = load_archive(archive, ('xyz', 'rgb'))
+            if len(cloud['xyz']) == 0:
                 messagebox.showinfo("Empty Point Cloud", "No points found in the dense point cloud.")
                 return
-            show_point_cloud(np.asarray(pcd.points), np.asarray(pcd.colors) if pcd.has_colors() else None)
+            show_point_cloud(cloud['xyz'], cloud.get('rgb'))
             self._update_log(" Point cloud visualized successfully.")
             self._update_step("Point cloud visualization complete", 0, 6)
         except Exception as e:
@@ -373,8 +443,9 @@ class ThreeDModelApp:
             messagebox.showerror("Error", "No reconstruction output found.")
             return
         
-        # Mesh file path (generated by COLMAP mesher or Open3D fallback)
+        # Mesh file path: the finest LOD level the viewer can handle, else the full mesh
         possible_mesh_files = [
+            run_mesh(self.latest_run_dir, VIEW_MAX_TRIANGLES),
             os.path.join(self.latest_run_dir, 'mesh', 'mesh.ply')
         ]
         
@@ -407,10 +478,11 @@ class ThreeDModelApp:
             self._update_log("Previous model selection cancelled.")
             self._update_step("Ready to start", 0, 6)
             return
-        # Check for expected structure (dense/fused.ply, mesh/mesh.ply, etc.)
+        # Check for expected structure (dense/fused.ply or its archive, mesh/mesh.ply, etc.)
         dense_ply = os.path.join(selected_dir, 'dense', 'fused.ply')
+        archive = os.path.join(selected_dir, 'dense', ARCHIVE_NAME)
         mesh_ply = os.path.join(selected_dir, 'mesh', 'mesh.ply')
-        if not (os.path.exists(dense_ply) and os.path.exists(mesh_ply)):
+        if not ((os.path.exists(dense_ply) or os.path.exists(archive)) and os.path.exists(mesh_ply)):
             self._update_log(f"Selected folder does not contain a valid model: {selected_dir}")
             self._clear_visualization_area("Selected folder is not a valid model run.", fill_color="#e74c3c")
             self._disable_view_buttons()
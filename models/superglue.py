@@ -42,7 +42,7 @@
 
 from copy import deepcopy
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import torch
 from torch import nn
@@ -63,10 +63,17 @@ def MLP(channels: List[int], do_bn: bool = True) -> nn.Module:
 
 
 def normalize_keypoints(kpts, image_shape):
-    """ Normalize keypoints locations based on image image_shape"""
-    _, _, height, width = image_shape
-    one = kpts.new_tensor(1)
-    size = torch.stack([one*width, one*height])[None]
+    """ Normalize keypoints locations based on image image_shape
+
+    image_shape is either the (b, c, h, w) shape shared by the batch or a
+    [b, 2] tensor holding the (h, w) of every batch element.
+    """
+    if isinstance(image_shape, torch.Tensor):
+        size = image_shape.to(kpts).flip(-1)
+    else:
+        _, _, height, width = image_shape
+        one = kpts.new_tensor(1)
+        size = torch.stack([one*width, one*height])[None]
     center = size / 2
     scaling = size.max(1, keepdim=True).values * 0.7
     return (kpts - center[:, None, :]) / scaling[:, None, :]
@@ -84,13 +91,36 @@ class KeypointEncoder(nn.Module):
         return self.encoder(torch.cat(inputs, dim=1))
 
 
-def attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor,torch.Tensor]:
+def attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+              mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor,torch.Tensor]:
     dim = query.shape[1]
     scores = torch.einsum('bdhn,bdhm->bhnm', query, key) / dim**.5
+    if mask is not None:  # [b, m] validity of the keys
+        scores = scores.masked_fill(~mask[:, None, None, :], float('-inf'))
     prob = torch.nn.functional.softmax(scores, dim=-1)
     return torch.einsum('bhnm,bdhm->bdhn', prob, value), prob
 
 
+def attention_sdpa(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                   mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """ Attention through torch's fused scaled_dot_product_attention kernel """
+    q, k, v = [x.permute(0, 2, 3, 1) for x in (query, key, value)]  # b h n d
+    attn_mask = None if mask is None else mask[:, None, None, :]
+    x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+    return x.permute(0, 3, 1, 2)  # b d h n
+
+
+def attention_chunked(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                      mask: Optional[torch.Tensor] = None, chunk_size: int = 512) -> torch.Tensor:
+    """ Attention over blocks of queries, holding at most chunk_size x m scores """
+    outputs = [attention(query[..., i:i+chunk_size], key, value, mask)[0]
+               for i in range(0, query.shape[-1], chunk_size)]
+    return torch.cat(outputs, dim=-1)
+
+
+ATTENTION_BACKENDS = ('einsum', 'sdpa', 'chunked')
+
+
 class MultiHeadedAttention(nn.Module):
     """ Multi-head attention to increase model expressivitiy """
     def __init__(self, num_heads: int, d_model: int):
@@ -100,12 +130,28 @@ class MultiHeadedAttention(nn.Module):
         self.num_heads = num_heads
         self.merge = nn.Conv1d(d_model, d_model, kernel_size=1)
         self.proj = nn.ModuleList([deepcopy(self.merge) for _ in range(3)])
-
-    def forward(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor) -> torch.Tensor:
+        self.backend = 'einsum'
+        self.chunk_size = 512
+        self.check_parity = False
+
+    def _attend(self, query, key, value, mask):
+        if self.backend == 'sdpa' and hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+            return attention_sdpa(query, key, value, mask)
+        if self.backend in ('sdpa', 'chunked'):
+            return attention_chunked(query, key, value, mask, self.chunk_size)
+        return attention(query, key, value, mask)[0]
+
+    def forward(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                mask: Optional[torch.Tensor] = None,
+                parity: Optional[List[float]] = None) -> torch.Tensor:
         batch_dim = query.size(0)
         query, key, value = [l(x).view(batch_dim, self.dim, self.num_heads, -1)
                              for l, x in zip(self.proj, (query, key, value))]
-        x, _ = attention(query, key, value)
+        x = self._attend(query, key, value, mask)
+        # The error goes to the caller's list: the module is shared between threads
+        if self.check_parity and parity is not None and self.backend != 'einsum':
+            reference, _ = attention(query, key, value, mask)
+            parity.append((x - reference).abs().max().item())
         return self.merge(x.contiguous().view(batch_dim, self.dim*self.num_heads, -1))
 
 
@@ -116,8 +162,10 @@ class AttentionalPropagation(nn.Module):
         self.mlp = MLP([feature_dim*2, feature_dim*2, feature_dim])
         nn.init.constant_(self.mlp[-1].bias, 0.0)
 
-    def forward(self, x: torch.Tensor, source: torch.Tensor) -> torch.Tensor:
-        message = self.attn(x, source, source)
+    def forward(self, x: torch.Tensor, source: torch.Tensor,
+                mask: Optional[torch.Tensor] = None,
+                parity: Optional[List[float]] = None) -> torch.Tensor:
+        message = self.attn(x, source, source, mask, parity)
         return self.mlp(torch.cat([x, message], dim=1))
 
 
@@ -129,13 +177,33 @@ class AttentionalGNN(nn.Module):
             for _ in range(len(layer_names))])
         self.names = layer_names
 
-    def forward(self, desc0: torch.Tensor, desc1: torch.Tensor) -> Tuple[torch.Tensor,torch.Tensor]:
+    def set_attention_backend(self, backend: str, chunk_size: int = 512,
+                              check_parity: bool = False) -> None:
+        """ Select 'einsum' (reference), 'sdpa' or 'chunked' attention
+
+        With check_parity, every layer also runs the einsum path and
+        appends the largest absolute difference to the `parity` list passed
+        to forward().
+        """
+        if backend not in ATTENTION_BACKENDS:
+            raise ValueError('Unknown attention backend \"{}\"'.format(backend))
+        for layer in self.layers:
+            layer.attn.backend = backend
+            layer.attn.chunk_size = chunk_size
+            layer.attn.check_parity = check_parity
+
+    def forward(self, desc0: torch.Tensor, desc1: torch.Tensor,
+                mask0: Optional[torch.Tensor] = None,
+                mask1: Optional[torch.Tensor] = None,
+                parity: Optional[List[float]] = None) -> Tuple[torch.Tensor,torch.Tensor]:
         for layer, name in zip(self.layers, self.names):
             if name == 'cross':
                 src0, src1 = desc1, desc0
+                srcmask0, srcmask1 = mask1, mask0
             else:  # if name == 'self':
                 src0, src1 = desc0, desc1
-            delta0, delta1 = layer(desc0, src0), layer(desc1, src1)
+                srcmask0, srcmask1 = mask0, mask1
+            delta0, delta1 = layer(desc0, src0, srcmask0, parity), layer(desc1, src1, srcmask1, parity)
             desc0, desc1 = (desc0 + delta0), (desc1 + delta1)
         return desc0, desc1
 
@@ -149,8 +217,58 @@ def log_sinkhorn_iterations(Z: torch.Tensor, log_mu: torch.Tensor, log_nu: torch
     return Z + u.unsqueeze(2) + v.unsqueeze(1)
 
 
-def log_optimal_transport(scores: torch.Tensor, alpha: torch.Tensor, iters: int) -> torch.Tensor:
-    """ Perform Differentiable Optimal Transport in Log-space for stability"""
+def log_sinkhorn_iterations_tol(Z: torch.Tensor, log_mu: torch.Tensor, log_nu: torch.Tensor,
+                                iters: int, tol: float,
+                                check_every: int = 10) -> Tuple[torch.Tensor, torch.Tensor]:
+    """ Sinkhorn Normalization in Log-space that stops early once converged
+
+    Every `check_every` iterations the L1 error of the row marginals (the
+    column marginals are exact right after the v update) is compared to
+    `tol`. Iteration stops as soon as every batch element has converged or
+    `iters` is reached. Also returns the iteration count at which each
+    batch element first converged.
+    """
+    u, v = torch.zeros_like(log_mu), torch.zeros_like(log_nu)
+    b = Z.shape[0]
+    n_iters = torch.full((b,), iters, dtype=torch.int, device=Z.device)
+    converged = torch.zeros(b, dtype=torch.bool, device=Z.device)
+    for i in range(1, iters + 1):
+        u = log_mu - torch.logsumexp(Z + v.unsqueeze(1), dim=2)
+        v = log_nu - torch.logsumexp(Z + u.unsqueeze(2), dim=1)
+        if i % check_every == 0 and i < iters:
+            row_marginal = torch.logsumexp(Z + u.unsqueeze(2) + v.unsqueeze(1), dim=2)
+            err = (row_marginal.exp() - log_mu.exp()).abs().sum(1)
+            newly = (err < tol) & ~converged
+            n_iters = torch.where(newly, n_iters.new_tensor(i), n_iters)
+            converged = converged | newly
+            if bool(converged.all()):
+                break
+    return Z + u.unsqueeze(2) + v.unsqueeze(1), n_iters
+
+
+def _sinkhorn(couplings, log_mu, log_nu, iters, tol, check_every):
+    if tol is None:
+        Z = log_sinkhorn_iterations(couplings, log_mu, log_nu, iters)
+        return Z, torch.full((Z.shape[0],), iters, dtype=torch.int, device=Z.device)
+    return log_sinkhorn_iterations_tol(couplings, log_mu, log_nu, iters, tol, check_every)
+
+
+def log_optimal_transport(scores: torch.Tensor, alpha: torch.Tensor, iters: int,
+                          mask0: Optional[torch.Tensor] = None,
+                          mask1: Optional[torch.Tensor] = None,
+                          tol: Optional[float] = None, check_every: int = 10,
+                          return_iterations: bool = False):
+    """ Perform Differentiable Optimal Transport in Log-space for stability
+
+    For padded batches, mask0 [b, m] and mask1 [b, n] flag the valid
+    keypoints; padded rows and columns get zero mass. With `tol` set,
+    Sinkhorn stops early once the marginals are within `tol`; pass
+    `return_iterations` to also get the per-pair iteration counts.
+    """
+    if mask0 is not None and mask1 is not None:
+        Z, n_iters = _masked_log_optimal_transport(
+            scores, alpha, iters, mask0, mask1, tol, check_every)
+        return (Z, n_iters) if return_iterations else Z
     b, m, n = scores.shape
     one = scores.new_tensor(1)
     ms, ns = (m*one).to(scores), (n*one).to(scores)
@@ -167,9 +285,35 @@ def log_optimal_transport(scores: torch.Tensor, alpha: torch.Tensor, iters: int)
     log_nu = torch.cat([norm.expand(n), ms.log()[None] + norm])
     log_mu, log_nu = log_mu[None].expand(b, -1), log_nu[None].expand(b, -1)
 
-    Z = log_sinkhorn_iterations(couplings, log_mu, log_nu, iters)
+    Z, n_iters = _sinkhorn(couplings, log_mu, log_nu, iters, tol, check_every)
     Z = Z - norm  # multiply probabilities by M+N
-    return Z
+    return (Z, n_iters) if return_iterations else Z
+
+
+def _masked_log_optimal_transport(scores: torch.Tensor, alpha: torch.Tensor, iters: int,
+                                  mask0: torch.Tensor, mask1: torch.Tensor,
+                                  tol: Optional[float] = None,
+                                  check_every: int = 10) -> Tuple[torch.Tensor, torch.Tensor]:
+    b, m, n = scores.shape
+    ms, ns = mask0.sum(1).to(scores), mask1.sum(1).to(scores)  # [b]
+
+    bins0 = alpha.expand(b, m, 1)
+    bins1 = alpha.expand(b, 1, n)
+    alpha = alpha.expand(b, 1, 1)
+
+    couplings = torch.cat([torch.cat([scores, bins0], -1),
+                           torch.cat([bins1, alpha], -1)], 1)
+
+    norm = - (ms + ns).log()  # [b]
+    ninf = scores.new_tensor(float('-inf'))
+    log_mu = torch.cat([torch.where(mask0, norm[:, None], ninf),
+                        (ns.log() + norm)[:, None]], 1)
+    log_nu = torch.cat([torch.where(mask1, norm[:, None], ninf),
+                        (ms.log() + norm)[:, None]], 1)
+
+    Z, n_iters = _sinkhorn(couplings, log_mu, log_nu, iters, tol, check_every)
+    Z = Z - norm[:, None, None]  # multiply probabilities by M+N
+    return Z, n_iters
 
 
 def arange_like(x, dim: int):
@@ -200,18 +344,34 @@ class SuperGlue(nn.Module):
         'keypoint_encoder': [32, 64, 128, 256],
         'GNN_layers': ['self', 'cross'] * 9,
         'sinkhorn_iterations': 100,
+        'sinkhorn_tolerance': None,  # stop Sinkhorn early below this marginal error
+        'sinkhorn_check_every': 10,
         'match_threshold': 0.2,
+        'attention_backend': 'einsum',  # or 'sdpa' / 'chunked' to bound memory
+        'attention_chunk_size': 512,
+        'attention_check_parity': False,
+    }
+
+    # Named Sinkhorn settings; explicit config values take precedence
+    sinkhorn_presets = {
+        'exact': {'sinkhorn_iterations': 100, 'sinkhorn_tolerance': None},
+        'adaptive': {'sinkhorn_iterations': 100, 'sinkhorn_tolerance': 1e-3},
+        'fast': {'sinkhorn_iterations': 20, 'sinkhorn_tolerance': None},
     }
 
     def __init__(self, config):
         super().__init__()
-        self.config = {**self.default_config, **config}
+        preset = self.sinkhorn_presets[config.get('sinkhorn_preset', 'exact')]
+        self.config = {**self.default_config, **preset, **config}
 
         self.kenc = KeypointEncoder(
             self.config['descriptor_dim'], self.config['keypoint_encoder'])
 
         self.gnn = AttentionalGNN(
             feature_dim=self.config['descriptor_dim'], layer_names=self.config['GNN_layers'])
+        self.gnn.set_attention_backend(
+            self.config['attention_backend'], self.config['attention_chunk_size'],
+            self.config['attention_check_parity'])
 
         self.final_proj = nn.Conv1d(
             self.config['descriptor_dim'], self.config['descriptor_dim'],
@@ -227,6 +387,15 @@ class SuperGlue(nn.Module):
         print('Loaded SuperGlue model (\"{}\" weights)'.format(
             self.config['weights']))
 
+    @staticmethod
+    def _image_shape(data, i):
+        if 'image' + i in data:
+            return data['image' + i].shape
+        shape = data['image_shape' + i]
+        if isinstance(shape, torch.Tensor) and shape.dim() == 2:
+            return shape
+        return (1, 1) + tuple(shape)
+
     def forward(self, data):
         """Run SuperGlue on a pair of keypoints and descriptors"""
         desc0, desc1 = data['descriptors0'], data['descriptors1']
@@ -239,18 +408,28 @@ class SuperGlue(nn.Module):
                 'matches1': kpts1.new_full(shape1, -1, dtype=torch.int),
                 'matching_scores0': kpts0.new_zeros(shape0),
                 'matching_scores1': kpts1.new_zeros(shape1),
+                'sinkhorn_iterations': kpts0.new_zeros(shape0[:1], dtype=torch.int),
             }
 
-        # Keypoint normalization.
-        kpts0 = normalize_keypoints(kpts0, data['image0'].shape)
-        kpts1 = normalize_keypoints(kpts1, data['image1'].shape)
+        # Padded batches flag their valid keypoints with 'mask0' / 'mask1'.
+        mask0, mask1 = data.get('mask0'), data.get('mask1')
+
+        # Keypoint normalization. Callers without the images at hand can pass
+        # their (height, width) as 'image_shape0' / 'image_shape1' instead,
+        # either as a tuple or as a [b, 2] tensor for one shape per pair.
+        kpts0 = normalize_keypoints(kpts0, self._image_shape(data, '0'))
+        kpts1 = normalize_keypoints(kpts1, self._image_shape(data, '1'))
 
         # Keypoint MLP encoder.
         desc0 = desc0 + self.kenc(kpts0, data['scores0'])
         desc1 = desc1 + self.kenc(kpts1, data['scores1'])
 
         # Multi-layer Transformer network.
-        desc0, desc1 = self.gnn(desc0, desc1)
+        errors = [] if self.config['attention_check_parity'] else None
+        desc0, desc1 = self.gnn(desc0, desc1, mask0, mask1, errors)
+        parity = {}
+        if errors is not None:
+            parity['attention_parity_error'] = max(errors, default=0.)
 
         # Final MLP projection.
         mdesc0, mdesc1 = self.final_proj(desc0), self.final_proj(desc1)
@@ -260,9 +439,13 @@ class SuperGlue(nn.Module):
         scores = scores / self.config['descriptor_dim']**.5
 
         # Run the optimal transport.
-        scores = log_optimal_transport(
+        scores, sinkhorn_iters = log_optimal_transport(
             scores, self.bin_score,
-            iters=self.config['sinkhorn_iterations'])
+            iters=self.config['sinkhorn_iterations'],
+            mask0=mask0, mask1=mask1,
+            tol=self.config['sinkhorn_tolerance'],
+            check_every=self.config['sinkhorn_check_every'],
+            return_iterations=True)
 
         # Get the matches with score above "match_threshold".
         max0, max1 = scores[:, :-1, :-1].max(2), scores[:, :-1, :-1].max(1)
@@ -274,6 +457,9 @@ class SuperGlue(nn.Module):
         mscores1 = torch.where(mutual1, mscores0.gather(1, indices1), zero)
         valid0 = mutual0 & (mscores0 > self.config['match_threshold'])
         valid1 = mutual1 & valid0.gather(1, indices1)
+        if mask0 is not None and mask1 is not None:
+            valid0 = valid0 & mask0
+            valid1 = valid1 & mask1
         indices0 = torch.where(valid0, indices0, indices0.new_tensor(-1))
         indices1 = torch.where(valid1, indices1, indices1.new_tensor(-1))
 
@@ -282,4 +468,6 @@ class SuperGlue(nn.Module):
             'matches1': indices1, # use -1 for invalid match
             'matching_scores0': mscores0,
             'matching_scores1': mscores1,
+            'sinkhorn_iterations': sinkhorn_iters,  # per pair
+            **parity,
         }
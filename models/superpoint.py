@@ -172,10 +172,14 @@ class SuperPoint(nn.Module):
             for s in scores]
         scores = [s[tuple(k.t())] for s, k in zip(scores, keypoints)]
 
-        # Discard keypoints near the image borders
+        # Discard keypoints near the image borders. Padded batches pass the
+        # valid (height, width) of every image so padding is masked out too.
+        sizes = data.get('image_size')
+        if sizes is None:
+            sizes = [(h*8, w*8)] * b
         keypoints, scores = list(zip(*[
-            remove_borders(k, s, self.config['remove_borders'], h*8, w*8)
-            for k, s in zip(keypoints, scores)]))
+            remove_borders(k, s, self.config['remove_borders'], int(hs), int(ws))
+            for k, s, (hs, ws) in zip(keypoints, scores, sizes)]))
 
         # Keep the k keypoints with highest score
         if self.config['max_keypoints'] >= 0:
@@ -0,0 +1,205 @@
+"""Headless reconstruction entry point.
+
+    python -m reconstruct IMAGE_DIR --name NAME [options]
+    python -m reconstruct IMAGE_DIR --name NAME --enqueue [--priority P]
+    python -m reconstruct --worker [--max-jobs N]
+    python -m reconstruct --archive RUN_DIR [--lossless] | --restore RUN_DIR
+
+With --enqueue the run is added to the persistent job queue instead
+(see utils.job_scheduler) and --worker runs the queued jobs, several at
+once, until the queue is empty. --archive replaces a run's fused.ply by
+a compressed archive (see utils.point_cloud_archive) and --restore
+writes it back. Progress is written to stdout as one JSON object per line; everything else
+(COLMAP output, diagnostics) goes to stderr. Only the pipeline modules are
+imported, so no display, tkinter, matplotlib or Open3D visualization is
+needed.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from utils.colmap_import import list_images
+from utils.colmap_runner import set_colmap_executable
+from utils.execution_profiles import DENSE_BACKENDS, PROFILES
+from utils.job_scheduler import JOBS_DB, JobScheduler
+from utils.pair_planner import STRATEGIES, DEFAULT_NUM_NEIGHBORS, check_strategy
+from utils.pipeline import DEFAULT_OPTIONS, MESHERS, archive_run, extend_run, restore_run, run_pipeline
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the 3D reconstruction pipeline without a GUI")
+    parser.add_argument('image_dir', nargs='?', help="Directory with the input images")
+    parser.add_argument('--name', help="Name of the run (output folder)")
+    parser.add_argument('--extend', metavar='RUN_DIR',
+                        help="Add the images to this existing run instead of starting a new one")
+    parser.add_argument('--outputs-dir', default=DEFAULT_OPTIONS['outputs_dir'])
+    parser.add_argument('--staging', choices=('auto', 'hardlink', 'symlink', 'copy'),
+                        default=DEFAULT_OPTIONS['staging_mode'],
+                        help="How images are placed in the run's images/ workspace")
+    parser.add_argument('--no-timestamp', action='store_true',
+                        help="Use --name as the run folder name as is; rerunning with the "
+                             "same name resumes at the first stage whose inputs changed")
+    parser.add_argument('--feature-type', choices=('sift', 'superpoint'),
+                        default=DEFAULT_OPTIONS['feature_type'])
+    parser.add_argument('--pair-strategy', choices=STRATEGIES,
+                        default=DEFAULT_OPTIONS['pair_strategy'])
+    parser.add_argument('--num-neighbors', '-k', type=int, default=DEFAULT_NUM_NEIGHBORS)
+    parser.add_argument('--vocab-tree', default=None, help="Vocabulary tree for vocab_tree matching")
+    parser.add_argument('--no-feature-cache', action='store_true')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default=DEFAULT_OPTIONS['profile'],
+                        help="Execution profile scaled to this machine (default: fixed COLMAP settings)")
+    parser.add_argument('--dense-backend', choices=DENSE_BACKENDS, default=DEFAULT_OPTIONS['dense_backend'],
+                        help="'colmap' patch match stereo needs CUDA; 'cpu' uses OpenCV SGBM; "
+                             "'auto' picks by GPU availability")
+    parser.add_argument('--colmap', metavar='PATH',
+                        help="COLMAP executable (default: $COLMAP_PATH, config.json, bin/ or PATH)")
+    parser.add_argument('--min-num-pixels', type=int, default=DEFAULT_OPTIONS['fusion_min_num_pixels'],
+                        help="StereoFusion.min_num_pixels")
+    parser.add_argument('--skip-dense', action='store_true', help="Stop after sparse reconstruction")
+    parser.add_argument('--skip-point-cloud-lod', action='store_true',
+                        help="Do not build the octree the point cloud viewer streams from")
+    parser.add_argument('--skip-clean', action='store_true',
+                        help="Mesh the fused cloud as is, without voxel downsampling and outlier removal")
+    parser.add_argument('--voxel-size', type=float, default=None,
+                        help="Voxel size of the cleaned cloud, in model units (default: from the point spacing)")
+    parser.add_argument('--mesher', choices=MESHERS, default=DEFAULT_OPTIONS['mesher'],
+                        help="'tiled' meshes tiles in parallel at a per-tile Poisson depth; 'simple' "
+                             "runs one Open3D Poisson at depth 8; 'colmap' tries COLMAP's mesher first")
+    parser.add_argument('--lod-levels', type=float, nargs='*', default=DEFAULT_OPTIONS['mesh_lod_levels'],
+                        metavar='FRACTION',
+                        help="Triangle fractions of the mesh LOD pyramid (none: no pyramid)")
+    parser.add_argument('--skip-mesh', action='store_true', help="Do not generate a mesh")
+    queue = parser.add_argument_group('job queue')
+    queue.add_argument('--enqueue', action='store_true', help="Queue the run instead of running it")
+    queue.add_argument('--priority', type=int, default=0, help="Higher priority jobs start first")
+    queue.add_argument('--worker', action='store_true', help="Run the queued jobs until the queue is empty")
+    queue.add_argument('--max-jobs', type=int, default=3, help="Jobs the worker runs at the same time")
+    queue.add_argument('--threads', type=int, default=None,
+                       help="CPU threads shared by the worker's jobs (default: all cores)")
+    queue.add_argument('--cancel', type=int, metavar='JOB_ID', help="Cancel a queued or running job")
+    queue.add_argument('--list-jobs', action='store_true', help="Print the job queue as JSON lines")
+    archive = parser.add_argument_group('archives')
+    archive.add_argument('--archive', metavar='RUN_DIR',
+                         help="Replace the run's dense/fused.ply by a compressed, quantized archive")
+    archive.add_argument('--lossless', action='store_true',
+                         help="With --archive: keep the exact PLY instead of quantizing it")
+    archive.add_argument('--restore', metavar='RUN_DIR', help="Write the archived dense/fused.ply back")
+    args = parser.parse_args(argv)
+    if not args.extend:
+        try:
+            check_strategy(args.feature_type, args.pair_strategy)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.colmap:
+        set_colmap_executable(args.colmap)
+    if args.worker or args.cancel is not None or args.list_jobs:
+        return run_queue_command(args)
+    if args.archive:
+        archive_run(args.archive, args.lossless)
+        return 0
+    if args.restore:
+        restore_run(args.restore)
+        return 0
+    if not args.image_dir:
+        print("error: IMAGE_DIR is required", file=sys.stderr)
+        return 2
+    if not args.name and not args.extend:
+        print("error: --name is required unless --extend is given", file=sys.stderr)
+        return 2
+    image_paths = [os.path.join(args.image_dir, f) for f in list_images(args.image_dir)]
+
+    # Keep stdout for JSON progress only: route everything else, including
+    # the output of COLMAP subprocesses, to stderr.
+    progress_out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    start = time.time()
+
+    def progress(event):
+        event['elapsed'] = round(time.time() - start, 3)
+        progress_out.write(json.dumps(event) + '\n')
+
+    if not image_paths:
+        progress({'event': 'error', 'message': f"No images found in {args.image_dir}"})
+        return 2
+
+    options = {
+        'staging_mode': args.staging,
+        'outputs_dir': args.outputs_dir,
+        'timestamp_run_name': not args.no_timestamp,
+        'feature_type': args.feature_type,
+        'pair_strategy': args.pair_strategy,
+        'num_neighbors': args.num_neighbors,
+        'vocab_tree_path': args.vocab_tree,
+        'use_feature_cache': not args.no_feature_cache,
+        'profile': args.profile,
+        'dense_backend': args.dense_backend,
+        'fusion_min_num_pixels': args.min_num_pixels,
+        'dense': not args.skip_dense,
+        'point_cloud_lod': not args.skip_point_cloud_lod,
+        'clean': not args.skip_clean,
+        'clean_options': {'voxel_size': args.voxel_size} if args.voxel_size else None,
+        'mesh': not (args.skip_dense or args.skip_mesh),
+        'mesher': args.mesher,
+        'mesh_lod_levels': args.lod_levels,
+    }
+    # Stage and matching options of an extension default to the ones the run was built with
+    extend_options = {'staging_mode': args.staging, 'use_feature_cache': not args.no_feature_cache}
+    if args.pair_strategy != DEFAULT_OPTIONS['pair_strategy']:
+        extend_options['pair_strategy'] = args.pair_strategy
+    if args.num_neighbors != DEFAULT_NUM_NEIGHBORS:
+        extend_options['num_neighbors'] = args.num_neighbors
+    if args.enqueue:
+        scheduler = JobScheduler(os.path.join(args.outputs_dir, JOBS_DB))
+        if args.extend:
+            job_id = scheduler.submit(image_paths, options=extend_options, priority=args.priority,
+                                      run_dir=args.extend)
+        else:
+            job_id = scheduler.submit(image_paths, args.name, options, args.priority)
+        progress({'event': 'job', 'job_id': job_id, 'status': 'queued'})
+        return 0
+    try:
+        if args.extend:
+            extend_run(args.extend, image_paths, extend_options, progress)
+        else:
+            run_pipeline(image_paths, args.name, options, progress)
+    except Exception as e:
+        progress({'event': 'error', 'message': str(e)})
+        return 1
+    return 0
+
+
+def run_queue_command(args):
+    scheduler_args = {'max_jobs': args.max_jobs, 'total_threads': args.threads}
+    if args.worker:
+        progress_out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+        sys.stdout.flush()
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        lock = threading.Lock()
+
+        def progress(job_id, event):
+            with lock:
+                progress_out.write(json.dumps({**event, 'job_id': job_id}) + '\n')
+
+        scheduler_args['progress'] = progress
+    scheduler = JobScheduler(os.path.join(args.outputs_dir, JOBS_DB), **scheduler_args)
+    if args.cancel is not None:
+        scheduler.cancel(args.cancel)
+    if args.list_jobs:
+        for job in scheduler.jobs():
+            print(json.dumps({k: v for k, v in job.items() if k not in ('image_paths', 'options')}))
+    if args.worker:
+        scheduler.run_until_empty()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())